@@ -1,8 +1,12 @@
 from __future__ import print_function
 
+import base64
+import collections
+import contextlib
 import json
 import logging
 import os
+import threading
 import time
 
 import ctk
@@ -12,6 +16,36 @@ import vtk
 
 import slicer
 from slicer.ScriptedLoadableModule import *
+from slicer.util import VTKObservationMixin
+
+
+class SparseROIMatrix(object):
+    """Set of ROIs stored as a sparse boolean matrix in CSR form: row `i` holds
+    the IDs of the vertices of the ROI `rowKeys[i]`"""
+
+    def __init__(self, indptr, indices, numberOfPoints, rowKeys):
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = (len(rowKeys), numberOfPoints)
+        self.rowKeys = rowKeys
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def rowSizes(self):
+        return numpy.diff(self.indptr)
+
+    def toDense(self):
+        dense = numpy.zeros(self.shape, dtype=bool)
+        dense[numpy.repeat(numpy.arange(self.shape[0]), self.rowSizes()), self.indices] = True
+        return dense
+
+    def toScipy(self):
+        """Return the matrix as a scipy.sparse.csr_matrix (scipy is required)"""
+        import scipy.sparse
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(self.indices.size, dtype=bool), self.indices, self.indptr),
+            shape=self.shape)
 
 
 class PickAndPaint(ScriptedLoadableModule):
@@ -40,11 +74,23 @@ class PickAndPaint(ScriptedLoadableModule):
 
 
 class PickAndPaintWidget(ScriptedLoadableModuleWidget):
+    @property
+    def logic(self):
+        # The logic is only created when it is first needed
+        if getattr(self, '_logic', None) is None:
+            self._logic = PickAndPaintLogic(self)
+        return self._logic
+
+    @logic.setter
+    def logic(self, logic):
+        self._logic = logic
+
     def setup(self):
         logging.debug("-------Pick And Paint Widget Setup--------")
+        startTime = time.perf_counter()
         ScriptedLoadableModuleWidget.setup(self)
         # reload the logic if there is any change
-        self.logic = PickAndPaintLogic(self)
+        self.logic = None
         self.interactionNode = slicer.mrmlScene.GetNodeByID(
             "vtkMRMLInteractionNodeSingleton")
 
@@ -60,36 +106,66 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         qfile = qt.QFile(path)
         qfile.open(qt.QFile.ReadOnly)
         widget = loader.load(qfile, self.parent)
+        qfile.close()
         self.layout = self.parent.layout()
         self.widget = widget
         self.layout.addWidget(widget)
+        # Walk the widget tree once, PickAndPaintLogic.get uses this index
+        self.widgetIndex = self.indexWidgets(widget)
+        widgets = self.widgetIndex
 
         # this attribute is useful for Longitudinal quantification extension
-        self.inputModelLabel = self.logic.get("inputModelLabel")
+        self.inputModelLabel = widgets["inputModelLabel"]
         # this attribute is useful for Longitudinal quantification extension
-        self.inputLandmarksLabel = self.logic.get("inputLandmarksLabel")
-        self.inputModelSelector = self.logic.get("inputModelSelector")
+        self.inputLandmarksLabel = widgets["inputLandmarksLabel"]
+        self.inputModelSelector = widgets["inputModelSelector"]
         self.inputModelSelector.setMRMLScene(slicer.mrmlScene)
-        self.inputLandmarksSelector = self.logic.get("inputLandmarksSelector")
+        self.inputLandmarksSelector = widgets["inputLandmarksSelector"]
         self.inputLandmarksSelector.setMRMLScene(slicer.mrmlScene)
         self.inputLandmarksSelector.addEnabled = True
         # The "enable" property seems to not be imported from the .ui
         self.inputLandmarksSelector.setEnabled(False)
-        self.loadLandmarksOnSurfacCheckBox = self.logic.get(
-            "loadLandmarksOnSurfacCheckBox")
-        self.landmarksScaleWidget = self.logic.get("landmarksScaleWidget")
-        self.addLandmarksButton = self.logic.get("addLandmarksButton")
-        self.surfaceDeplacementCheckBox = self.logic.get(
-            "surfaceDeplacementCheckBox")
-        self.landmarkComboBox = self.logic.get("landmarkComboBox")
-        self.radiusDefinitionWidget = self.logic.get("radiusDefinitionWidget")
-        self.cleanerButton = self.logic.get("cleanerButton")
-        self.correspondentShapes = self.logic.get("correspondentShapes")
-        self.nonCorrespondentShapes = self.logic.get("nonCorrespondentShapes")
-        self.propagationInputComboBox = self.logic.get(
-            "propagationInputComboBox")
+        self.loadLandmarksOnSurfacCheckBox = widgets["loadLandmarksOnSurfacCheckBox"]
+        self.landmarksScaleWidget = widgets["landmarksScaleWidget"]
+        self.addLandmarksButton = widgets["addLandmarksButton"]
+        self.surfaceDeplacementCheckBox = widgets["surfaceDeplacementCheckBox"]
+        self.landmarkComboBox = widgets["landmarkComboBox"]
+        # The landmarks are held in an item model updated incrementally by the
+        # logic, and can be filtered by typing part of their label
+        self.landmarkComboBoxModel = qt.QStandardItemModel(self.landmarkComboBox)
+        self.landmarkComboBox.setModel(self.landmarkComboBoxModel)
+        self.landmarkComboBox.setEditable(True)
+        self.landmarkComboBox.setInsertPolicy(qt.QComboBox.NoInsert)
+        landmarkCompleter = qt.QCompleter(self.landmarkComboBoxModel, self.landmarkComboBox)
+        landmarkCompleter.setCaseSensitivity(qt.Qt.CaseInsensitive)
+        landmarkCompleter.setFilterMode(qt.Qt.MatchContains)
+        landmarkCompleter.setCompletionMode(qt.QCompleter.PopupCompletion)
+        self.landmarkComboBox.setCompleter(landmarkCompleter)
+        self.radiusDefinitionWidget = widgets["radiusDefinitionWidget"]
+        self.ROITypeComboBox = widgets["ROITypeComboBox"]
+        self.ROIConnectedCheckBox = widgets["ROIConnectedCheckBox"]
+        self.ROIWeightingComboBox = widgets["ROIWeightingComboBox"]
+        self.cleanerButton = widgets["cleanerButton"]
+        self.automaticShapes = widgets["automaticShapes"]
+        self.correspondentShapes = widgets["correspondentShapes"]
+        self.nonCorrespondentShapes = widgets["nonCorrespondentShapes"]
+        self.transferROIShapeCheckBox = widgets["transferROIShapeCheckBox"]
+        self.fillROIHolesCheckBox = widgets["fillROIHolesCheckBox"]
+        self.chainedPropagationCheckBox = widgets["chainedPropagationCheckBox"]
+        self.propagationInputComboBox = widgets["propagationInputComboBox"]
         self.propagationInputComboBox.setMRMLScene(slicer.mrmlScene)
-        self.propagateButton = self.logic.get("propagateButton")
+        self.propagateButton = widgets["propagateButton"]
+        self.ROIStatisticsButton = widgets["ROIStatisticsButton"]
+        self.ROIOverlapsButton = widgets["ROIOverlapsButton"]
+        self.ROIDistancesButton = widgets["ROIDistancesButton"]
+        self.propagationReportLabel = widgets["propagationReportLabel"]
+        self.sparseROIStorageCheckBox = widgets["sparseROIStorageCheckBox"]
+        self.hardenModelMemoryBudgetSpinBox = widgets["hardenModelMemoryBudgetSpinBox"]
+        self.hardenModelPoolLabel = widgets["hardenModelPoolLabel"]
+        self.observersLabel = widgets["observersLabel"]
+        self.recordSessionButton = widgets["recordSessionButton"]
+        self.memoryReportButton = widgets["memoryReportButton"]
+        self.searchStructuresStatusLabel = widgets["searchStructuresStatusLabel"]
 
         # ------------------------------------------------------------------------------------
         #                                   CONNECTIONS
@@ -108,12 +184,67 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
             'currentIndexChanged(QString)', self.onLandmarkComboBoxChanged)
         self.radiusDefinitionWidget.connect(
             'valueChanged(double)', self.onRadiusValueChanged)
+        self.ROITypeComboBox.connect(
+            'currentIndexChanged(int)', self.onROITypeChanged)
+        self.ROIConnectedCheckBox.connect(
+            'stateChanged(int)', self.onROITypeChanged)
+        self.ROIWeightingComboBox.connect(
+            'currentIndexChanged(int)', self.onROITypeChanged)
         self.propagationInputComboBox.connect(
             'checkedNodesChanged()', self.onPropagationInputComboBoxCheckedNodesChanged)
+        self.transferROIShapeCheckBox.connect(
+            'toggled(bool)', self.fillROIHolesCheckBox.setEnabled)
         self.propagateButton.connect('clicked()', self.onPropagateButton)
+        self.ROIStatisticsButton.connect('clicked()', self.onROIStatisticsButton)
+        self.ROIOverlapsButton.connect('clicked()', self.onROIOverlapsButton)
+        self.ROIDistancesButton.connect('clicked()', self.onROIDistancesButton)
+        self.sparseROIStorageCheckBox.connect(
+            'toggled(bool)', self.onSparseROIStorageToggled)
+        self.hardenModelMemoryBudgetSpinBox.connect(
+            'valueChanged(int)', self.onHardenModelMemoryBudgetChanged)
+        self.recordSessionButton.connect('toggled(bool)', self.onRecordSessionToggled)
+        self.memoryReportButton.connect('clicked()', self.onMemoryReportButton)
+        # Polls the background builds of the search structures, see updateSearchStructuresStatus
+        self.searchStructuresStatusTimer = qt.QTimer()
+        self.searchStructuresStatusTimer.setInterval(200)
+        self.searchStructuresStatusTimer.connect('timeout()', self.updateSearchStructuresStatus)
+
+        self.sceneObserverTags = [
+            slicer.mrmlScene.AddObserver(
+                slicer.mrmlScene.EndCloseEvent, self.onCloseScene),
+            slicer.mrmlScene.AddObserver(
+                slicer.mrmlScene.StartSaveEvent, self.onStartSaveScene),
+            slicer.mrmlScene.AddObserver(
+                slicer.mrmlScene.EndSaveEvent, self.onEndSaveScene),
+            slicer.mrmlScene.AddObserver(
+                slicer.mrmlScene.EndImportEvent, self.onEndImportScene),
+        ]
+
+        self.setupTime = time.perf_counter() - startTime
+        logging.debug("-------Pick And Paint Widget Setup done in %.1f ms--------", 1000 * self.setupTime)
 
-        slicer.mrmlScene.AddObserver(
-            slicer.mrmlScene.EndCloseEvent, self.onCloseScene)
+    def cleanup(self):
+        for tag in getattr(self, 'sceneObserverTags', []):
+            slicer.mrmlScene.RemoveObserver(tag)
+        self.sceneObserverTags = []
+        if self._logic is not None:
+            self._logic.stopSessionRecording()
+            self._logic.shutdownPrewarming()
+            # Otherwise the observers of the old logic outlive a module reload
+            self._logic.removeObservers()
+        if hasattr(self, 'searchStructuresStatusTimer'):
+            self.searchStructuresStatusTimer.stop()
+
+    def indexWidgets(self, widget):
+        """Map the object names of `widget` and of all its children to the objects"""
+        widgetIndex = dict()
+        widgetsToVisit = [widget]
+        while widgetsToVisit:
+            currentWidget = widgetsToVisit.pop()
+            if currentWidget.objectName and currentWidget.objectName not in widgetIndex:
+                widgetIndex[currentWidget.objectName] = currentWidget
+            widgetsToVisit.extend(currentWidget.children())
+        return widgetIndex
 
     def enter(self):
         logging.debug('------- in function: enter --------')
@@ -126,7 +257,7 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
             if fidlist.GetAttribute("connectedModelID") != model.GetID():
                 self.inputModelSelector.setCurrentNode(None)
                 self.inputLandmarksSelector.setCurrentNode(None)
-                self.landmarkComboBox.clear()
+                self.logic.clearLandmarkComboBox()
         self.UpdateInterface()
 
         # Checking the names of the fiducials
@@ -141,22 +272,35 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
                     markupID = fidList.GetNthMarkupID(n)
                     markupLabel = fidList.GetNthMarkupLabel(n)
                     landmarkDescription[markupID]["landmarkLabel"] = markupLabel
+                    if fidList is self.logic.selectedFidList:
+                        self.logic.renameLandmarkComboBoxItem(markupID, markupLabel)
                 fidList.SetAttribute("landmarkDescription",
                                      self.logic.encodeJSON(landmarkDescription))
 
+    def onStartSaveScene(self, obj, event):
+        # Nothing was painted if the logic has not been created yet
+        if self._logic is not None:
+            self.logic.onStartSaveScene(obj, event)
+
+    def onEndSaveScene(self, obj, event):
+        if self._logic is not None:
+            self.logic.onEndSaveScene(obj, event)
+
+    def onEndImportScene(self, obj, event):
+        self.logic.onEndImportScene(obj, event)
+
     def onCloseScene(self, obj, event):
-        list_ = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
-        end = list_.GetNumberOfItems()
-        for i in range(end):
-            model = list_.GetItemAsObject(i)
-            hardenModel = slicer.mrmlScene.GetNodesByName(
-                model.GetName()).GetItemAsObject(0)
-            slicer.mrmlScene.RemoveNode(hardenModel)
+        self.logic.cancelPrewarming()
+        self.logic.releaseHardenModels()
         self.radiusDefinitionWidget.value = 0.0
         self.landmarksScaleWidget.value = 2.0
-        self.landmarkComboBox.clear()
+        self.logic.clearLandmarkComboBox()
         self.logic.selectedFidList = None
         self.logic.selectedModel = None
+        self.logic.removeObservers()
+        self.logic.observersChanged()
+        self.logic.releaseMeshCache()
+        self.recordSessionButton.setChecked(False)
 
     def UpdateInterface(self):
         if not self.logic.selectedModel:
@@ -165,8 +309,7 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         if not self.logic.selectedFidList:
             return
         fidList = self.logic.selectedFidList
-        selectedFidReflID = self.logic.findIDFromLabel(
-            fidList, self.landmarkComboBox.currentText)
+        selectedFidReflID = self.logic.getSelectedLandmarkID()
 
         if activeInput:
             # Update values on widgets.
@@ -175,30 +318,41 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
             if landmarkDescription and selectedFidReflID:
                 activeDictLandmarkValue = landmarkDescription[selectedFidReflID]
                 self.radiusDefinitionWidget.value = activeDictLandmarkValue["ROIradius"]
+                self.ROITypeComboBox.blockSignals(True)
+                self.ROIConnectedCheckBox.blockSignals(True)
+                self.ROIWeightingComboBox.blockSignals(True)
+                self.ROITypeComboBox.setCurrentIndex(self.logic.ROI_TYPES.index(
+                    activeDictLandmarkValue.get("ROIType", self.logic.ROI_TYPE_RINGS)))
+                self.ROIConnectedCheckBox.setChecked(
+                    activeDictLandmarkValue.get("ROIConnected", False))
+                self.ROIWeightingComboBox.setCurrentIndex(self.logic.ROI_WEIGHTINGS.index(
+                    activeDictLandmarkValue.get("ROIWeighting", self.logic.ROI_WEIGHTING_BINARY)))
+                self.ROITypeComboBox.blockSignals(False)
+                self.ROIConnectedCheckBox.blockSignals(False)
+                self.ROIWeightingComboBox.blockSignals(False)
                 if activeDictLandmarkValue["projection"]["isProjected"]:
                     self.surfaceDeplacementCheckBox.setChecked(True)
                 else:
                     self.surfaceDeplacementCheckBox.setChecked(False)
             else:
                 self.radiusDefinitionWidget.value = 0.0
-            self.logic.UpdateThreeDView(self.landmarkComboBox.currentText)
+            self.logic.UpdateThreeDView(selectedFidReflID)
 
     def onModelChanged(self):
         logging.debug("-------Model Changed--------")
-        if self.logic.selectedModel:
-            Model = self.logic.selectedModel
-            try:
-                Model.RemoveObserver(self.logic.decodeJSON(
-                    self.logic.selectedModel.GetAttribute("modelModifieTagEvent")))
-            except:
-                pass
+        model = self.inputModelSelector.currentNode()
+        self.logic.recordSessionEvent("modelSelected", modelID=model.GetID() if model else None)
         self.logic.selectedModel = self.inputModelSelector.currentNode()
         self.logic.ModelChanged(self.inputModelSelector,
                                 self.inputLandmarksSelector)
         self.inputLandmarksSelector.setCurrentNode(None)
+        if model:
+            self.logic.schedulePrewarming([model])
 
     def onLandmarksChanged(self):
         logging.debug("-------Landmarks Changed--------")
+        fidList = self.inputLandmarksSelector.currentNode()
+        self.logic.recordSessionEvent("listSelected", fidListID=fidList.GetID() if fidList else None)
         if self.inputModelSelector.currentNode():
             self.logic.FidList = self.inputLandmarksSelector.currentNode()
             self.logic.selectedFidList = self.inputLandmarksSelector.currentNode()
@@ -209,7 +363,7 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
                                             self.inputLandmarksSelector,
                                             onSurface)
             else:
-                self.landmarkComboBox.clear()
+                self.logic.clearLandmarkComboBox()
 
     def onAddButton(self):
         # Add fiducial on the scene.
@@ -249,16 +403,14 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         # The following case can occur if a new MarkupsFiducial is generated to hold new
         # landmarks. The list will start empty and the landmark combo box will hold nothing.
         # In this case there is no need to continue with this routine.
-        if self.landmarkComboBox.currentText == '':
+        selectedFidReflID = self.logic.getSelectedLandmarkID()
+        if not selectedFidReflID:
             return
-        selectedFidReflID = self.logic.findIDFromLabel(
-            fidList, self.landmarkComboBox.currentText)
         isOnSurface = self.surfaceDeplacementCheckBox.isChecked()
         landmarkDescription = self.logic.decodeJSON(
             fidList.GetAttribute("landmarkDescription"))
         if isOnSurface:
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                fidList.GetAttribute("hardenModelID"))
+            hardenModel = self.logic.getHardenModel(fidList)
             landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
             landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
                 self.logic.projectOnSurface(
@@ -272,6 +424,8 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
 
     def onLandmarkComboBoxChanged(self):
         logging.debug("-------- ComboBox changement --------")
+        self.logic.recordSessionEvent("landmarkSelected", label=self.landmarkComboBox.itemText(
+            self.landmarkComboBox.currentIndex))
         self.UpdateInterface()
 
     def onRadiusValueChanged(self):
@@ -279,24 +433,31 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         fidList = self.logic.selectedFidList
         if not fidList:
             return
-        selectedFidReflID = self.logic.findIDFromLabel(
-            fidList, self.landmarkComboBox.currentText)
+        selectedFidReflID = self.logic.getSelectedLandmarkID()
+        if selectedFidReflID:
+            if self.logic.setLandmarkROIRadius(fidList, selectedFidReflID,
+                                               self.radiusDefinitionWidget.value):
+                self.surfaceDeplacementCheckBox.setChecked(True)
+
+    def onROITypeChanged(self):
+        logging.debug("--------- ROI type modification ----------")
+        fidList = self.logic.selectedFidList
+        if not fidList:
+            return
+        selectedFidReflID = self.logic.getSelectedLandmarkID()
         if selectedFidReflID:
             landmarkDescription = self.logic.decodeJSON(
                 fidList.GetAttribute("landmarkDescription"))
             activeLandmarkState = landmarkDescription[selectedFidReflID]
-            activeLandmarkState["ROIradius"] = self.radiusDefinitionWidget.value
-            if not activeLandmarkState["projection"]["isProjected"]:
-                self.surfaceDeplacementCheckBox.setChecked(True)
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                    fidList.GetAttribute("hardenModelID"))
-                landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
-                landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
-                    self.logic.projectOnSurface(
-                        hardenModel, fidList, selectedFidReflID)
+            activeLandmarkState["ROIType"] = self.logic.ROI_TYPES[
+                self.ROITypeComboBox.currentIndex]
+            activeLandmarkState["ROIConnected"] = self.ROIConnectedCheckBox.isChecked()
+            activeLandmarkState["ROIWeighting"] = self.logic.ROI_WEIGHTINGS[
+                self.ROIWeightingComboBox.currentIndex]
             fidList.SetAttribute("landmarkDescription",
                                  self.logic.encodeJSON(landmarkDescription))
-            self.logic.findROI(fidList)
+            if activeLandmarkState["ROIradius"] != 0:
+                self.logic.findROI(fidList)
 
     def onCleanButton(self):
         messageBox = ctk.ctkMessageBox()
@@ -316,12 +477,43 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
             messageBox.setInformativeText("")
             messageBox.exec_()
 
+    def onSparseROIStorageToggled(self, checked):
+        self.logic.setSparseROIStorage(checked)
+
+    def onHardenModelMemoryBudgetChanged(self, value):
+        self.logic.hardenModelMemoryBudget = value * 1024
+        self.logic.evictHardenModels()
+
+    def onRecordSessionToggled(self, checked):
+        if not checked:
+            self.logic.stopSessionRecording()
+            return
+        fileName = qt.QFileDialog.getSaveFileName(
+            None, "Record session", "", "PickAndPaint session (*.jsonl)")
+        if not fileName:
+            self.recordSessionButton.blockSignals(True)
+            self.recordSessionButton.setChecked(False)
+            self.recordSessionButton.blockSignals(False)
+            return
+        self.logic.startSessionRecording(fileName)
+
+    def updateObserversLabel(self, numberOfObservers):
+        self.observersLabel.text = "Live observers: %d" % numberOfObservers
+
+    def updateHardenModelPoolLabel(self):
+        memorySizes = self.logic.getHardenModelMemorySizes()
+        self.hardenModelPoolLabel.text = "Harden copies: %d (%.1f MB)" % (
+            len(memorySizes), sum(memorySizes.values()) / 1024.0)
+
     def onPropagationInputComboBoxCheckedNodesChanged(self):
         if not self.inputModelSelector.currentNode():
             return
+        modelToPropList = self.propagationInputComboBox.checkedNodes()
+        self.logic.setPropagationTargets(
+            [model for model in modelToPropList
+             if model.GetID() != self.inputModelSelector.currentNode().GetID()])
         if not self.inputLandmarksSelector.currentNode():
             return
-        modelToPropList = self.propagationInputComboBox.checkedNodes()
         finalList = list()
         for model in modelToPropList:
             if model.GetID() != self.inputModelSelector.currentNode().GetID():
@@ -329,6 +521,20 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         self.inputLandmarksSelector.currentNode().SetAttribute(
             "modelToPropList", self.logic.encodeJSON({"modelToPropList": finalList}))
 
+    def startSearchStructuresStatusPolling(self):
+        self.updateSearchStructuresStatus()
+        self.searchStructuresStatusTimer.start()
+
+    def updateSearchStructuresStatus(self):
+        self.logic.finishPrewarmedHardenings()
+        numberOfPendingBuilds = self.logic.getNumberOfPendingPrewarmings()
+        if numberOfPendingBuilds:
+            self.searchStructuresStatusLabel.text = \
+                "Search structures: building (%d meshes left)" % numberOfPendingBuilds
+        else:
+            self.searchStructuresStatusLabel.text = "Search structures: ready"
+            self.searchStructuresStatusTimer.stop()
+
     def onPropagateButton(self):
         logging.debug(" ------------------------------------ onPropagateButton -------------------------------------- ")
         if not self.inputModelSelector.currentNode():
@@ -336,78 +542,174 @@ class PickAndPaintWidget(ScriptedLoadableModuleWidget):
         if not self.inputLandmarksSelector.currentNode():
             return
         model = self.inputModelSelector.currentNode()
-        self.logic.cleanerAndTriangleFilter(model)
-        hardenModel = self.logic.createIntermediateHardenModel(model)
-        model.SetAttribute("hardenModelID", hardenModel.GetID())
         fidList = self.inputLandmarksSelector.currentNode()
+        if self.automaticShapes.isChecked():
+            typeOfPropagation = "automatic"
+        elif self.correspondentShapes.isChecked():
+            typeOfPropagation = "correspondentShapes"
+        else:
+            typeOfPropagation = "nonCorrespondentShapes"
+        report = self.logic.propagateFromReference(
+            fidList, model, typeOfPropagation,
+            self.transferROIShapeCheckBox.isChecked(),
+            self.fillROIHolesCheckBox.isChecked(),
+            self.chainedPropagationCheckBox.isChecked())
+        self.propagationReportLabel.text = "\n".join(report)
+        self.UpdateInterface()
 
-        decoded_json = self.logic.decodeJSON(
-            fidList.GetAttribute("modelToPropList"))
-        modelToPropagateList = []
-        if decoded_json is not None:
-            modelToPropagateList = decoded_json["modelToPropList"]
+    def onROIStatisticsButton(self):
+        fidList = self.inputLandmarksSelector.currentNode()
+        if not fidList or not fidList.GetAttribute("connectedModelID"):
+            self.logic.warningMessage("Please select a fiducial list")
+            return
+        self.showTable(self.logic.exportROIStatistics(fidList))
 
-        for IDmodelToPropagate in modelToPropagateList:
-            modelToPropagate = slicer.mrmlScene.GetNodeByID(IDmodelToPropagate)
-            isClean = self.logic.decodeJSON(fidList.GetAttribute("isClean"))
-            if isClean:
-                if not isClean["isClean"]:
-                    self.logic.cleanerAndTriangleFilter(modelToPropagate)
-                    hardenModel = self.logic.createIntermediateHardenModel(
-                        modelToPropagate)
-                    modelToPropagate.SetAttribute(
-                        "hardenModelID", hardenModel.GetID())
-            else:
-                self.logic.cleanerAndTriangleFilter(modelToPropagate)
-                hardenModel = self.logic.createIntermediateHardenModel(
-                    modelToPropagate)
-                modelToPropagate.SetAttribute(
-                    "hardenModelID", hardenModel.GetID())
-            if self.correspondentShapes.isChecked():
-                fidList.SetAttribute("typeOfPropagation",
-                                     "correspondentShapes")
-                self.logic.propagateCorrespondent(
-                    fidList, model, modelToPropagate)
-            else:
-                fidList.SetAttribute("typeOfPropagation",
-                                     "nonCorrespondentShapes")
-                self.logic.propagateNonCorrespondent(fidList, modelToPropagate)
-        self.UpdateInterface()
+    def onROIOverlapsButton(self):
+        model = self.inputModelSelector.currentNode()
+        if not model:
+            self.logic.warningMessage("Please select a model")
+            return
+        fidLists = self.logic.getConnectedFiducialLists(model)
+        if not fidLists:
+            self.logic.warningMessage("No fiducial list is connected to the model")
+            return
+        self.showTable(self.logic.exportROIOverlaps(fidLists, model))
+
+    def onROIDistancesButton(self):
+        fidList = self.inputLandmarksSelector.currentNode()
+        if not fidList or not fidList.GetAttribute("connectedModelID"):
+            self.logic.warningMessage("Please select a fiducial list")
+            return
+        self.showTable(self.logic.exportROIDistances(fidList))
+
+    def onMemoryReportButton(self):
+        self.showTable(self.logic.exportMemoryReport())
+
+    def showTable(self, tableNode):
+        slicer.app.layoutManager().setLayout(
+            slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
+        slicer.app.applicationLogic().GetSelectionNode().SetActiveTableID(tableNode.GetID())
+        slicer.app.applicationLogic().PropagateTableSelection()
 
 
-class PickAndPaintLogic(ScriptedLoadableModuleLogic):
+class PickAndPaintLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     ROI_ARRAY_NAME = '{0}_{1}_ROI'
+    # Signed distances from the ROIs of a fiducial list to a model, see computeROIDistances
+    ROI_DISTANCE_ARRAY_NAME = '{0}_{1}_Distance'
+    ROI_DISTANCE_PERCENTILES = [50, 95]
+    # Topological rings grown from the landmark (see defineNeighbor) or all the
+    # vertices within an Euclidean distance of the landmark (see defineBallNeighbor)
+    ROI_TYPE_RINGS = 'rings'
+    ROI_TYPE_BALL = 'ball'
+    ROI_TYPES = [ROI_TYPE_RINGS, ROI_TYPE_BALL]
+    # Weights of the vertices of an ROI, see computeROIWeights
+    ROI_WEIGHTING_BINARY = 'binary'
+    ROI_WEIGHTING_GAUSSIAN = 'gaussian'
+    ROI_WEIGHTING_HEAT = 'heat'
+    ROI_WEIGHTINGS = [ROI_WEIGHTING_BINARY, ROI_WEIGHTING_GAUSSIAN, ROI_WEIGHTING_HEAT]
+    ROI_MINIMUM_WEIGHT = 1e-6
+    HEAT_DIFFUSION_STEP = 0.5
+    # Model attribute holding the sparse copy of the ROI arrays, see storeSparseROI
+    SPARSE_ROI_ATTRIBUTE = "sparseROIs"
+    # Fiducial list attribute holding the ROIs combined from the ROIs of its
+    # landmarks, see combineROIs
+    COMBINED_ROI_ATTRIBUTE = "combinedROIs"
+    ROI_OPERATIONS = ["union", "intersection", "difference"]
+    ORIGINAL_POINT_ID_ARRAY_NAME = "PickAndPaintOriginalPointID"
+    # Attributes where the observer tags used to be stored, they are removed
+    # from the nodes of old scenes
+    LEGACY_OBSERVER_TAG_ATTRIBUTES = ["PointAddedEventTag", "PointModifiedEventTag",
+                                      "PointRemovedEventTag", "modelModifieTagEvent"]
+
+    PROPAGATION_DESCRIPTIONS = {
+        "correspondentShapes": "correspondent",
+        "nonCorrespondentShapes": "non correspondent",
+    }
+    # Radius (in mm) of the search for the closest vertex around the position
+    # of a landmark on the previous time point, see propagateChained
+    CHAINED_SEARCH_RADIUS = 5.0
+    # Rigid alignments refined on the closest vertices, see computeVertexPermutation:
+    # at most this many closest vertex queries from each of the (at most 5)
+    # starting rotations
+    VERTEX_PERMUTATION_ALIGNMENT_ITERATIONS = 5
+    # Recorded session event -> method replaying it, see replaySession
+    SESSION_EVENT_REPLAYERS = {
+        "modelSelected": "replayModelSelected",
+        "listSelected": "replayListSelected",
+        "landmarkSelected": "replayLandmarkSelected",
+        "pointsAdded": "replayPointsAdded",
+        "pointModified": "replayPointModified",
+        "radiusChanged": "replayRadiusChanged",
+        "propagate": "replayPropagate",
+    }
+    # Memory (in kB) that the harden copies of the models which are not in use
+    # may take before they are removed from the scene, see evictHardenModels
+    HARDEN_MODEL_MEMORY_BUDGET = 512 * 1024
 
     def __init__(self, interface):
+        VTKObservationMixin.__init__(self)
         self.selectedModel = None
         self.selectedFidList = None
         self.interface = interface
+        # Search structures computed on the meshes, see getCachedMeshData
+        self.meshCache = dict()
+        # The mesh cache is also filled by the prewarming thread, see prewarmModels
+        self.meshCacheLock = threading.Lock()
+        self.prewarmExecutor = None
+        self.prewarmFutures = list()
+        # Model ID -> (future of its harden mesh, version of the model), see prewarmModels
+        self.prewarmedHardenings = dict()
+        # Checked models to propagate to, their harden copies are not evicted
+        self.propagationTargetIDs = set()
+        # (model ID, ROI array name) -> (version, statistics), see computeROIStatistics
+        self.ROIStatisticsCache = dict()
+        # Landmark -> rings grown around its closest vertex, see getRingLayers
+        self.ringLayerCache = dict()
+        # (reference mesh, target mesh) -> vertex permutation, see computeVertexPermutation
+        self.vertexPermutationCache = dict()
+        # If True, the ROIs are saved in the scene as sparse index lists and
+        # the dense ROI arrays are rebuilt when the models are displayed
+        self.sparseROIStorage = False
+        self.modelsWithReleasedROIs = set()
+        # Set while onPointModifiedEvent runs, so that the landmark moves it
+        # does itself are ignored
+        self.handlingPointModifiedEvent = False
+        # Landmarks added in a row (loading or pasting a list) are described,
+        # projected and painted together, see onPointAddedEvent
+        self.addedPointsProcessingScheduled = False
+        self.bulkLandmarkImportDepth = 0
+        # Landmark ID -> item of the model of the landmark combo box
+        self.landmarkComboBoxItems = dict()
+        # Harden model ID -> model ID, least recently used first, see getHardenModel
+        self.hardenModelPool = collections.OrderedDict()
+        self.hardenModelMemoryBudget = self.HARDEN_MODEL_MEMORY_BUDGET
+        # Model ID -> number of running operations using its harden model
+        self.modelsInUse = collections.Counter()
+        # Harden model ID -> version of the model it was made from, see getHardenModelVersion
+        self.hardenModelVersions = dict()
+        # File the session events are written to, see startSessionRecording
+        self.sessionRecordFile = None
+        self.sessionRecordStartTime = 0.0
+        # Recorded markup ID -> ID of the landmark added by the replay, see replayPointsAdded
+        self.replayedMarkupIDs = dict()
 
     def get(self, objectName):
-        return self.findWidget(self.interface.widget, objectName)
-
-    def findWidget(self, widget, objectName):
-        if widget.objectName == objectName:
-            return widget
-        else:
-            for w in widget.children():
-                resulting_widget = self.findWidget(w, objectName)
-                if resulting_widget:
-                    return resulting_widget
-            return None
+        """Return the widget of the panel named `objectName`, see indexWidgets"""
+        try:
+            return self.interface.widgetIndex[objectName]
+        except KeyError:
+            raise KeyError("PickAndPaint has no widget named '%s'" % objectName)
 
-    def UpdateThreeDView(self, landmarkLabel):
+    def UpdateThreeDView(self, selectedFidReflID):
         # Update the 3D view on Slicer
         if not self.selectedFidList:
             return
         if not self.selectedModel:
             return
         logging.debug("UpdateThreeDView")
-        active = self.selectedFidList
         # deactivate all landmarks
         list_ = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
         end = list_.GetNumberOfItems()
-        selectedFidReflID = self.findIDFromLabel(active, landmarkLabel)
         for i in range(end):
             fidList = list_.GetItemAsObject(i)
             landmarkDescription = self.decodeJSON(
@@ -427,24 +729,162 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
             displayNode.SetScalarVisibility(True)
 
     def createIntermediateHardenModel(self, model):
+        hardenPolyData = vtk.vtkPolyData()
+        hardenPolyData.DeepCopy(model.GetPolyData())
+        version = self.getHardenModelVersion(model)
+        hardenModel = self.addHardenModelNode(model, hardenPolyData)
+        if model.GetParentTransformNode():
+            hardenModel.SetAndObserveTransformNodeID(
+                model.GetParentTransformNode().GetID())
+            logic = slicer.vtkSlicerTransformLogic()
+            logic.hardenTransform(hardenModel)
+        self.registerHardenModel(model, hardenModel, version)
+        return hardenModel
+
+    def addHardenModelNode(self, model, hardenPolyData):
+        """Put the harden copy of the model in the scene, in the node of the
+        previous copy if there is one"""
         hardenModel = slicer.mrmlScene.GetNodesByName("SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(
             slicer.app.applicationPid())).GetItemAsObject(0)
         if hardenModel is None:
             hardenModel = slicer.vtkMRMLModelNode()
-        hardenPolyData = vtk.vtkPolyData()
-        hardenPolyData.DeepCopy(model.GetPolyData())
+        else:
+            self.releaseMeshCache(hardenModel.GetPolyData())
+            hardenModel.SetAndObserveTransformNodeID(None)
         hardenModel.SetAndObservePolyData(hardenPolyData)
         hardenModel.SetName(
             "SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(slicer.app.applicationPid()))
-        if model.GetParentTransformNode():
-            hardenModel.SetAndObserveTransformNodeID(
-                model.GetParentTransformNode().GetID())
         hardenModel.HideFromEditorsOn()
         slicer.mrmlScene.AddNode(hardenModel)
-        logic = slicer.vtkSlicerTransformLogic()
-        logic.hardenTransform(hardenModel)
         return hardenModel
 
+    def registerHardenModel(self, model, hardenModel, version):
+        self.hardenModelVersions[hardenModel.GetID()] = version
+        self.hardenModelPool[hardenModel.GetID()] = model.GetID()
+        self.hardenModelPool.move_to_end(hardenModel.GetID())
+        self.evictHardenModels(keep=hardenModel.GetID())
+
+    def getHardenModelVersion(self, model):
+        """Key that changes when the mesh of the model or its transform is modified"""
+        transformNode = model.GetParentTransformNode()
+        return (self.meshVersion(model.GetPolyData()),
+                transformNode.GetID() if transformNode else None,
+                transformNode.GetMTime() if transformNode else 0)
+
+    def hasFreshHardenModel(self, model):
+        """Whether the harden copy of the model was made from its current mesh and transform"""
+        hardenModel = slicer.mrmlScene.GetNodeByID(model.GetAttribute("hardenModelID") or "")
+        return hardenModel is not None \
+            and self.hardenModelVersions.get(hardenModel.GetID()) == self.getHardenModelVersion(model)
+
+    def getFreshHardenModel(self, model):
+        """Return the harden copy of the model, made again only if the mesh or
+        the transform of the model changed since it was made (or prewarmed)"""
+        self.finishPrewarmedHardening(model.GetID())
+        if self.hasFreshHardenModel(model):
+            hardenModel = slicer.mrmlScene.GetNodeByID(model.GetAttribute("hardenModelID"))
+            self.hardenModelPool.move_to_end(hardenModel.GetID())
+            return hardenModel
+        hardenModel = self.createIntermediateHardenModel(model)
+        self.setHardenModel(model, hardenModel)
+        return hardenModel
+
+    def getHardenModel(self, node):
+        """Return the harden copy of a model, or of the model connected to a
+        fiducial list. The copy is created again if it was evicted or if it
+        is outdated, and waited for if it is being prewarmed."""
+        model = node
+        if node.IsA("vtkMRMLMarkupsNode"):
+            model = slicer.mrmlScene.GetNodeByID(node.GetAttribute("connectedModelID") or "")
+        if model is None:
+            return slicer.mrmlScene.GetNodeByID(node.GetAttribute("hardenModelID") or "")
+        hardenModel = self.getFreshHardenModel(model)
+        if node.GetAttribute("hardenModelID") != hardenModel.GetID():
+            node.SetAttribute("hardenModelID", hardenModel.GetID())
+        return hardenModel
+
+    def setHardenModel(self, model, hardenModel):
+        """Point the model and the fiducial lists connected to it to a new harden copy"""
+        model.SetAttribute("hardenModelID", hardenModel.GetID())
+        for fidList in self.getConnectedFiducialLists(model):
+            fidList.SetAttribute("hardenModelID", hardenModel.GetID())
+
+    @contextlib.contextmanager
+    def usingHardenModels(self, *models):
+        """Keep the harden copies of the models in the pool while the block runs"""
+        modelIDs = [model.GetID() for model in models]
+        self.modelsInUse.update(modelIDs)
+        try:
+            yield
+        finally:
+            self.modelsInUse.subtract(modelIDs)
+            self.modelsInUse = +self.modelsInUse
+            self.evictHardenModels()
+
+    def getHardenModelReferences(self):
+        """Count, for each harden copy, the fiducial lists connected to it and
+        the models using it (selected model, running propagations and checked
+        propagation targets)"""
+        references = collections.Counter()
+        list_ = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
+        for i in range(list_.GetNumberOfItems()):
+            references[list_.GetItemAsObject(i).GetAttribute("hardenModelID")] += 1
+        models = [self.selectedModel] + [slicer.mrmlScene.GetNodeByID(modelID)
+                                         for modelID in [*self.modelsInUse, *self.propagationTargetIDs]]
+        for model in models:
+            if model is not None:
+                references[model.GetAttribute("hardenModelID")] += 1
+        return references
+
+    def getHardenModelMemorySizes(self):
+        """Return the memory (in kB) of each harden copy of the pool"""
+        memorySizes = dict()
+        for hardenModelID in list(self.hardenModelPool):
+            hardenModel = slicer.mrmlScene.GetNodeByID(hardenModelID)
+            if hardenModel is None:
+                del self.hardenModelPool[hardenModelID]
+                continue
+            polyData = hardenModel.GetPolyData()
+            memorySizes[hardenModelID] = polyData.GetActualMemorySize() if polyData else 0
+        return memorySizes
+
+    def evictHardenModels(self, keep=None):
+        """Remove the least recently used harden copies that are not referenced
+        until the pool fits in the memory budget"""
+        memorySizes = self.getHardenModelMemorySizes()
+        totalMemorySize = sum(memorySizes.values())
+        if totalMemorySize > self.hardenModelMemoryBudget:
+            references = self.getHardenModelReferences()
+            for hardenModelID in list(self.hardenModelPool):
+                if totalMemorySize <= self.hardenModelMemoryBudget:
+                    break
+                if hardenModelID == keep or references[hardenModelID]:
+                    continue
+                hardenModel = slicer.mrmlScene.GetNodeByID(hardenModelID)
+                self.releaseMeshCache(hardenModel.GetPolyData())
+                slicer.mrmlScene.RemoveNode(hardenModel)
+                # The model does not point to a removed node, getHardenModel
+                # makes the copy again when it is needed
+                model = slicer.mrmlScene.GetNodeByID(self.hardenModelPool.pop(hardenModelID))
+                if model is not None and model.GetAttribute("hardenModelID") == hardenModelID:
+                    model.SetAttribute("hardenModelID", "")
+                self.hardenModelVersions.pop(hardenModelID, None)
+                totalMemorySize -= memorySizes[hardenModelID]
+        if self.interface:
+            self.interface.updateHardenModelPoolLabel()
+
+    def releaseHardenModels(self):
+        """Remove all the harden copies of the pool from the scene"""
+        for hardenModelID in self.hardenModelPool:
+            hardenModel = slicer.mrmlScene.GetNodeByID(hardenModelID)
+            if hardenModel is not None:
+                slicer.mrmlScene.RemoveNode(hardenModel)
+        self.hardenModelPool.clear()
+        self.hardenModelVersions.clear()
+        self.modelsInUse.clear()
+        if self.interface:
+            self.interface.updateHardenModelPoolLabel()
+
     def onModelModified(self, obj, event):
         # recompute the harden model
         hardenModel = self.createIntermediateHardenModel(obj)
@@ -465,8 +905,7 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
                     for n in range(fidList.GetNumberOfMarkups()):
                         markupID = fidList.GetNthMarkupID(n)
                         if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                            hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                                fidList.GetAttribute("hardenModelID"))
+                            hardenModel = self.getHardenModel(fidList)
                             markupsIndex = fidList.GetNthControlPointIndexByID(markupID)
                             self.replaceLandmark(hardenModel.GetPolyData(), fidList, markupsIndex,
                                                  landmarkDescription[markupID]["projection"]["closestPointIndex"])
@@ -478,18 +917,21 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
         # if a Model Node is present
         if inputModel:
             self.selectedModel = inputModel
-            hardenModel = self.createIntermediateHardenModel(inputModel)
-            inputModel.SetAttribute("hardenModelID", hardenModel.GetID())
-            modelModifieTagEvent = inputModel.AddObserver(
-                inputModel.TransformModifiedEvent, self.onModelModified)
-            inputModel.SetAttribute("modelModifieTagEvent", self.encodeJSON(
-                {"modelModifieTagEvent": modelModifieTagEvent}))
+            self.restoreSparseROIs(inputModel)
+            # An outdated harden copy is kept until prewarmModels, or
+            # getHardenModel on first use, registers a new one
+            self.removeLegacyObserverTags(inputModel)
+            self.removeObservers(self.onModelModified)
+            self.addObserver(inputModel, inputModel.TransformModifiedEvent,
+                             self.onModelModified)
             inputLandmarksSelector.setEnabled(True)
         # if no model is selected
         else:
+            self.removeObservers(self.onModelModified)
             # Update the fiducial list selector
             inputLandmarksSelector.setCurrentNode(None)
             inputLandmarksSelector.setEnabled(False)
+        self.observersChanged()
 
     def isUnderTransform(self, markups):
         if markups.GetParentTransformNode():
@@ -534,32 +976,37 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
             messageBox.exec_()
             return False
 
+    def newLandmarkState(self, landmarkLabel, isProjected, closestPointIndex=None):
+        landmarkState = dict()
+        landmarkState["landmarkLabel"] = landmarkLabel
+        landmarkState["ROIradius"] = 0
+        landmarkState["ROIType"] = self.ROI_TYPE_RINGS
+        landmarkState["ROIConnected"] = False
+        landmarkState["ROIWeighting"] = self.ROI_WEIGHTING_BINARY
+        landmarkState["projection"] = dict()
+        landmarkState["projection"]["isProjected"] = isProjected
+        landmarkState["projection"]["closestPointIndex"] = closestPointIndex
+        landmarkState["midPoint"] = dict()
+        landmarkState["midPoint"]["definedByThisMarkup"] = list()
+        landmarkState["midPoint"]["isMidPoint"] = False
+        landmarkState["midPoint"]["Point1"] = None
+        landmarkState["midPoint"]["Point2"] = None
+        return landmarkState
+
     def createNewDataStructure(self, landmarks, model, onSurface):
         landmarks.SetAttribute("connectedModelID", model.GetID())
         landmarks.SetAttribute(
             "hardenModelID", model.GetAttribute("hardenModelID"))
+        markupIDs = [landmarks.GetNthMarkupID(n) for n in range(landmarks.GetNumberOfMarkups())]
+        closestPointIndices = dict()
+        if onSurface:
+            hardenModel = self.getHardenModel(landmarks)
+            closestPointIndices = self.projectLandmarksOnSurface(
+                hardenModel, landmarks, markupIDs)
         landmarkDescription = dict()
-        for n in range(landmarks.GetNumberOfMarkups()):
-            markupID = landmarks.GetNthMarkupID(n)
-            landmarkDescription[markupID] = dict()
-            landmarkLabel = landmarks.GetNthMarkupLabel(n)
-            landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-            landmarkDescription[markupID]["ROIradius"] = 0
-            landmarkDescription[markupID]["projection"] = dict()
-            if onSurface:
-                landmarkDescription[markupID]["projection"]["isProjected"] = True
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                    landmarks.GetAttribute("hardenModelID"))
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, landmarks, markupID)
-            else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarkDescription[markupID]["midPoint"] = dict()
-            landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = []
-            landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-            landmarkDescription[markupID]["midPoint"]["Point1"] = None
-            landmarkDescription[markupID]["midPoint"]["Point2"] = None
+        for n, markupID in enumerate(markupIDs):
+            landmarkDescription[markupID] = self.newLandmarkState(
+                landmarks.GetNthMarkupLabel(n), onSurface, closestPointIndices.get(markupID))
         landmarks.SetAttribute("landmarkDescription",
                                self.encodeJSON(landmarkDescription))
         planeDescription = dict()
@@ -576,19 +1023,20 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
             "hardenModelID", model.GetAttribute("hardenModelID"))
         landmarkDescription = self.decodeJSON(
             landmarks.GetAttribute("landmarkDescription"))
-        for n in range(landmarks.GetNumberOfMarkups()):
-            markupID = landmarks.GetNthMarkupID(n)
-            if onSurface:
-                if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                        landmarks.GetAttribute("hardenModelID"))
-                    landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, landmarks, markupID)
-            else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarks.SetAttribute("landmarkDescription",
-                                   self.encodeJSON(landmarkDescription))
+        if onSurface:
+            projectedIDs = [markupID for markupID, landmarkState in landmarkDescription.items()
+                            if landmarkState["projection"]["isProjected"]]
+            hardenModel = self.getHardenModel(landmarks)
+            closestPointIndices = self.projectLandmarksOnSurface(
+                hardenModel, landmarks, projectedIDs)
+            for markupID, indexClosestPoint in closestPointIndices.items():
+                landmarkDescription[markupID]["projection"]["closestPointIndex"] = indexClosestPoint
+        else:
+            for landmarkState in landmarkDescription.values():
+                landmarkState["projection"]["isProjected"] = False
+                landmarkState["projection"]["closestPointIndex"] = None
+        landmarks.SetAttribute("landmarkDescription",
+                               self.encodeJSON(landmarkDescription))
         landmarks.SetAttribute("isClean", self.encodeJSON({"isClean": False}))
 
     def connectLandmarks(self, modelSelector, landmarkSelector, onSurface):
@@ -603,26 +1051,9 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
             landmarkSelector.setCurrentNode(None)
             return
         connectedModelID = landmarks.GetAttribute("connectedModelID")
-        try:
-            tag = self.decodeJSON(landmarks.GetAttribute("PointAddedEventTag"))
-            landmarks.RemoveObserver(tag["PointAddedEventTag"])
-            logging.debug("PointAddedEvent observers removed!")
-        except:
-            pass
-        try:
-            tag = self.decodeJSON(
-                landmarks.GetAttribute("PointModifiedEventTag"))
-            landmarks.RemoveObserver(tag["PointModifiedEventTag"])
-            logging.debug("PointModifiedEvent observers removed!")
-        except:
-            pass
-        try:
-            tag = self.decodeJSON(
-                landmarks.GetAttribute("PointRemovedEventTag"))
-            landmarks.RemoveObserver(tag["PointRemovedEventTag"])
-            logging.debug("PointRemovedEvent observers removed!")
-        except:
-            pass
+        # Only the selected fiducial list is observed
+        self.removeLandmarksObservers()
+        self.removeLegacyObserverTags(landmarks)
         if connectedModelID:
             if connectedModelID != model.GetID():
                 if self.connectedModelChangement():
@@ -640,46 +1071,128 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
         # update of the landmark Combo Box
         self.updateLandmarkComboBox(landmarks)
         # adding of listeners
-        PointAddedEventTag = landmarks.AddObserver(
-            landmarks.PointAddedEvent, self.onPointAddedEvent)
-        landmarks.SetAttribute("PointAddedEventTag", self.encodeJSON(
-            {"PointAddedEventTag": PointAddedEventTag}))
-        PointModifiedEventTag = landmarks.AddObserver(
-            landmarks.PointModifiedEvent, self.onPointModifiedEvent)
-        landmarks.SetAttribute("PointModifiedEventTag", self.encodeJSON(
-            {"PointModifiedEventTag": PointModifiedEventTag}))
-        PointRemovedEventTag = landmarks.AddObserver(
-            landmarks.PointRemovedEvent, self.onPointRemovedEvent)
-        landmarks.SetAttribute("PointRemovedEventTag", self.encodeJSON(
-            {"PointRemovedEventTag": PointRemovedEventTag}))
+        self.addObserver(landmarks, landmarks.PointAddedEvent, self.onPointAddedEvent)
+        self.addObserver(landmarks, landmarks.PointModifiedEvent, self.onPointModifiedEvent)
+        self.addObserver(landmarks, landmarks.PointRemovedEvent, self.onPointRemovedEvent)
+        self.observersChanged()
+
+    def removeLandmarksObservers(self):
+        self.removeObservers(self.onPointAddedEvent)
+        self.removeObservers(self.onPointModifiedEvent)
+        self.removeObservers(self.onPointRemovedEvent)
+        self.observersChanged()
+
+    def removeLegacyObserverTags(self, node):
+        for attributeName in self.LEGACY_OBSERVER_TAG_ATTRIBUTES:
+            if node.GetAttribute(attributeName) is not None:
+                node.RemoveAttribute(attributeName)
+
+    def numberOfObservers(self):
+        """Number of VTK observers currently installed by the logic"""
+        return len(self.Observations)
+
+    def observersChanged(self):
+        logging.debug("%d live observers", self.numberOfObservers())
+        if self.interface:
+            self.interface.updateObserversLabel(self.numberOfObservers())
+
+    def setLandmarkROIRadius(self, fidList, markupID, radius):
+        """Set the ROI radius of a landmark, projecting it on the surface if it
+        was not, and paint the ROIs again. Return True if the landmark was
+        projected."""
+        self.recordSessionEvent("radiusChanged", fidListID=fidList.GetID(),
+                                markupID=markupID, radius=radius)
+        landmarkDescription = self.decodeJSON(
+            fidList.GetAttribute("landmarkDescription"))
+        activeLandmarkState = landmarkDescription[markupID]
+        activeLandmarkState["ROIradius"] = radius
+        projected = not activeLandmarkState["projection"]["isProjected"]
+        if projected:
+            hardenModel = self.getHardenModel(fidList)
+            activeLandmarkState["projection"]["isProjected"] = True
+            activeLandmarkState["projection"]["closestPointIndex"] = \
+                self.projectOnSurface(hardenModel, fidList, markupID)
+        fidList.SetAttribute("landmarkDescription",
+                             self.encodeJSON(landmarkDescription))
+        self.findROI(fidList)
+        return projected
 
     # Called when a landmark is added on a model
     def onPointAddedEvent(self, obj, event):
         logging.debug("------markup adding-------")
-        landmarkDescription = self.decodeJSON(
-            obj.GetAttribute("landmarkDescription"))
-        numOfMarkups = obj.GetNumberOfMarkups()
-        # because every time a new node is added, its index is the last one on the list:
-        markupID = obj.GetNthMarkupID(numOfMarkups - 1)
-        landmarkDescription[markupID] = dict()
-        landmarkLabel = obj.GetNthMarkupLabel(numOfMarkups - 1)
-        landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-        landmarkDescription[markupID]["ROIradius"] = 0
-        landmarkDescription[markupID]["projection"] = dict()
-        landmarkDescription[markupID]["projection"]["isProjected"] = True
-        # The landmark will be projected by onPointModifiedEvent
-        landmarkDescription[markupID]["midPoint"] = dict()
-        landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-        landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-        landmarkDescription[markupID]["midPoint"]["Point1"] = None
-        landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        obj.SetAttribute("landmarkDescription",
-                         self.encodeJSON(landmarkDescription))
-        self.interface.landmarkComboBox.addItem(landmarkLabel)
-        self.interface.landmarkComboBox.setCurrentIndex(
-            self.interface.landmarkComboBox.count - 1)
+        # When a list is loaded or pasted, the points are added one after the
+        # other in the same event loop iteration: they are handled together
+        if self.bulkLandmarkImportDepth == 0 and not self.addedPointsProcessingScheduled:
+            self.addedPointsProcessingScheduled = True
+            qt.QTimer.singleShot(0, lambda: self.processAddedPoints(obj))
+
+    @contextlib.contextmanager
+    def bulkLandmarkImport(self, fidList):
+        """Suspend the handling of the landmarks added to (or moved in) the
+        fiducial list until the end of the block, where they are described,
+        projected and painted in one pass"""
+        self.bulkLandmarkImportDepth += 1
+        try:
+            yield
+        finally:
+            self.bulkLandmarkImportDepth -= 1
+            if self.bulkLandmarkImportDepth == 0:
+                self.processAddedPoints(fidList)
+
+    def importLandmarks(self, fidList, positions, labels=None):
+        """Add the landmarks at `positions` to the connected fiducial list,
+        return their IDs"""
+        markupIDs = list()
+        with self.bulkLandmarkImport(fidList):
+            for n, position in enumerate(positions):
+                label = labels[n] if labels else ""
+                markupIDs.append(fidList.GetNthMarkupID(fidList.AddFiducialFromArray(position, label)))
+        return markupIDs
+
+    def processAddedPoints(self, fidList):
+        self.addedPointsProcessingScheduled = False
+        newIDs = self.addLandmarksToDescription(fidList)
+        if not newIDs:
+            return
+        if self.sessionRecordFile:
+            indices = [fidList.GetNthControlPointIndexByID(markupID) for markupID in newIDs]
+            positions = list()
+            for index in indices:
+                coord = [-1, -1, -1]
+                fidList.GetNthFiducialPosition(index, coord)
+                positions.append(coord)
+            self.recordSessionEvent("pointsAdded", fidListID=fidList.GetID(), markupIDs=newIDs,
+                                    positions=positions,
+                                    labels=[fidList.GetNthMarkupLabel(index) for index in indices])
+        comboBox = self.interface.landmarkComboBox
+        comboBox.blockSignals(True)
+        self.addLandmarkComboBoxItems(
+            fidList, [fidList.GetNthControlPointIndexByID(markupID) for markupID in newIDs])
+        comboBox.setCurrentIndex(comboBox.count - 1)
+        comboBox.blockSignals(False)
         self.interface.UpdateInterface()
-        qt.QTimer.singleShot(0, lambda: self.onPointModifiedEvent(obj, None))
+        self.findROI(fidList)
+
+    def addLandmarksToDescription(self, fidList):
+        """Describe (and project on the surface) the landmarks of the list that
+        are not in its landmarkDescription yet, return their IDs"""
+        landmarkDescription = self.decodeJSON(
+            fidList.GetAttribute("landmarkDescription"))
+        if landmarkDescription is None:
+            return []
+        newIDs = [fidList.GetNthMarkupID(n) for n in range(fidList.GetNumberOfMarkups())
+                  if fidList.GetNthMarkupID(n) not in landmarkDescription]
+        if not newIDs:
+            return []
+        hardenModel = self.getHardenModel(fidList)
+        closestPointIndices = self.projectLandmarksOnSurface(hardenModel, fidList, newIDs)
+        for markupID in newIDs:
+            landmarkDescription[markupID] = self.newLandmarkState(
+                fidList.GetNthMarkupLabel(fidList.GetNthControlPointIndexByID(markupID)),
+                True, closestPointIndices[markupID])
+        fidList.SetAttribute("landmarkDescription",
+                             self.encodeJSON(landmarkDescription))
+        return newIDs
 
     def calculateMidPointCoord(self, fidList, landmark1ID, landmark2ID):
         """Set the midpoint when you know the the mrml nodes"""
@@ -707,80 +1220,127 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
                 index = fidList.GetNthControlPointIndexByID(midPointID)
                 fidList.SetNthFiducialPositionFromArray(index, coord)
                 if landmarkDescription[midPointID]["projection"]["isProjected"]:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                        fidList.GetAttribute("hardenModelID"))
+                    hardenModel = self.getHardenModel(fidList)
                     landmarkDescription[midPointID]["projection"]["closestPointIndex"] = \
                         self.projectOnSurface(hardenModel, fidList, landmarkID)
                     fidList.SetAttribute(
                         "landmarkDescription", self.encodeJSON(landmarkDescription))
                 self.updateMidPoint(fidList, midPointID)
 
-    # Called when a landmarks is moved
-    def onPointModifiedEvent(self, obj, event):
+    # Called when a landmarks is moved (or renamed)
+    @vtk.calldata_type(vtk.VTK_INT)
+    def onPointModifiedEvent(self, obj, event, markupsIndex=None):
         logging.debug("----onPointModifiedEvent PandP-----")
+        # The projection on the surface moves the landmark again
+        if self.handlingPointModifiedEvent or self.bulkLandmarkImportDepth:
+            return
         landmarkDescription = self.decodeJSON(
             obj.GetAttribute("landmarkDescription"))
         if not landmarkDescription:
             return
-        selectedLandmarkID = self.findIDFromLabel(
-            obj, self.interface.landmarkComboBox.currentText)
-        # remove observer to make sure, the callback function won't work..
-        tag = self.decodeJSON(obj.GetAttribute("PointModifiedEventTag"))
-        obj.RemoveObserver(tag["PointModifiedEventTag"])
+        # Points of a list being loaded or pasted are handled together by
+        # processAddedPoints, with a single findROI
+        if self.addedPointsProcessingScheduled:
+            return
+        if markupsIndex is not None and 0 <= markupsIndex < obj.GetNumberOfMarkups():
+            if obj.GetNthMarkupID(markupsIndex) not in landmarkDescription:
+                return
+            if self.sessionRecordFile:
+                coord = [-1, -1, -1]
+                obj.GetNthFiducialPosition(markupsIndex, coord)
+                self.recordSessionEvent("pointModified", fidListID=obj.GetID(),
+                                        markupID=obj.GetNthMarkupID(markupsIndex),
+                                        position=coord)
+            self.updateLandmarkLabel(obj, landmarkDescription, markupsIndex)
+        self.handlingPointModifiedEvent = True
+        try:
+            self.updateModifiedLandmark(obj, landmarkDescription)
+        finally:
+            self.handlingPointModifiedEvent = False
+
+    def updateModifiedLandmark(self, obj, landmarkDescription):
+        selectedLandmarkID = self.getSelectedLandmarkID()
         if selectedLandmarkID:
             activeLandmarkState = landmarkDescription[selectedLandmarkID]
             if activeLandmarkState["projection"]["isProjected"]:
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(
-                    obj.GetAttribute("hardenModelID"))
+                hardenModel = self.getHardenModel(obj)
                 activeLandmarkState["projection"]["closestPointIndex"] = \
                     self.projectOnSurface(hardenModel, obj, selectedLandmarkID)
                 obj.SetAttribute("landmarkDescription",
                                  self.encodeJSON(landmarkDescription))
             self.updateMidPoint(obj, selectedLandmarkID)
             self.findROI(obj)
-        time.sleep(0.08)
-        # Add the observer again
-        PointModifiedEventTag = obj.AddObserver(
-            obj.PointModifiedEvent, self.onPointModifiedEvent)
-        obj.SetAttribute("PointModifiedEventTag", self.encodeJSON(
-            {"PointModifiedEventTag": PointModifiedEventTag}))
+
+    def updateLandmarkLabel(self, fidList, landmarkDescription, markupsIndex):
+        markupID = fidList.GetNthMarkupID(markupsIndex)
+        markupLabel = fidList.GetNthMarkupLabel(markupsIndex)
+        if markupID not in landmarkDescription \
+                or landmarkDescription[markupID]["landmarkLabel"] == markupLabel:
+            return
+        landmarkDescription[markupID]["landmarkLabel"] = markupLabel
+        fidList.SetAttribute("landmarkDescription",
+                             self.encodeJSON(landmarkDescription))
+        self.renameLandmarkComboBoxItem(markupID, markupLabel)
 
     def onPointRemovedEvent(self, obj, event):
         logging.debug("------markup deleting-------")
         landmarkDescription = self.decodeJSON(
             obj.GetAttribute("landmarkDescription"))
-        IDs = []
-        for ID, value in landmarkDescription.items():
-            isFound = False
-            for n in range(obj.GetNumberOfMarkups()):
-                markupID = obj.GetNthMarkupID(n)
-                if ID == markupID:
-                    isFound = True
-            if not isFound:
-                logging.debug(ID)
-                IDs.append(ID)
+        remainingIDs = set(obj.GetNthMarkupID(n) for n in range(obj.GetNumberOfMarkups()))
+        IDs = [ID for ID in landmarkDescription if ID not in remainingIDs]
         for ID in IDs:
+            logging.debug(ID)
             landmarkDescription.pop(ID, None)
         obj.SetAttribute("landmarkDescription",
                          self.encodeJSON(landmarkDescription))
-        self.updateLandmarkComboBox(obj)
+        self.removeLandmarkComboBoxItems(IDs)
+
+    def clearLandmarkComboBox(self):
+        self.interface.landmarkComboBoxModel.clear()
+        self.landmarkComboBoxItems.clear()
 
     def updateLandmarkComboBox(self, fidList, displayMidPoint=True):
         if not fidList:
             return
+        self.interface.landmarkComboBox.blockSignals(True)
+        self.clearLandmarkComboBox()
+        self.addLandmarkComboBoxItems(fidList, range(fidList.GetNumberOfMarkups()))
+        self.interface.landmarkComboBox.blockSignals(False)
+
+    def addLandmarkComboBoxItems(self, fidList, markupsIndices):
+        """Append the landmarks (except the midpoints) to the landmark combo box"""
         landmarkDescription = self.decodeJSON(
             fidList.GetAttribute("landmarkDescription"))
+        for markupsIndex in markupsIndices:
+            markupID = fidList.GetNthMarkupID(markupsIndex)
+            if landmarkDescription[markupID]["midPoint"]["isMidPoint"]:
+                continue
+            item = qt.QStandardItem(fidList.GetNthMarkupLabel(markupsIndex))
+            item.setData(markupID, qt.Qt.UserRole)
+            self.interface.landmarkComboBoxModel.appendRow(item)
+            self.landmarkComboBoxItems[markupID] = item
+
+    def removeLandmarkComboBoxItems(self, markupIDs):
         self.interface.landmarkComboBox.blockSignals(True)
-        self.interface.landmarkComboBox.clear()
-        numOfFid = fidList.GetNumberOfMarkups()
-        if numOfFid > 0:
-            for i in range(numOfFid):
-                ID = fidList.GetNthMarkupID(i)
-                if not landmarkDescription[ID]["midPoint"]["isMidPoint"]:
-                    landmarkLabel = fidList.GetNthMarkupLabel(i)
-                    self.interface.landmarkComboBox.addItem(landmarkLabel)
+        for markupID in markupIDs:
+            item = self.landmarkComboBoxItems.pop(markupID, None)
+            if item is not None:
+                self.interface.landmarkComboBoxModel.removeRow(item.row())
         self.interface.landmarkComboBox.blockSignals(False)
 
+    def renameLandmarkComboBoxItem(self, markupID, landmarkLabel):
+        item = self.landmarkComboBoxItems.get(markupID)
+        if item is not None and item.text() != landmarkLabel:
+            item.setText(landmarkLabel)
+
+    def getSelectedLandmarkID(self):
+        """ID of the landmark selected in the landmark combo box (the text of
+        the combo box can be a label being typed)"""
+        comboBox = self.interface.landmarkComboBox
+        if comboBox.currentIndex < 0:
+            return None
+        return comboBox.itemData(comboBox.currentIndex, qt.Qt.UserRole) or None
+
     def findIDFromLabel(self, fidList, landmarkLabel):
         # find the ID of the markupsNode from the label of a landmark!
         landmarkDescription = self.decodeJSON(
@@ -794,13 +1354,24 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
         landmarkCoord = numpy.zeros(3)
         landmarkCoord[1] = 42
         fidNode.GetNthFiducialPosition(landmarkID, landmarkCoord)
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(inputPolyData)
-        pointLocator.AutomaticOn()
-        pointLocator.BuildLocator()
-        indexClosestPoint = pointLocator.FindClosestPoint(landmarkCoord)
+        indexClosestPoint = self.getPointLocator(inputPolyData).FindClosestPoint(landmarkCoord)
         return indexClosestPoint
 
+    def findClosestPointNear(self, inputPolyData, coord, searchRadius):
+        """Return the index of the closest vertex of `inputPolyData` to `coord`.
+
+        The search is first limited to `searchRadius` around `coord` and falls
+        back to a search over the whole mesh.
+        """
+        pointLocator = self.getPointLocator(inputPolyData)
+        if searchRadius:
+            dist2 = vtk.reference(0.0)
+            indexClosestPoint = pointLocator.FindClosestPointWithinRadius(
+                searchRadius, coord, dist2)
+            if indexClosestPoint >= 0:
+                return indexClosestPoint
+        return pointLocator.FindClosestPoint(coord)
+
     def replaceLandmark(self, inputModelPolyData, fidNode, landmarkID, indexClosestPoint):
         landmarkCoord = [-1, -1, -1]
         inputModelPolyData.GetPoints().GetPoint(indexClosestPoint, landmarkCoord)
@@ -816,6 +1387,28 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
                                  markupsIndex, indexClosestPoint)
             return indexClosestPoint
 
+    def projectLandmarksOnSurface(self, modelOnProject, fidNode, markupIDs):
+        """Move the landmarks `markupIDs` to their closest vertex of the model,
+        return the indices of these vertices by landmark ID"""
+        if not markupIDs:
+            return dict()
+        polyData = modelOnProject.GetPolyData()
+        markupsIndices = [fidNode.GetNthControlPointIndexByID(markupID) for markupID in markupIDs]
+        landmarkCoords = numpy.zeros((len(markupIDs), 3))
+        for i, markupsIndex in enumerate(markupsIndices):
+            fidNode.GetNthFiducialPosition(markupsIndex, landmarkCoords[i])
+        closestPointIndices = self.findClosestVertices(landmarkCoords, polyData)
+        # The landmarks are moved by the module itself
+        handlingPointModifiedEvent = self.handlingPointModifiedEvent
+        self.handlingPointModifiedEvent = True
+        try:
+            for markupsIndex, indexClosestPoint in zip(markupsIndices, closestPointIndices):
+                self.replaceLandmark(polyData, fidNode, markupsIndex, indexClosestPoint)
+        finally:
+            self.handlingPointModifiedEvent = handlingPointModifiedEvent
+        return {markupID: int(indexClosestPoint)
+                for markupID, indexClosestPoint in zip(markupIDs, closestPointIndices)}
+
     def defineNeighbor(self, connectedVerticesList, inputModelNodePolyData, indexClosestPoint, distance):
         self.GetConnectedVertices(
             connectedVerticesList, inputModelNodePolyData, indexClosestPoint)
@@ -841,117 +1434,1250 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
                 connectedVerticesIDList.InsertUniqueId(pointIdList.GetId(j))
         return connectedVerticesIDList
 
-    def addArrayFromIdList(self, connectedIdList, inputModelNode, arrayName):
+    def defineBallNeighbor(self, inputModelNodePolyData, indexClosestPoint, radius, connectedOnly=False):
+        """Return the IDs of all the vertices lying within `radius` (Euclidean
+        distance) of the vertex `indexClosestPoint`, as a numpy array.
+
+        If `connectedOnly` is True, only the vertices that can be reached from
+        `indexClosestPoint` without leaving the ball are kept, so that the ROI
+        does not jump across thin structures.
+        """
+        center = inputModelNodePolyData.GetPoint(indexClosestPoint)
+        idList = vtk.vtkIdList()
+        self.getPointLocator(inputModelNodePolyData).FindPointsWithinRadius(
+            radius, center, idList)
+        ballIDs = self.idListToArray(idList)
+        if connectedOnly and ballIDs.size:
+            insideBall = numpy.zeros(
+                inputModelNodePolyData.GetNumberOfPoints(), dtype=bool)
+            insideBall[ballIDs] = True
+            ballIDs = self.growRegion(
+                self.getVertexAdjacency(inputModelNodePolyData),
+                [indexClosestPoint], insideBall)
+        return ballIDs
+
+    def computeLandmarkROI(self, inputModelNodePolyData, indexClosestPoint, landmarkState,
+                           landmarkKey=None):
+        """Return the IDs of the vertices of the ROI of one landmark as a numpy array.
+
+        The rings of the landmark identified by `landmarkKey` are kept between
+        calls, see getRingLayers.
+        """
+        radius = landmarkState["ROIradius"]
+        if landmarkState.get("ROIType", self.ROI_TYPE_RINGS) == self.ROI_TYPE_BALL:
+            return self.defineBallNeighbor(inputModelNodePolyData,
+                                           indexClosestPoint,
+                                           radius,
+                                           landmarkState.get("ROIConnected", False))
+        # Same rings as defineNeighbor
+        return numpy.concatenate(self.getRingLayers(
+            inputModelNodePolyData, indexClosestPoint, max(1, int(radius)), landmarkKey))
+
+    def getRingLayers(self, polyData, seed, numberOfRings, landmarkKey=None):
+        """Return the rings of vertices around `seed` up to `numberOfRings`, as a
+        list of arrays of vertex IDs (the first one holds the seed).
+
+        If `landmarkKey` is given, the rings are kept for that landmark while its
+        seed and mesh do not change: a larger radius only grows the stored
+        frontier and a smaller one reuses the first rings.
+        """
+        version = self.meshVersion(polyData)
+        cached = self.ringLayerCache.get(landmarkKey)
+        if cached is not None and cached[0] is polyData and cached[1] == version \
+                and cached[2] == seed:
+            layers, isComplete = cached[3], cached[4]
+        else:
+            layers, isComplete = [numpy.array([seed], dtype=numpy.int64)], False
+        if len(layers) <= numberOfRings and not isComplete:
+            adjacency = self.getVertexAdjacency(polyData)
+            while len(layers) <= numberOfRings:
+                # The neighbors of a ring are in the previous, same or next ring
+                neighbors = numpy.unique(self.neighborsOf(adjacency, layers[-1]))
+                innerRings = layers[-2:]
+                ring = numpy.setdiff1d(neighbors, numpy.concatenate(innerRings), assume_unique=True)
+                if not ring.size:
+                    # The whole connected component is covered
+                    isComplete = True
+                    break
+                layers.append(ring)
+        if landmarkKey is not None:
+            self.ringLayerCache[landmarkKey] = (polyData, version, seed, layers, isComplete)
+        return layers[:numberOfRings + 1]
+
+    def computeROIWeights(self, polyData, seeds, ROIPointIDs, landmarkStates, landmarkKeys):
+        """Return, for each landmark, the weights of the vertices of its ROI
+        (aligned with `ROIPointIDs`), or None if its ROI is binary.
+
+        ROI_WEIGHTING_GAUSSIAN weights fall off with the ring distance to the
+        seed (the Euclidean distance for ball ROIs). ROI_WEIGHTING_HEAT weights
+        are a heat kernel: the seed is diffused over the ROI, with the random
+        walk Laplacian of the mesh, for all the landmarks at once. Both have a
+        width of half the radius and a weight of 1 at the seed.
+        """
+        ROIWeights = [None] * len(seeds)
+        heatLandmarks = list()
+        for i, landmarkState in enumerate(landmarkStates):
+            weighting = landmarkState.get("ROIWeighting", self.ROI_WEIGHTING_BINARY)
+            if weighting == self.ROI_WEIGHTING_GAUSSIAN:
+                distances = self.computeSeedDistances(
+                    polyData, seeds[i], ROIPointIDs[i], landmarkState, landmarkKeys[i])
+                sigma = max(landmarkState["ROIradius"], 1) / 2.0
+                ROIWeights[i] = numpy.exp(-0.5 * (distances / sigma) ** 2)
+            elif weighting == self.ROI_WEIGHTING_HEAT:
+                heatLandmarks.append(i)
+        if heatLandmarks:
+            heatWeights = self.diffuseHeat(
+                polyData, [seeds[i] for i in heatLandmarks],
+                [ROIPointIDs[i] for i in heatLandmarks],
+                [landmarkStates[i] for i in heatLandmarks])
+            for i, weights in zip(heatLandmarks, heatWeights):
+                ROIWeights[i] = weights
+        # Every vertex of the ROI keeps a (possibly tiny) weight
+        return [weights if weights is None else numpy.maximum(weights, self.ROI_MINIMUM_WEIGHT)
+                for weights in ROIWeights]
+
+    def computeSeedDistances(self, polyData, seed, ROIPointIDs, landmarkState, landmarkKey=None):
+        """Distance of the vertices of a ROI to its seed: number of rings for
+        ring ROIs, Euclidean distance for ball ROIs"""
+        from vtk.util import numpy_support
+        if landmarkState.get("ROIType", self.ROI_TYPE_RINGS) == self.ROI_TYPE_BALL:
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            return numpy.linalg.norm(points[ROIPointIDs] - points[seed], axis=1)
+        layers = self.getRingLayers(polyData, seed, max(1, int(landmarkState["ROIradius"])),
+                                    landmarkKey)
+        layerIDs = numpy.concatenate(layers)
+        layerDistances = numpy.repeat(numpy.arange(len(layers), dtype=numpy.float64),
+                                      [layer.size for layer in layers])
+        order = numpy.argsort(layerIDs)
+        return layerDistances[order][numpy.searchsorted(layerIDs[order], ROIPointIDs)]
+
+    def diffuseHeat(self, polyData, seeds, ROIPointIDs, landmarkStates):
+        """Diffuse a unit of heat from every seed over its ROI (zero outside of
+        it) and return the heat of the vertices of each ROI, scaled to 1 at the
+        maximum. The landmarks are the columns of one (vertices x landmarks)
+        matrix multiplied by the adjacency of the union of the ROIs."""
+        from vtk.util import numpy_support
+        vertices = numpy.unique(numpy.concatenate(ROIPointIDs))
+        adjacency = self.getVertexAdjacency(polyData)
+        # Adjacency restricted to the union of the ROIs, in CSR form
+        neighbors = self.neighborsOf(adjacency, vertices)
+        owners = numpy.repeat(numpy.arange(vertices.size), numpy.diff(adjacency[0])[vertices])
+        positions = numpy.minimum(numpy.searchsorted(vertices, neighbors), vertices.size - 1)
+        isInside = vertices[positions] == neighbors
+        localIndices = positions[isInside]
+        localIndptr = numpy.zeros(vertices.size + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(owners[isInside], minlength=vertices.size), out=localIndptr[1:])
+        degrees = numpy.maximum(numpy.diff(localIndptr), 1).astype(numpy.float64)[:, numpy.newaxis]
+        nonEmptyRows = numpy.flatnonzero(numpy.diff(localIndptr))
+
+        numberOfLandmarks = len(seeds)
+        inside = numpy.zeros((vertices.size, numberOfLandmarks))
+        heat = numpy.zeros((vertices.size, numberOfLandmarks))
+        numberOfSteps = numpy.zeros(numberOfLandmarks, dtype=numpy.int64)
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        for i, landmarkState in enumerate(landmarkStates):
+            inside[numpy.searchsorted(vertices, ROIPointIDs[i]), i] = 1.0
+            heat[numpy.searchsorted(vertices, seeds[i]), i] = 1.0
+            sigma = max(landmarkState["ROIradius"], 1) / 2.0
+            if landmarkState.get("ROIType", self.ROI_TYPE_RINGS) == self.ROI_TYPE_BALL:
+                # Width in rings: radius divided by the length of the edges of the seed
+                seedNeighbors = self.neighborsOf(adjacency, numpy.array([seeds[i]]))
+                if seedNeighbors.size:
+                    sigma /= numpy.linalg.norm(
+                        points[seedNeighbors] - points[seeds[i]], axis=1).mean()
+            # The variance of the lazy random walk grows by HEAT_DIFFUSION_STEP per step
+            numberOfSteps[i] = int(numpy.ceil(sigma ** 2 / self.HEAT_DIFFUSION_STEP))
+
+        for step in range(numberOfSteps.max()):
+            active = numberOfSteps > step
+            neighborHeat = numpy.zeros_like(heat)
+            if localIndices.size:
+                neighborHeat[nonEmptyRows] = numpy.add.reduceat(
+                    heat[localIndices], localIndptr[nonEmptyRows], axis=0)
+            heat[:, active] += self.HEAT_DIFFUSION_STEP * (
+                neighborHeat[:, active] / degrees - heat[:, active])
+            heat *= inside
+
+        ROIWeights = list()
+        for i in range(numberOfLandmarks):
+            weights = heat[numpy.searchsorted(vertices, ROIPointIDs[i]), i]
+            ROIWeights.append(weights / weights.max() if weights.max() > 0 else weights)
+        return ROIWeights
+
+    def averageNeighborValues(self, adjacency, values, vertices):
+        """Mean of the non zero values of the neighbors of each vertex"""
+        neighbors = self.neighborsOf(adjacency, vertices)
+        owners = numpy.repeat(numpy.arange(vertices.size), numpy.diff(adjacency[0])[vertices])
+        sums = numpy.bincount(owners, weights=values[neighbors], minlength=vertices.size)
+        counts = numpy.bincount(owners, weights=values[neighbors] > 0, minlength=vertices.size)
+        return numpy.where(counts > 0, sums / numpy.maximum(counts, 1), 1.0)
+
+    def computeNestedROIs(self, polyData, seeds, radii, ROIType=ROI_TYPE_RINGS):
+        """Compute the ROIs of every radius of `radii` around every vertex of
+        `seeds` without modifying the scene.
+
+        With ROI_TYPE_RINGS (radii are numbers of rings, as in defineNeighbor)
+        all the seeds are grown together in one breadth first traversal up to
+        the largest radius; with ROI_TYPE_BALL (radii are distances, as in
+        defineBallNeighbor) the vertices are found with one radius query per
+        seed. The smaller ROIs are prefixes of the larger ones. Return a
+        SparseROIMatrix whose row `i * len(radii) + j` is the ROI of
+        `seeds[i]` with radius `radii[j]`.
+        """
+        from vtk.util import numpy_support
+        seeds = numpy.asarray(seeds, dtype=numpy.int64)
+        radii = list(radii)
+        numberOfPoints = polyData.GetNumberOfPoints()
+        if ROIType == self.ROI_TYPE_BALL:
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            locator = self.getPointLocator(polyData)
+            seedOrder, vertices, distances = list(), list(), list()
+            for i, seed in enumerate(seeds):
+                idList = vtk.vtkIdList()
+                locator.FindPointsWithinRadius(max(radii), points[seed], idList)
+                ballIDs = self.idListToArray(idList)
+                seedOrder.append(numpy.full(ballIDs.size, i))
+                vertices.append(ballIDs)
+                distances.append(numpy.linalg.norm(points[ballIDs] - points[seed], axis=1))
+            radiiLimits = radii
+        else:
+            seedOrder, vertices, distances = self.computeRingDistances(
+                self.getVertexAdjacency(polyData), seeds,
+                max(max(1, int(radius)) for radius in radii))
+            seedOrder, vertices, distances = [seedOrder], [vertices], [distances]
+            radiiLimits = [max(1, int(radius)) for radius in radii]
+        seedOrder = numpy.concatenate(seedOrder)
+        vertices = numpy.concatenate(vertices)
+        distances = numpy.concatenate(distances)
+        # Sort by seed then distance so that each ROI is a prefix of the
+        # vertices of its seed
+        order = numpy.lexsort((distances, seedOrder))
+        seedOrder, vertices, distances = seedOrder[order], vertices[order], distances[order]
+        seedStarts = numpy.searchsorted(seedOrder, numpy.arange(seeds.size))
+        seedEnds = numpy.searchsorted(seedOrder, numpy.arange(seeds.size), side='right')
+
+        rows, rowKeys = list(), list()
+        for i, seed in enumerate(seeds):
+            seedDistances = distances[seedStarts[i]:seedEnds[i]]
+            for radius, radiusLimit in zip(radii, radiiLimits):
+                end = seedStarts[i]
+                if radius != 0:
+                    end += numpy.searchsorted(seedDistances, radiusLimit, side='right')
+                rows.append(numpy.sort(vertices[seedStarts[i]:end]))
+                rowKeys.append((int(seed), radius))
+        indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum([row.size for row in rows], out=indptr[1:])
+        indices = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=numpy.int64)
+        return SparseROIMatrix(indptr, indices, numberOfPoints, rowKeys)
+
+    def computeRingDistances(self, adjacency, seeds, maximumRing):
+        """Multi-source breadth first traversal: return the arrays (seed index,
+        vertex, ring) of every vertex within `maximumRing` rings of each seed"""
+        indptr = adjacency[0]
+        numberOfPoints = indptr.size - 1
+        frontierSeeds = numpy.arange(seeds.size, dtype=numpy.int64)
+        frontierVertices = seeds
+        # Visited (seed, vertex) pairs, encoded as seed * numberOfPoints + vertex
+        visited = numpy.unique(frontierSeeds * numberOfPoints + frontierVertices)
+        seedOrder, vertices, rings = [frontierSeeds], [frontierVertices], [numpy.zeros(seeds.size)]
+        for ring in range(1, maximumRing + 1):
+            neighbors = self.neighborsOf(adjacency, frontierVertices)
+            owners = numpy.repeat(frontierSeeds, numpy.diff(indptr)[frontierVertices])
+            keys = numpy.unique(owners * numberOfPoints + neighbors)
+            keys = keys[~numpy.isin(keys, visited, assume_unique=True)]
+            if not keys.size:
+                break
+            visited = numpy.union1d(visited, keys)
+            frontierSeeds, frontierVertices = numpy.divmod(keys, numberOfPoints)
+            seedOrder.append(frontierSeeds)
+            vertices.append(frontierVertices)
+            rings.append(numpy.full(keys.size, ring))
+        return numpy.concatenate(seedOrder), numpy.concatenate(vertices), numpy.concatenate(rings)
+
+    def growRegion(self, adjacency, seeds, allowedVertices):
+        """Breadth first traversal of the mesh from `seeds` restricted to the
+        vertices flagged in the boolean mask `allowedVertices`"""
+        seeds = numpy.asarray(seeds, dtype=numpy.int64)
+        visited = numpy.zeros(allowedVertices.shape[0], dtype=bool)
+        frontier = numpy.unique(seeds[allowedVertices[seeds]])
+        visited[frontier] = True
+        while frontier.size:
+            neighbors = self.neighborsOf(adjacency, frontier)
+            neighbors = neighbors[allowedVertices[neighbors] & ~visited[neighbors]]
+            frontier = numpy.unique(neighbors)
+            visited[frontier] = True
+        return numpy.flatnonzero(visited)
+
+    def neighborsOf(self, adjacency, vertices):
+        """Return the concatenated neighbors of `vertices` (with repetitions)"""
+        indptr, indices = adjacency
+        starts = indptr[vertices]
+        counts = indptr[vertices + 1] - starts
+        shifts = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+        return indices[shifts + numpy.arange(shifts.size)]
+
+    def idListToArray(self, idList):
+        numberOfIds = idList.GetNumberOfIds()
+        return numpy.fromiter((idList.GetId(i) for i in range(numberOfIds)),
+                              dtype=numpy.int64, count=numberOfIds)
+
+    def meshVersion(self, polyData):
+        """Key that changes when the points or the polygons of the mesh are
+        modified (but not when point data arrays such as ROIs are added)"""
+        points = polyData.GetPoints()
+        return (polyData.GetNumberOfPoints(),
+                points.GetMTime() if points else 0,
+                polyData.GetPolys().GetMTime())
+
+    def getCachedMeshData(self, polyData, kind, builder):
+        """Return the structure `kind` computed on `polyData` by `builder`.
+
+        The result is cached until the mesh is modified. If the structure is
+        being built by another thread (see prewarmModels), wait for it.
+        """
+        import concurrent.futures
+        key = (kind, id(polyData))
+        version = self.meshVersion(polyData)
+        with self.meshCacheLock:
+            cached = self.meshCache.get(key)
+            if cached is None or cached[0] is not polyData or cached[1] != version:
+                future = concurrent.futures.Future()
+                # A reference to polyData is kept so that its id can not be reused
+                self.meshCache[key] = (polyData, version, future)
+                cached = None
+        if cached is not None:
+            if not isinstance(cached[2], concurrent.futures.Future):
+                return cached[2]
+            try:
+                return cached[2].result()
+            except Exception:
+                # The build failed in the other thread, try again in this one
+                return self.getCachedMeshData(polyData, kind, builder)
+        try:
+            value = builder()
+        except BaseException as error:
+            with self.meshCacheLock:
+                if self.meshCache.get(key, (None, None, None))[2] is future:
+                    del self.meshCache[key]
+            future.set_exception(error)
+            raise
+        with self.meshCacheLock:
+            if self.meshCache.get(key, (None, None, None))[2] is future:
+                self.meshCache[key] = (polyData, version, value)
+        future.set_result(value)
+        return value
+
+    def releaseMeshCache(self, polyData=None):
+        """Drop the cached structures of `polyData` (of every mesh if None)"""
+        if polyData is None:
+            with self.meshCacheLock:
+                self.meshCache.clear()
+            self.ROIStatisticsCache.clear()
+            self.ringLayerCache.clear()
+            self.vertexPermutationCache.clear()
+            return
+        with self.meshCacheLock:
+            for cache in [self.meshCache, self.ringLayerCache]:
+                for key in [key for key, cached in list(cache.items()) if cached[0] is polyData]:
+                    del cache[key]
+        for key in [key for key, cached in self.vertexPermutationCache.items()
+                    if polyData is cached[0] or polyData is cached[1]]:
+            del self.vertexPermutationCache[key]
+
+    def schedulePrewarming(self, models):
+        """Prewarm the models once the current event is handled, so that
+        selecting them in the panel does not wait for their harden copies"""
+        modelIDs = [model.GetID() for model in models]
+        if modelIDs:
+            qt.QTimer.singleShot(0, lambda: self.prewarmModels(modelIDs))
+
+    def setPropagationTargets(self, models):
+        """Prewarm the models the ROIs will be propagated to, and keep their
+        harden copies in the pool until they are used or unchecked"""
+        self.propagationTargetIDs = {model.GetID() for model in models}
+        self.evictHardenModels()
+        self.schedulePrewarming(models)
+
+    def prewarmModels(self, modelIDs):
+        """Harden the models and build the search structures of their harden
+        copies (point locators and vertex adjacency) on a worker thread.
+
+        The worker only reads a snapshot of each mesh, taken on the main
+        thread, and applies the transform to a new vtkPolyData; only the
+        harden model nodes are created on the main thread, by
+        finishPrewarmedHardening. The search structures are put in the mesh
+        cache, under the harden copy, as futures that the interactive calls
+        wait for if they are not built yet. Models that already have an up to
+        date harden copy or that are being prewarmed are skipped.
+        """
+        import concurrent.futures
+        if self.prewarmExecutor is None:
+            self.prewarmExecutor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="PickAndPaintPrewarm")
+        for modelID in modelIDs:
+            model = slicer.mrmlScene.GetNodeByID(modelID)
+            if model is None or model.GetPolyData() is None \
+                    or modelID in self.prewarmedHardenings or self.hasFreshHardenModel(model):
+                continue
+            # The worker reads a snapshot of the mesh and of its transform
+            sourcePolyData = vtk.vtkPolyData()
+            sourcePolyData.ShallowCopy(model.GetPolyData())
+            future = self.prewarmExecutor.submit(
+                self.buildHardenPolyData, sourcePolyData, self.getTransformToWorld(model))
+            self.prewarmedHardenings[modelID] = (future, self.getHardenModelVersion(model))
+            self.prewarmFutures.append(future)
+        if self.interface:
+            self.interface.startSearchStructuresStatusPolling()
+
+    def getTransformToWorld(self, model):
+        """Copy of the transform from the model to the world, or None"""
+        transformNode = model.GetParentTransformNode()
+        if transformNode is None:
+            return None
+        if transformNode.IsTransformToWorldLinear():
+            matrix = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformToWorld(matrix)
+            transform = vtk.vtkTransform()
+            transform.SetMatrix(matrix)
+            return transform
+        transformToWorld = vtk.vtkGeneralTransform()
+        transformNode.GetTransformToWorld(transformToWorld)
+        transform = vtk.vtkGeneralTransform()
+        transform.DeepCopy(transformToWorld)
+        return transform
+
+    def buildHardenPolyData(self, polyData, transformToWorld):
+        """Copy of the mesh in world coordinates, with its search structures
+        (run by the prewarming thread)"""
+        if transformToWorld is None:
+            hardenPolyData = vtk.vtkPolyData()
+            hardenPolyData.DeepCopy(polyData)
+        else:
+            transformFilter = vtk.vtkTransformPolyDataFilter()
+            transformFilter.SetInputData(polyData)
+            transformFilter.SetTransform(transformToWorld)
+            transformFilter.Update()
+            hardenPolyData = transformFilter.GetOutput()
+        self.buildSearchStructures(hardenPolyData)
+        return hardenPolyData
+
+    def finishPrewarmedHardening(self, modelID, wait=True):
+        """Put in the scene the harden copy of the model made by the prewarming
+        thread. If it is not ready yet, wait for it (or, if `wait` is False,
+        leave it for later)."""
+        import concurrent.futures
+        pending = self.prewarmedHardenings.get(modelID)
+        if pending is None:
+            return
+        future, version = pending
+        if not wait and not future.done():
+            return
+        del self.prewarmedHardenings[modelID]
+        try:
+            hardenPolyData = future.result()
+        except concurrent.futures.CancelledError:
+            return
+        except Exception as error:
+            logging.warning("Prewarming of the harden copy failed: %s", error)
+            return
+        model = slicer.mrmlScene.GetNodeByID(modelID)
+        # The model or its transform changed since the copy was started
+        if model is None or version != self.getHardenModelVersion(model):
+            return
+        hardenModel = self.addHardenModelNode(model, hardenPolyData)
+        self.registerHardenModel(model, hardenModel, version)
+        self.setHardenModel(model, hardenModel)
+
+    def finishPrewarmedHardenings(self):
+        """Put in the scene the harden copies that are ready"""
+        for modelID in list(self.prewarmedHardenings):
+            self.finishPrewarmedHardening(modelID, wait=False)
+
+    def buildSearchStructures(self, polyData):
+        """Fill the mesh cache with the structures used when landmarks are placed"""
+        self.getPointLocator(polyData)
+        self.getVertexSearch(polyData)
+        self.getVertexAdjacency(polyData)
+
+    def getNumberOfPendingPrewarmings(self):
+        """Number of meshes whose search structures are still being built"""
+        for future in [future for future in self.prewarmFutures if future.done()]:
+            self.prewarmFutures.remove(future)
+            if not future.cancelled() and future.exception() is not None:
+                logging.warning("Prewarming of the search structures failed: %s", future.exception())
+        return len(self.prewarmFutures)
+
+    def cancelPrewarming(self):
+        """Cancel the builds that have not started yet, and drop the harden
+        copies that were not put in the scene"""
+        for future in self.prewarmFutures:
+            future.cancel()
+        self.prewarmFutures = [future for future in self.prewarmFutures if not future.cancelled()]
+        self.prewarmedHardenings.clear()
+
+    def shutdownPrewarming(self):
+        self.cancelPrewarming()
+        if self.prewarmExecutor is not None:
+            self.prewarmExecutor.shutdown(wait=False)
+            self.prewarmExecutor = None
+
+    def getPointLocator(self, polyData):
+        def buildLocator():
+            locator = vtk.vtkStaticPointLocator()
+            locator.SetDataSet(polyData)
+            locator.BuildLocator()
+            return locator
+        return self.getCachedMeshData(polyData, 'pointLocator', buildLocator)
+
+    def getPolygons(self, polyData):
+        """Return the polygons of the mesh as a list of (numberOfCells, cellSize)
+        arrays of point IDs, one per cell size"""
+        from vtk.util import numpy_support
+
+        def buildPolygons():
+            polys = polyData.GetPolys()
+            offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray()).astype(numpy.int64)
+            connectivity = numpy_support.vtk_to_numpy(
+                polys.GetConnectivityArray()).astype(numpy.int64)
+            sizes = numpy.diff(offsets)
+            polygons = list()
+            for size in numpy.unique(sizes):
+                starts = offsets[:-1][sizes == size]
+                polygons.append(connectivity[starts[:, None] + numpy.arange(size)])
+            return polygons
+        return self.getCachedMeshData(polyData, 'polygons', buildPolygons)
+
+    def getTriangles(self, polyData):
+        """Return the polygons of the mesh split in triangles, as a (n, 3) array"""
+        def buildTriangles():
+            triangles = [numpy.zeros((0, 3), dtype=numpy.int64)]
+            for cells in self.getPolygons(polyData):
+                for i in range(1, cells.shape[1] - 1):
+                    triangles.append(cells[:, [0, i, i + 1]])
+            return numpy.concatenate(triangles)
+        return self.getCachedMeshData(polyData, 'triangles', buildTriangles)
+
+    def getVertexAreasAndNormals(self, polyData):
+        """Return, for each vertex, a third of the area of its incident triangles
+        and the area-weighted sum of their normals"""
+        from vtk.util import numpy_support
+
+        def buildVertexAreasAndNormals():
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            triangles = self.getTriangles(polyData)
+            crossProducts = numpy.cross(points[triangles[:, 1]] - points[triangles[:, 0]],
+                                        points[triangles[:, 2]] - points[triangles[:, 0]])
+            triangleAreas = 0.5 * numpy.linalg.norm(crossProducts, axis=1)
+            numberOfPoints = polyData.GetNumberOfPoints()
+            vertexAreas = numpy.zeros(numberOfPoints)
+            vertexNormals = numpy.zeros((numberOfPoints, 3))
+            for corner in range(3):
+                numpy.add.at(vertexAreas, triangles[:, corner], triangleAreas / 3.0)
+                numpy.add.at(vertexNormals, triangles[:, corner], 0.5 * crossProducts)
+            return vertexAreas, vertexNormals
+        return self.getCachedMeshData(polyData, 'vertexAreasAndNormals',
+                                      buildVertexAreasAndNormals)
+
+    def getVertexAdjacency(self, polyData):
+        """Return the vertex adjacency of the mesh in CSR form (indptr, indices).
+
+        Like GetConnectedVertices, two vertices are neighbors if they belong to
+        the same cell.
+        """
+        def buildAdjacency():
+            numberOfPoints = polyData.GetNumberOfPoints()
+            keys = [numpy.zeros(0, dtype=numpy.int64)]
+            for cells in self.getPolygons(polyData):
+                for i in range(cells.shape[1]):
+                    for j in range(cells.shape[1]):
+                        if i != j:
+                            keys.append(cells[:, i] * numberOfPoints + cells[:, j])
+            keys = numpy.unique(numpy.concatenate(keys))
+            rows = keys // numberOfPoints
+            indptr = numpy.zeros(numberOfPoints + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(rows, minlength=numberOfPoints),
+                         out=indptr[1:])
+            return indptr, keys % numberOfPoints
+        return self.getCachedMeshData(polyData, 'vertexAdjacency', buildAdjacency)
+
+    def findClosestVertices(self, points, polyData):
+        """Return, for each row of the (n, 3) array `points`, the ID of the
+        closest vertex of `polyData`.
+
+        All the points are handled by a single vtkPointInterpolator run (nearest
+        neighbor kernel) using a search structure cached for `polyData`.
+        """
+        from vtk.util import numpy_support
+        points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1, 3)
+        if not points.shape[0]:
+            return numpy.zeros(0, dtype=numpy.int64)
+        source, locator = self.getVertexSearch(polyData)
+        queryPoints = vtk.vtkPoints()
+        queryPoints.SetData(numpy_support.numpy_to_vtk(points, deep=1))
+        query = vtk.vtkPolyData()
+        query.SetPoints(queryPoints)
+        interpolator = vtk.vtkPointInterpolator()
+        interpolator.SetInputData(query)
+        interpolator.SetSourceData(source)
+        interpolator.SetKernel(vtk.vtkVoronoiKernel())
+        interpolator.SetLocator(locator)
+        interpolator.Update()
+        vertexIDs = interpolator.GetOutput().GetPointData().GetArray('VertexID')
+        return numpy.rint(numpy_support.vtk_to_numpy(vertexIDs)).astype(numpy.int64)
+
+    def getVertexSearch(self, polyData):
+        """Return the search structure used by findClosestVertices: a shallow
+        copy of the mesh holding the IDs of its vertices, and its locator"""
+        from vtk.util import numpy_support
+
+        def buildVertexSearch():
+            # The locator is not rebuilt when arrays are added to polyData
+            source = vtk.vtkPolyData()
+            source.SetPoints(polyData.GetPoints())
+            vertexIDs = numpy_support.numpy_to_vtk(
+                numpy.arange(polyData.GetNumberOfPoints(), dtype=numpy.float64), deep=1)
+            vertexIDs.SetName('VertexID')
+            source.GetPointData().AddArray(vertexIDs)
+            locator = vtk.vtkStaticPointLocator()
+            locator.SetDataSet(source)
+            locator.BuildLocator()
+            return source, locator
+        return self.getCachedMeshData(polyData, 'vertexSearch', buildVertexSearch)
+
+    def countNeighborsInMask(self, adjacency, mask):
+        indptr, indices = adjacency
+        rows = numpy.repeat(numpy.arange(indptr.size - 1), numpy.diff(indptr))
+        return numpy.bincount(rows, weights=mask[indices], minlength=indptr.size - 1)
+
+    def closeMask(self, adjacency, mask, iterations=1):
+        """Morphological closing (dilation then erosion by `iterations` rings)
+        of a boolean vertex mask, used to fill small holes in an ROI"""
+        degree = numpy.diff(adjacency[0])
+        for i in range(iterations):
+            mask = mask | (self.countNeighborsInMask(adjacency, mask) > 0)
+        for i in range(iterations):
+            mask = mask & (self.countNeighborsInMask(adjacency, mask) == degree)
+        return mask
+
+    def addArrayFromIdList(self, connectedIdList, inputModelNode, arrayName, storeSparse=True,
+                           values=None):
+        """Add the ROI `arrayName` to the model: 1 (or the weights `values`) on the
+        vertices of `connectedIdList`, 0 elsewhere"""
+        from vtk.util import numpy_support
         if not inputModelNode:
             return
         inputModelNodePolydata = inputModelNode.GetPolyData()
         pointData = inputModelNodePolydata.GetPointData()
-        numberofIds = connectedIdList.GetNumberOfIds()
+        if isinstance(connectedIdList, vtk.vtkIdList):
+            connectedIdList = self.idListToArray(connectedIdList)
         hasArrayInt = pointData.HasArray(arrayName)
         if hasArrayInt == 1:  # ROI Array found
             pointData.RemoveArray(arrayName)
-        arrayToAdd = vtk.vtkDoubleArray()
+        connectedIdList = numpy.asarray(connectedIdList, dtype=numpy.int64)
+        isWeighted = values is not None and numpy.any(values != 1.0)
+        if not isWeighted:
+            values = None
+        arrayValues = numpy.zeros(inputModelNodePolydata.GetNumberOfPoints())
+        arrayValues[connectedIdList] = 1.0 if values is None else values
+        if storeSparse and self.keepsSparseROIs(inputModelNode):
+            self.storeSparseROI(inputModelNode, arrayName, connectedIdList, values)
+        arrayToAdd = numpy_support.numpy_to_vtk(arrayValues, deep=1, array_type=vtk.VTK_DOUBLE)
         arrayToAdd.SetName(arrayName)
-        for i in range(inputModelNodePolydata.GetNumberOfPoints()):
-            arrayToAdd.InsertNextValue(0.0)
-        for i in range(numberofIds):
-            arrayToAdd.SetValue(connectedIdList.GetId(i), 1.0)
         lut = vtk.vtkLookupTable()
-        tableSize = 2
+        # Weighted ROIs are displayed with a ramp from the model color to red
+        tableSize = 256 if isWeighted else 2
         lut.SetNumberOfTableValues(tableSize)
         lut.Build()
         displayNode = inputModelNode.GetDisplayNode()
         if displayNode:
             rgb = displayNode.GetColor()
-            lut.SetTableValue(0, rgb[0], rgb[1], rgb[2], 1)
         else:
-            lut.SetTableValue(0, 0.0, 1.0, 0.0, 1)
-        lut.SetTableValue(1, 1.0, 0.0, 0.0, 1)
+            rgb = (0.0, 1.0, 0.0)
+        for i in range(tableSize):
+            t = i / (tableSize - 1.0)
+            lut.SetTableValue(i, (1 - t) * rgb[0] + t, (1 - t) * rgb[1], (1 - t) * rgb[2], 1)
         arrayToAdd.SetLookupTable(lut)
         pointData.AddArray(arrayToAdd)
         inputModelNodePolydata.Modified()
         return True
 
-    def displayROI(self, inputModelNode, scalarName):
-        PolyData = inputModelNode.GetPolyData()
-        PolyData.Modified()
-        displayNode = inputModelNode.GetModelDisplayNode()
-        displayNode.SetScalarVisibility(False)
-        disabledModify = displayNode.StartModify()
-        displayNode.SetActiveScalarName(scalarName)
-        displayNode.SetScalarVisibility(True)
-        displayNode.EndModify(disabledModify)
+    def encodeSparseROI(self, connectedIdList, numberOfPoints, values=None):
+        """Encode the vertex IDs of an ROI as a delta-encoded, zlib-compressed
+        and base64-encoded string (and its weights, if any, as float32)"""
+        import zlib
+        IDs, firstIndices = numpy.unique(numpy.asarray(connectedIdList, dtype=numpy.int64),
+                                         return_index=True)
+        deltas = numpy.diff(IDs, prepend=0).astype('<u4')
+        encodedROI = {"numberOfPoints": int(numberOfPoints),
+                      "IDs": base64.b64encode(zlib.compress(deltas.tobytes())).decode('ascii')}
+        if values is not None and numpy.any(numpy.asarray(values) != 1.0):
+            weights = numpy.asarray(values, dtype='<f4')[firstIndices]
+            encodedROI["values"] = base64.b64encode(zlib.compress(weights.tobytes())).decode('ascii')
+        return encodedROI
 
-    def findROI(self, fidList):
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(
-            fidList.GetAttribute("hardenModelID"))
-        connectedModel = slicer.app.mrmlScene().GetNodeByID(
-            fidList.GetAttribute("connectedModelID"))
-        landmarkDescription = self.decodeJSON(
-            fidList.GetAttribute("landmarkDescription"))
-        arrayName = fidList.GetAttribute("arrayName")
-        arrayPartNames = set()
+    def decodeSparseROI(self, encodedROI):
+        import zlib
+        deltas = numpy.frombuffer(
+            zlib.decompress(base64.b64decode(encodedROI["IDs"])), dtype='<u4')
+        return numpy.cumsum(deltas, dtype=numpy.int64)
 
-        ROIPointListID = vtk.vtkIdList()
-        for key, activeLandmarkState in landmarkDescription.items():
-            currentROIPointListID = vtk.vtkIdList()
-            currentArrayPartName = self.ROI_ARRAY_NAME.format(
-                connectedModel.GetName(),
-                activeLandmarkState['landmarkLabel'],
-            )
-            if activeLandmarkState["ROIradius"] != 0:
-                self.defineNeighbor(currentROIPointListID,
-                                    hardenModel.GetPolyData(),
-                                    activeLandmarkState["projection"]["closestPointIndex"],
-                                    activeLandmarkState["ROIradius"])
-                self.addArrayFromIdList(currentROIPointListID,
-                                        connectedModel,
-                                        currentArrayPartName)
-                arrayPartNames.add(currentArrayPartName)
-            for j in range(currentROIPointListID.GetNumberOfIds()):
-                ROIPointListID.InsertUniqueId(currentROIPointListID.GetId(j))
+    def decodeSparseROIValues(self, encodedROI):
+        """Return the weights of a sparse ROI, or None if it is binary"""
+        import zlib
+        if "values" not in encodedROI:
+            return None
+        return numpy.frombuffer(
+            zlib.decompress(base64.b64decode(encodedROI["values"])), dtype='<f4').astype(numpy.float64)
 
-        fidList.SetAttribute("arrayPartNames", self.encodeJSON(list(arrayPartNames)))
+    def storeSparseROI(self, inputModelNode, arrayName, connectedIdList, values=None):
+        sparseROIs = self.decodeJSON(
+            inputModelNode.GetAttribute(self.SPARSE_ROI_ATTRIBUTE)) or dict()
+        sparseROIs[arrayName] = self.encodeSparseROI(
+            connectedIdList, inputModelNode.GetPolyData().GetNumberOfPoints(), values)
+        inputModelNode.SetAttribute(self.SPARSE_ROI_ATTRIBUTE, self.encodeJSON(sparseROIs))
 
-        listID = ROIPointListID
-        self.addArrayFromIdList(listID, connectedModel, arrayName)
-        self.displayROI(connectedModel, arrayName)
-        return ROIPointListID
+    def keepsSparseROIs(self, inputModelNode):
+        """Whether the sparse copy of the ROIs of the model must be updated with
+        its ROI arrays: sparse storage is on, or the model already has a copy
+        (which would be outdated otherwise)"""
+        return self.sparseROIStorage or bool(inputModelNode.GetAttribute(self.SPARSE_ROI_ATTRIBUTE))
 
-    def cleanerAndTriangleFilter(self, inputModel):
-        cleanerPolydata = vtk.vtkCleanPolyData()
-        cleanerPolydata.SetInputData(inputModel.GetPolyData())
-        cleanerPolydata.Update()
-        triangleFilter = vtk.vtkTriangleFilter()
+    def setSparseROIStorage(self, enabled):
+        """Turn the sparse storage of the ROIs on or off. When it is turned on,
+        the sparse copies are rebuilt from the ROI arrays of the models."""
+        self.sparseROIStorage = enabled
+        if not enabled:
+            return
+        models = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
+        for i in range(models.GetNumberOfItems()):
+            self.updateSparseROIs(models.GetItemAsObject(i))
+
+    def updateSparseROIs(self, inputModelNode):
+        """Store the sparse copy of every ROI array of the model"""
+        from vtk.util import numpy_support
+        if not inputModelNode.GetPolyData():
+            return
+        self.restoreSparseROIs(inputModelNode)
+        pointData = inputModelNode.GetPolyData().GetPointData()
+        for i in range(pointData.GetNumberOfArrays()):
+            arrayName = pointData.GetArrayName(i) or ""
+            if not arrayName.endswith("_ROI"):
+                continue
+            values = numpy_support.vtk_to_numpy(pointData.GetArray(i))
+            paintedIDs = numpy.flatnonzero(values)
+            self.storeSparseROI(inputModelNode, arrayName, paintedIDs, values[paintedIDs])
+
+    def matchesSparseROI(self, array, encodedROI):
+        """Whether the ROI array can be rebuilt from its sparse copy"""
+        from vtk.util import numpy_support
+        values = numpy_support.vtk_to_numpy(array)
+        if encodedROI["numberOfPoints"] != values.size:
+            return False
+        paintedIDs = numpy.flatnonzero(values)
+        if not numpy.array_equal(paintedIDs, self.decodeSparseROI(encodedROI)):
+            return False
+        sparseValues = self.decodeSparseROIValues(encodedROI)
+        if sparseValues is None:
+            return bool(numpy.all(values[paintedIDs] == 1.0))
+        return numpy.allclose(values[paintedIDs], sparseValues, rtol=1e-6, atol=1e-7)
+
+    def releaseDenseROIs(self, inputModelNode):
+        """Remove from the mesh the ROI arrays that have an up to date sparse copy"""
+        sparseROIs = self.decodeJSON(inputModelNode.GetAttribute(self.SPARSE_ROI_ATTRIBUTE))
+        if not sparseROIs or not inputModelNode.GetPolyData():
+            return
+        pointData = inputModelNode.GetPolyData().GetPointData()
+        for arrayName, encodedROI in sparseROIs.items():
+            array = pointData.GetArray(arrayName)
+            if array is None:
+                continue
+            if not self.matchesSparseROI(array, encodedROI):
+                logging.warning("The sparse copy of ROI %s of %s is outdated, the array is kept",
+                                arrayName, inputModelNode.GetName())
+                continue
+            pointData.RemoveArray(arrayName)
+        self.modelsWithReleasedROIs.add(inputModelNode.GetID())
+
+    def restoreSparseROIs(self, inputModelNode):
+        """Rebuild the dense ROI arrays of the model from their sparse copy"""
+        sparseROIs = self.decodeJSON(inputModelNode.GetAttribute(self.SPARSE_ROI_ATTRIBUTE))
+        if not sparseROIs or not inputModelNode.GetPolyData():
+            return
+        self.modelsWithReleasedROIs.discard(inputModelNode.GetID())
+        polyData = inputModelNode.GetPolyData()
+        for arrayName, encodedROI in sparseROIs.items():
+            if polyData.GetPointData().HasArray(arrayName):
+                continue
+            if encodedROI["numberOfPoints"] != polyData.GetNumberOfPoints():
+                logging.warning("ROI %s does not match the mesh of %s anymore",
+                                arrayName, inputModelNode.GetName())
+                continue
+            self.addArrayFromIdList(self.decodeSparseROI(encodedROI),
+                                    inputModelNode, arrayName, storeSparse=False,
+                                    values=self.decodeSparseROIValues(encodedROI))
+
+    def isModelDisplayed(self, inputModelNode):
+        displayNode = inputModelNode.GetDisplayNode()
+        return bool(displayNode and displayNode.GetVisibility())
+
+    def onStartSaveScene(self, caller, event):
+        if not self.sparseROIStorage:
+            return
+        models = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
+        for i in range(models.GetNumberOfItems()):
+            self.releaseDenseROIs(models.GetItemAsObject(i))
+
+    def onEndSaveScene(self, caller, event):
+        # Only the displayed models get their ROI arrays back, the other ones
+        # are rebuilt when they are used
+        for modelID in list(self.modelsWithReleasedROIs):
+            model = slicer.mrmlScene.GetNodeByID(modelID)
+            if model is None:
+                self.modelsWithReleasedROIs.discard(modelID)
+            elif self.isModelDisplayed(model):
+                self.restoreSparseROIs(model)
+
+    def onEndImportScene(self, caller, event):
+        models = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
+        for i in range(models.GetNumberOfItems()):
+            model = models.GetItemAsObject(i)
+            if not model.GetAttribute(self.SPARSE_ROI_ATTRIBUTE):
+                continue
+            if self.isModelDisplayed(model):
+                self.restoreSparseROIs(model)
+            else:
+                self.modelsWithReleasedROIs.add(model.GetID())
+
+    def displayROI(self, inputModelNode, scalarName):
+        self.restoreSparseROIs(inputModelNode)
+        PolyData = inputModelNode.GetPolyData()
+        PolyData.Modified()
+        displayNode = inputModelNode.GetModelDisplayNode()
+        displayNode.SetScalarVisibility(False)
+        disabledModify = displayNode.StartModify()
+        displayNode.SetActiveScalarName(scalarName)
+        displayNode.SetScalarVisibility(True)
+        displayNode.EndModify(disabledModify)
+
+    def findROI(self, fidList):
+        hardenModel = self.getHardenModel(fidList)
+        connectedModel = slicer.app.mrmlScene().GetNodeByID(
+            fidList.GetAttribute("connectedModelID"))
+        landmarkDescription = self.decodeJSON(
+            fidList.GetAttribute("landmarkDescription"))
+        arrayName = fidList.GetAttribute("arrayName")
+
+        landmarkROIs = list()
+        for key, activeLandmarkState in landmarkDescription.items():
+            currentArrayPartName = self.ROI_ARRAY_NAME.format(
+                connectedModel.GetName(),
+                activeLandmarkState['landmarkLabel'],
+            )
+            landmarkROIs.append((currentArrayPartName,
+                                 activeLandmarkState["projection"]["closestPointIndex"],
+                                 activeLandmarkState,
+                                 (fidList.GetID(), key)))
+        arrayPartNames = {landmarkROI[0] for landmarkROI in landmarkROIs
+                          if landmarkROI[2]["ROIradius"] != 0}
+        fidList.SetAttribute("arrayPartNames", self.encodeJSON(list(arrayPartNames)))
+        ROIPointListID = self.paintLandmarkROIs(connectedModel, hardenModel.GetPolyData(),
+                                                landmarkROIs, arrayName)
+        self.updateCombinedROIs(fidList, connectedModel)
+        return ROIPointListID
+
+    def paintLandmarkROIs(self, inputModel, polyData, landmarkROIs, arrayName):
+        """Compute on `polyData` the ROIs of the landmarks, given as (ROI array
+        name, closest point index, landmark state, landmark key) tuples, and
+        paint them and their union `arrayName` on the model. Return the IDs of
+        the vertices of the union."""
+        landmarkROIs = [landmarkROI for landmarkROI in landmarkROIs
+                        if landmarkROI[2]["ROIradius"] != 0]
+        ROIPointIDs = [self.computeLandmarkROI(polyData, indexClosestPoint, landmarkState, landmarkKey)
+                       for _, indexClosestPoint, landmarkState, landmarkKey in landmarkROIs]
+        ROIWeights = self.computeROIWeights(
+            polyData, [landmarkROI[1] for landmarkROI in landmarkROIs], ROIPointIDs,
+            [landmarkROI[2] for landmarkROI in landmarkROIs],
+            [landmarkROI[3] for landmarkROI in landmarkROIs])
+        ROIValues = numpy.zeros(polyData.GetNumberOfPoints())
+        for landmarkROI, currentROIPointIDs, weights in zip(landmarkROIs, ROIPointIDs, ROIWeights):
+            self.addArrayFromIdList(currentROIPointIDs, inputModel, landmarkROI[0], values=weights)
+            ROIValues[currentROIPointIDs] = numpy.maximum(
+                ROIValues[currentROIPointIDs], 1.0 if weights is None else weights)
+
+        ROIPointListID = numpy.flatnonzero(ROIValues)
+        self.addArrayFromIdList(ROIPointListID, inputModel, arrayName,
+                                values=ROIValues[ROIPointListID])
+        self.displayROI(inputModel, arrayName)
+        return ROIPointListID
+
+    def cleanerAndTriangleFilter(self, inputModel):
+        """Clean and triangulate the mesh of the model.
+
+        Return, for every point of the previous mesh, the ID of the point of the
+        cleaned mesh it became: the same point when it was kept, the closest
+        remaining vertex when it was merged or removed.
+        """
+        from vtk.util import numpy_support
+        polyData = inputModel.GetPolyData()
+        numberOfPoints = polyData.GetNumberOfPoints()
+        # Tag the points with their ID to recover the renumbering of the cleaner
+        taggedPolyData = vtk.vtkPolyData()
+        taggedPolyData.ShallowCopy(polyData)
+        originalPointIDs = numpy_support.numpy_to_vtk(
+            numpy.arange(numberOfPoints, dtype=numpy.int64), deep=1)
+        originalPointIDs.SetName(self.ORIGINAL_POINT_ID_ARRAY_NAME)
+        taggedPolyData.GetPointData().AddArray(originalPointIDs)
+        cleanerPolydata = vtk.vtkCleanPolyData()
+        cleanerPolydata.SetInputData(taggedPolyData)
+        cleanerPolydata.Update()
+        triangleFilter = vtk.vtkTriangleFilter()
         triangleFilter.SetInputData(cleanerPolydata.GetOutput())
         triangleFilter.Update()
-        inputModel.SetAndObservePolyData(triangleFilter.GetOutput())
+        cleanedPolyData = triangleFilter.GetOutput()
+        keptPointIDs = numpy_support.vtk_to_numpy(
+            cleanedPolyData.GetPointData().GetArray(self.ORIGINAL_POINT_ID_ARRAY_NAME)).copy()
+        cleanedPolyData.GetPointData().RemoveArray(self.ORIGINAL_POINT_ID_ARRAY_NAME)
+
+        pointIDMap = numpy.full(numberOfPoints, -1, dtype=numpy.int64)
+        pointIDMap[keptPointIDs] = numpy.arange(keptPointIDs.size)
+        mergedPointIDs = numpy.flatnonzero(pointIDMap < 0)
+        if mergedPointIDs.size:
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            pointIDMap[mergedPointIDs] = self.findClosestVertices(
+                points[mergedPointIDs], cleanedPolyData)
+        # Keep an already clean mesh, with its harden copy and search structures
+        if cleanedPolyData.GetNumberOfPoints() == numberOfPoints \
+                and cleanedPolyData.GetNumberOfCells() == polyData.GetNumberOfCells() \
+                and cleanedPolyData.GetPolys().GetNumberOfConnectivityIds() == \
+                polyData.GetPolys().GetNumberOfConnectivityIds() \
+                and self.isIdentityMap(pointIDMap):
+            return pointIDMap
+        self.releaseMeshCache(polyData)
+        inputModel.SetAndObservePolyData(cleanedPolyData)
+        return pointIDMap
+
+    def isIdentityMap(self, pointIDMap):
+        return numpy.array_equal(pointIDMap, numpy.arange(pointIDMap.size))
+
+    def remapLandmarks(self, fidList, pointIDMap):
+        """Renumber the closest point indices of all the landmarks of the list
+        after their mesh was cleaned"""
+        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        if not landmarkDescription or self.isIdentityMap(pointIDMap):
+            return
+        projections = [landmarkState["projection"] for landmarkState in landmarkDescription.values()
+                       if landmarkState["projection"]["closestPointIndex"] is not None]
+        indices = numpy.array([projection["closestPointIndex"] for projection in projections],
+                              dtype=numpy.int64)
+        valid = (indices >= 0) & (indices < pointIDMap.size)
+        indices[valid] = pointIDMap[indices[valid]]
+        for projection, index, isValid in zip(projections, indices.tolist(), valid):
+            if isValid:
+                projection["closestPointIndex"] = index
+        fidList.SetAttribute("landmarkDescription", self.encodeJSON(landmarkDescription))
+
+    def remapSparseROIs(self, inputModelNode, pointIDMap):
+        """Renumber the sparse copies of the ROIs of a model after its mesh was
+        cleaned (the dense ROI arrays follow the points through the cleaner)"""
+        sparseROIs = self.decodeJSON(inputModelNode.GetAttribute(self.SPARSE_ROI_ATTRIBUTE))
+        if not sparseROIs or self.isIdentityMap(pointIDMap):
+            return
+        numberOfPoints = inputModelNode.GetPolyData().GetNumberOfPoints()
+        for arrayName, encodedROI in sparseROIs.items():
+            if encodedROI["numberOfPoints"] != pointIDMap.size:
+                continue
+            sparseROIs[arrayName] = self.encodeSparseROI(
+                pointIDMap[self.decodeSparseROI(encodedROI)], numberOfPoints,
+                self.decodeSparseROIValues(encodedROI))
+        inputModelNode.SetAttribute(self.SPARSE_ROI_ATTRIBUTE, self.encodeJSON(sparseROIs))
+
+    def cleanModel(self, inputModel, fidList=None):
+        """Clean the mesh of the model and renumber the vertex IDs stored for
+        it (sparse ROIs and, if given, closest points of the landmarks)"""
+        pointIDMap = self.cleanerAndTriangleFilter(inputModel)
+        self.remapSparseROIs(inputModel, pointIDMap)
+        if fidList is not None:
+            self.remapLandmarks(fidList, pointIDMap)
+        return pointIDMap
 
     def cleanMesh(self, selectedLandmark):
         activeInput = self.selectedModel
         fidList = self.selectedFidList
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(
-            activeInput.GetAttribute("hardenModelID"))
+        hardenModel = self.getHardenModel(activeInput)
         if activeInput:
-            # Clean the mesh with vtkCleanPolyData cleaner and vtkTriangleFilter:
-            self.cleanerAndTriangleFilter(activeInput)
-            self.cleanerAndTriangleFilter(hardenModel)
-            # Define the new ROI:
-            selectedLandmarkID = self.findIDFromLabel(
-                fidList, selectedLandmark)
-            if selectedLandmarkID:
-                landmarkDescription = self.decodeJSON(
-                    fidList.GetAttribute("landmarkDescription"))
-                landmarkDescription[selectedLandmarkID]["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, fidList, selectedLandmarkID)
-                fidList.SetAttribute("landmarkDescription",
-                                     self.encodeJSON(landmarkDescription))
+            # Clean the mesh with vtkCleanPolyData cleaner and vtkTriangleFilter,
+            # the closest points of the landmarks are indices of the harden model:
+            self.cleanModel(activeInput)
+            self.cleanModel(hardenModel, fidList)
             fidList.SetAttribute("isClean", self.encodeJSON({"isClean": True}))
 
+    def getTopologyFingerprint(self, inputModel):
+        """Return the number of points of the model and a hash of its polygons.
+
+        The fingerprint is cached until the mesh is modified, and stored in the
+        'topologyFingerprint' attribute of the model.
+        """
+        from vtk.util import numpy_support
+        import hashlib
+        polyData = inputModel.GetPolyData()
+
+        def buildFingerprint():
+            polys = polyData.GetPolys()
+            digest = hashlib.sha1()
+            for array in [polys.GetOffsetsArray(), polys.GetConnectivityArray()]:
+                digest.update(numpy.ascontiguousarray(
+                    numpy_support.vtk_to_numpy(array), dtype='<i8').tobytes())
+            return "%d:%s" % (polyData.GetNumberOfPoints(), digest.hexdigest())
+
+        fingerprint = self.getCachedMeshData(polyData, 'topologyFingerprint', buildFingerprint)
+        if inputModel.GetAttribute("topologyFingerprint") != fingerprint:
+            inputModel.SetAttribute("topologyFingerprint", fingerprint)
+        return fingerprint
+
+    def getTopologyInvariant(self, inputModel):
+        """Return the numbers of points and triangles of the model and a hash
+        of its sorted vertex degrees: unlike the topology fingerprint, it does
+        not change when the vertices are renumbered"""
+        import hashlib
+        polyData = inputModel.GetPolyData()
+
+        def buildInvariant():
+            triangles = self.getTriangles(polyData)
+            degrees = numpy.sort(numpy.bincount(triangles.ravel(), minlength=polyData.GetNumberOfPoints()))
+            digest = hashlib.sha1(numpy.ascontiguousarray(degrees, dtype='<i8').tobytes())
+            return "%d:%d:%s" % (polyData.GetNumberOfPoints(), len(triangles), digest.hexdigest())
+
+        return self.getCachedMeshData(polyData, 'topologyInvariant', buildInvariant)
+
+    def detectTypeOfPropagation(self, referenceInputModel, propagatedInputModel):
+        """Correspondent if both models have the same topology, possibly with
+        their vertices renumbered. The vertex matching is only tried when the
+        topology invariants show that the meshes may differ only by order."""
+        if self.getTopologyFingerprint(referenceInputModel) == \
+                self.getTopologyFingerprint(propagatedInputModel):
+            return "correspondentShapes"
+        if self.getTopologyInvariant(referenceInputModel) == self.getTopologyInvariant(propagatedInputModel) \
+                and self.getVertexPermutation(referenceInputModel, propagatedInputModel) is not None:
+            return "correspondentShapes"
+        return "nonCorrespondentShapes"
+
+    def getVertexPermutation(self, referenceInputModel, propagatedInputModel):
+        """Return the vertex permutation between two correspondent models whose
+        vertices are in a different order (see computeVertexPermutation), or
+        None if they are not correspondent up to a permutation"""
+        return self.computeVertexPermutation(self.getGeometryPolyData(referenceInputModel),
+                                             self.getGeometryPolyData(propagatedInputModel))
+
+    def computeVertexPermutation(self, referencePolyData, targetPolyData):
+        """Match the vertices of two meshes that have the same triangles up to a
+        renumbering of their vertices.
+
+        Meshes with the same triangles are matched by the identity, meshes with
+        different vertex degrees are not matched. Otherwise the target is
+        aligned on the reference: centroids, sizes and a rotation, starting
+        from the identity and from the principal axes of both meshes, refined
+        by Procrustes steps on the closest vertices while they improve the
+        matching (see VERTEX_PERMUTATION_ALIGNMENT_ITERATIONS). For
+        each alignment, every vertex is matched to the closest vertex of the
+        reference with one batched query. The matching is kept if it is a
+        bijection that maps the triangles of the target onto the triangles of
+        the reference. Return the array `permutation` such that the vertex `i`
+        of the target is the vertex `permutation[i]` of the reference, or None.
+        The result is cached until one of the meshes is modified.
+        """
+        from vtk.util import numpy_support
+        key = (id(referencePolyData), id(targetPolyData))
+        versions = (self.meshVersion(referencePolyData), self.meshVersion(targetPolyData))
+        cached = self.vertexPermutationCache.get(key)
+        if cached is not None and cached[0] is referencePolyData \
+                and cached[1] is targetPolyData and cached[2] == versions:
+            return cached[3]
+
+        permutation, reason = None, None
+        referencePoints = numpy_support.vtk_to_numpy(referencePolyData.GetPoints().GetData())
+        targetPoints = numpy_support.vtk_to_numpy(targetPolyData.GetPoints().GetData())
+        referenceTriangles = self.getTriangles(referencePolyData)
+        targetTriangles = self.getTriangles(targetPolyData)
+        if referencePoints.shape != targetPoints.shape or not referencePoints.size:
+            reason = "different numbers of points (%d and %d)" % (len(referencePoints), len(targetPoints))
+        elif referenceTriangles.shape != targetTriangles.shape:
+            reason = "different numbers of triangles (%d and %d)" % (
+                len(referenceTriangles), len(targetTriangles))
+        elif numpy.array_equal(referenceTriangles, targetTriangles):
+            # Same vertex order
+            permutation = numpy.arange(len(targetPoints))
+        elif not numpy.array_equal(
+                numpy.sort(numpy.bincount(referenceTriangles.ravel(), minlength=len(referencePoints))),
+                numpy.sort(numpy.bincount(targetTriangles.ravel(), minlength=len(targetPoints)))):
+            reason = "different vertex degrees"
+        else:
+            referenceCentroid = referencePoints.mean(axis=0)
+            referenceCentered = referencePoints - referenceCentroid
+            targetCentered = targetPoints - targetPoints.mean(axis=0)
+            referenceSize = numpy.sqrt((referenceCentered ** 2).sum(axis=1).mean())
+            targetSize = numpy.sqrt((targetCentered ** 2).sum(axis=1).mean())
+            scale = referenceSize / targetSize if targetSize > 0 else 1.0
+            targetCentered = targetCentered * scale
+            for rotation in self.getPrincipalAxesRotations(referenceCentered, targetCentered):
+                previousNumberOfMatchedTwice = None
+                for iteration in range(self.VERTEX_PERMUTATION_ALIGNMENT_ITERATIONS):
+                    matches = self.findClosestVertices(
+                        targetCentered.dot(rotation.T) + referenceCentroid, referencePolyData)
+                    numberOfMatchedTwice = matches.size - numpy.unique(matches).size
+                    # Stop refining an alignment that does not improve
+                    if not numberOfMatchedTwice or (previousNumberOfMatchedTwice is not None
+                                                    and numberOfMatchedTwice >= previousNumberOfMatchedTwice):
+                        break
+                    previousNumberOfMatchedTwice = numberOfMatchedTwice
+                    rotation = self.computeProcrustesRotation(targetCentered, referenceCentered[matches])
+                if numberOfMatchedTwice:
+                    reason = "the closest vertices are not a permutation " \
+                             "(%d vertices matched twice after alignment)" % numberOfMatchedTwice
+                elif not self.haveSameTriangles(referenceTriangles, matches[targetTriangles]):
+                    reason = "the matched vertices do not have the same triangles"
+                else:
+                    permutation, reason = matches, None
+                    break
+        if reason:
+            logging.info("No vertex permutation between the meshes: %s", reason)
+        self.vertexPermutationCache[key] = (referencePolyData, targetPolyData, versions, permutation)
+        return permutation
+
+    def getPrincipalAxesRotations(self, referenceCentered, targetCentered):
+        """Rotations to try to align the centered target points on the centered
+        reference points: the identity, then the rotations mapping the
+        principal axes of the target on those of the reference (one per choice
+        of axis directions)"""
+        rotations = [numpy.identity(3)]
+        referenceAxes = numpy.linalg.eigh(referenceCentered.T.dot(referenceCentered))[1]
+        targetAxes = numpy.linalg.eigh(targetCentered.T.dot(targetCentered))[1]
+        for signs in [(1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1),
+                      (-1, -1, -1), (-1, 1, 1), (1, -1, 1), (1, 1, -1)]:
+            rotation = referenceAxes.dot(numpy.diag(signs)).dot(targetAxes.T)
+            if numpy.linalg.det(rotation) > 0:
+                rotations.append(rotation)
+        return rotations
+
+    def computeProcrustesRotation(self, points, targetPoints):
+        """Rotation that best maps the centered `points` on `targetPoints`
+        (Kabsch algorithm)"""
+        U, S, Vt = numpy.linalg.svd(points.T.dot(targetPoints - targetPoints.mean(axis=0)))
+        correction = numpy.diag([1.0, 1.0, numpy.sign(numpy.linalg.det(Vt.T.dot(U.T))) or 1.0])
+        return Vt.T.dot(correction).dot(U.T)
+
+    def haveSameTriangles(self, triangles, otherTriangles):
+        """Whether two (n, 3) arrays hold the same triangles, in any order and
+        with any rotation of their vertices"""
+        if triangles.shape != otherTriangles.shape:
+            return False
+        sortedTriangles = [numpy.sort(cells, axis=1) for cells in [triangles, otherTriangles]]
+        sortedTriangles = [cells[numpy.lexsort(cells.T[::-1])] for cells in sortedTriangles]
+        return numpy.array_equal(sortedTriangles[0], sortedTriangles[1])
+
+    def propagateFromReference(self, fidList, referenceInputModel, typeOfPropagation="automatic",
+                               transferROIShape=False, fillHoles=False, chained=False):
+        """Clean the reference model and propagate the ROIs of the fiducial list
+        to the models of its 'modelToPropList' attribute. Return one report
+        line per propagated model."""
+        decoded_json = self.decodeJSON(fidList.GetAttribute("modelToPropList"))
+        modelToPropagateList = []
+        if decoded_json is not None:
+            modelToPropagateList = decoded_json["modelToPropList"]
+        self.recordSessionEvent("propagate", fidListID=fidList.GetID(),
+                                modelID=referenceInputModel.GetID(),
+                                modelToPropList=modelToPropagateList,
+                                typeOfPropagation=typeOfPropagation,
+                                transferROIShape=transferROIShape,
+                                fillHoles=fillHoles, chained=chained)
+        self.cleanModel(referenceInputModel, fidList)
+        self.getFreshHardenModel(referenceInputModel)
+        modelsToPropagate = [slicer.mrmlScene.GetNodeByID(IDmodelToPropagate)
+                             for IDmodelToPropagate in modelToPropagateList]
+
+        try:
+            if chained:
+                return self.propagateChained(fidList, referenceInputModel, modelsToPropagate,
+                                             typeOfPropagation, transferROIShape, fillHoles)
+            report = list()
+            for modelToPropagate in modelsToPropagate:
+                try:
+                    self.prepareModelToPropagate(fidList, modelToPropagate)
+                    usedTypeOfPropagation = self.propagate(
+                        fidList, referenceInputModel, modelToPropagate, typeOfPropagation,
+                        transferROIShape, fillHoles)
+                except Exception as error:
+                    logging.exception("Propagation to %s failed", modelToPropagate.GetName())
+                    report.append("%s: failed (%s)" % (modelToPropagate.GetName(), error))
+                    continue
+                report.append(self.describePropagation(
+                    modelToPropagate, typeOfPropagation, usedTypeOfPropagation))
+            return report
+        finally:
+            # The prewarmed copies of the targets are used, they can be evicted
+            self.propagationTargetIDs.difference_update(modelToPropagateList)
+            self.evictHardenModels()
+
+    def propagate(self, fidList, referenceInputModel, propagatedInputModel,
+                  typeOfPropagation="automatic", transferROIShape=False, fillHoles=False):
+        """Propagate the ROIs of the fiducial list to a model, with the given type
+        of propagation or, if it is 'automatic', with the correspondent
+        propagation when both meshes have the same topology. A model that turns
+        out not to be correspondent gets the non correspondent propagation.
+        Return the type of propagation used."""
+        if typeOfPropagation == "automatic":
+            typeOfPropagation = self.detectTypeOfPropagation(
+                referenceInputModel, propagatedInputModel)
+        with self.usingHardenModels(referenceInputModel, propagatedInputModel):
+            if typeOfPropagation == "correspondentShapes" and \
+                    not self.propagateCorrespondent(fidList, referenceInputModel, propagatedInputModel):
+                typeOfPropagation = "nonCorrespondentShapes"
+            if typeOfPropagation == "nonCorrespondentShapes":
+                if transferROIShape:
+                    self.propagateNonCorrespondentTransfer(
+                        fidList, referenceInputModel, propagatedInputModel, fillHoles)
+                else:
+                    self.propagateNonCorrespondent(fidList, propagatedInputModel)
+        self.updateCombinedROIs(fidList, propagatedInputModel)
+        logging.info("Propagation to %s: %s", propagatedInputModel.GetName(), typeOfPropagation)
+        fidList.SetAttribute("typeOfPropagation", typeOfPropagation)
+        propagatedInputModel.SetAttribute("typeOfPropagation", typeOfPropagation)
+        return typeOfPropagation
+
+    def describePropagation(self, propagatedInputModel, typeOfPropagation, usedTypeOfPropagation):
+        """Report line of a propagation, telling when a model asked to be
+        propagated as correspondent was not"""
+        description = "%s: %s" % (propagatedInputModel.GetName(),
+                                  self.PROPAGATION_DESCRIPTIONS[usedTypeOfPropagation])
+        if typeOfPropagation == "correspondentShapes" and usedTypeOfPropagation != typeOfPropagation:
+            description += " (not correspondent)"
+        return description
+
     def propagateCorrespondent(self, fidList, referenceInputModel, propagatedInputModel):
+        """Copy the ROI arrays of the reference model to a model with the same
+        triangles (possibly with its vertices in another order). Return False,
+        without copying anything, if the meshes are not correspondent."""
+        from vtk.util import numpy_support
+        if referenceInputModel.GetPolyData().GetNumberOfPoints() != \
+                propagatedInputModel.GetPolyData().GetNumberOfPoints():
+            logging.warning("%s and %s do not have the same number of points, "
+                            "they are not correspondent meshes",
+                            referenceInputModel.GetName(), propagatedInputModel.GetName())
+            return False
+        # Meshes with the same triangles but another vertex order
+        permutation = None
+        if self.getTopologyFingerprint(referenceInputModel) != \
+                self.getTopologyFingerprint(propagatedInputModel):
+            permutation = self.getVertexPermutation(referenceInputModel, propagatedInputModel)
+            if permutation is None:
+                logging.warning("%s and %s do not have the same triangles, "
+                                "they are not correspondent meshes",
+                                referenceInputModel.GetName(), propagatedInputModel.GetName())
+                return False
+            logging.info("Vertices of %s are permuted", propagatedInputModel.GetName())
         arrayName = fidList.GetAttribute("arrayName")
         arrayPartNames = self.decodeJSON(fidList.GetAttribute("arrayPartNames"))
 
+        self.restoreSparseROIs(referenceInputModel)
         referencePointData = referenceInputModel.GetPolyData().GetPointData()
         propagatedPointData = propagatedInputModel.GetPolyData().GetPointData()
 
@@ -960,46 +2686,872 @@ class PickAndPaintLogic(ScriptedLoadableModuleLogic):
             if arrayToPropagate:
                 if propagatedPointData.GetArray(name):  # Array already exists
                     propagatedPointData.RemoveArray(name)
+                if permutation is not None:
+                    permutedArray = numpy_support.numpy_to_vtk(
+                        numpy_support.vtk_to_numpy(arrayToPropagate)[permutation],
+                        deep=1, array_type=vtk.VTK_DOUBLE)
+                    permutedArray.SetName(name)
+                    permutedArray.SetLookupTable(arrayToPropagate.GetLookupTable())
+                    arrayToPropagate = permutedArray
                 propagatedPointData.AddArray(arrayToPropagate)
+                if self.keepsSparseROIs(propagatedInputModel):
+                    values = numpy_support.vtk_to_numpy(arrayToPropagate)
+                    paintedIDs = numpy.flatnonzero(values)
+                    self.storeSparseROI(propagatedInputModel, name, paintedIDs, values[paintedIDs])
                 self.displayROI(propagatedInputModel, name)
             else:
                 logging.warning(" NO ROI ARRAY %s FOUND. PLEASE DEFINE ONE BEFORE.", name)
                 continue
+        return True
+
+    def prepareModelToPropagate(self, fidList, modelToPropagate):
+        isClean = self.decodeJSON(fidList.GetAttribute("isClean"))
+        if isClean and isClean["isClean"]:
+            return
+        self.cleanModel(modelToPropagate)
+        self.getFreshHardenModel(modelToPropagate)
+
+    def propagationChainKey(self, fidList, typeOfPropagation, transferROIShape, fillHoles):
+        """Hash of the reference model, landmarks, ROI definitions and options
+        of the propagation: a chain of propagations is only extended while it
+        does not change"""
+        import hashlib
+        positions = list()
+        for n in range(fidList.GetNumberOfMarkups()):
+            coord = [-1, -1, -1]
+            fidList.GetNthFiducialPosition(n, coord)
+            positions.append(coord)
+        description = [fidList.GetAttribute("connectedModelID"),
+                       fidList.GetAttribute("landmarkDescription"),
+                       fidList.GetAttribute("arrayPartNames"),
+                       positions, typeOfPropagation, transferROIShape, fillHoles]
+        return hashlib.sha1(json.dumps(description).encode('utf-8')).hexdigest()
+
+    def propagateChained(self, fidList, referenceInputModel, modelsToPropagate,
+                         typeOfPropagation="nonCorrespondentShapes", transferROIShape=False,
+                         fillHoles=False):
+        """Propagate the ROIs along a series of time points (T0 -> T1 -> ... -> Tn).
+
+        Each time point receives the ROIs of the previous one: copied if both
+        meshes are correspondent, otherwise grown from the landmark positions
+        projected on the previous time point (or, if `transferROIShape` is
+        True, transferred from the ROIs painted on it). The chain is stored on
+        the fiducial list, so appending a time point to an already propagated
+        series only propagates to the new time point. A time point whose mesh
+        was modified or whose ROI arrays were removed is propagated again, with
+        the following ones. Return one report line per time point.
+        """
+        chainKey = self.propagationChainKey(fidList, typeOfPropagation, transferROIShape, fillHoles)
+        chain = self.decodeJSON(fidList.GetAttribute("propagationChain"))
+        if not chain or chain["key"] != chainKey:
+            chain = {"key": chainKey, "steps": []}
+        # Reuse the steps already computed for the beginning of the series
+        steps = list()
+        for step, modelToPropagate in zip(chain["steps"], modelsToPropagate):
+            if not self.isPropagationStepValid(step, modelToPropagate):
+                break
+            steps.append(step)
+        logging.debug("Chained propagation: %d time points already propagated", len(steps))
+        report = ["%s: %s (already propagated)" % (
+            modelToPropagate.GetName(), self.PROPAGATION_DESCRIPTIONS[step["typeOfPropagation"]])
+            for step, modelToPropagate in zip(steps, modelsToPropagate)]
+
+        previousModel = referenceInputModel
+        seedPoints = None
+        if steps:
+            previousModel = slicer.mrmlScene.GetNodeByID(steps[-1]["modelID"])
+            seedPoints = steps[-1]["seedPoints"]
+        for modelToPropagate in modelsToPropagate[len(steps):]:
+            try:
+                self.prepareModelToPropagate(fidList, modelToPropagate)
+                usedTypeOfPropagation, seedPoints = self.propagateChainStep(
+                    fidList, previousModel, modelToPropagate, typeOfPropagation,
+                    transferROIShape, fillHoles, seedPoints)
+            except Exception as error:
+                # The following time points are propagated from this one
+                logging.exception("Chained propagation to %s failed", modelToPropagate.GetName())
+                report.append("%s: failed (%s)" % (modelToPropagate.GetName(), error))
+                break
+            pointData = modelToPropagate.GetPolyData().GetPointData()
+            steps.append({"modelID": modelToPropagate.GetID(),
+                          "meshVersion": list(self.meshVersion(modelToPropagate.GetPolyData())),
+                          "arrayNames": [name for name in self.getPropagatedArrayNames(fidList)
+                                         if pointData.HasArray(name)],
+                          "typeOfPropagation": usedTypeOfPropagation,
+                          "seedPoints": seedPoints})
+            report.append("%s (chained from %s)" % (
+                self.describePropagation(modelToPropagate, typeOfPropagation, usedTypeOfPropagation),
+                previousModel.GetName()))
+            previousModel = modelToPropagate
+        chain["steps"] = steps
+        fidList.SetAttribute("propagationChain", self.encodeJSON(chain))
+        return report
 
-    def propagateNonCorrespondent(self, fidList, modelToPropagate):
+    def propagateChainStep(self, fidList, previousModel, modelToPropagate, typeOfPropagation,
+                           transferROIShape, fillHoles, seedPoints):
+        """Propagate the ROIs of the previous time point of a chain to the next
+        one, see propagateChained. Return the type of propagation used and the
+        positions the ROIs were grown from."""
+        if typeOfPropagation == "automatic":
+            typeOfPropagation = self.detectTypeOfPropagation(previousModel, modelToPropagate)
+        with self.usingHardenModels(previousModel, modelToPropagate):
+            if typeOfPropagation == "correspondentShapes":
+                if self.propagateCorrespondent(fidList, previousModel, modelToPropagate):
+                    seedPoints = self.getCorrespondentSeedPoints(
+                        fidList, previousModel, modelToPropagate, seedPoints, self.CHAINED_SEARCH_RADIUS)
+                else:
+                    typeOfPropagation = "nonCorrespondentShapes"
+            if typeOfPropagation == "nonCorrespondentShapes":
+                if transferROIShape:
+                    self.propagateNonCorrespondentTransfer(
+                        fidList, previousModel, modelToPropagate, fillHoles)
+                else:
+                    seedPoints = self.propagateNonCorrespondent(
+                        fidList, modelToPropagate, seedPoints, self.CHAINED_SEARCH_RADIUS)
+        self.updateCombinedROIs(fidList, modelToPropagate)
+        logging.info("Chained propagation from %s to %s: %s", previousModel.GetName(),
+                     modelToPropagate.GetName(), typeOfPropagation)
+        fidList.SetAttribute("typeOfPropagation", typeOfPropagation)
+        modelToPropagate.SetAttribute("typeOfPropagation", typeOfPropagation)
+        return typeOfPropagation, seedPoints
+
+    def getPropagatedArrayNames(self, fidList):
+        """Names of the ROI arrays the propagation of the fiducial list writes"""
+        return [fidList.GetAttribute("arrayName"),
+                *(self.decodeJSON(fidList.GetAttribute("arrayPartNames")) or [])]
+
+    def isPropagationStepValid(self, step, modelToPropagate):
+        """Whether a step of a propagation chain can be reused: same model,
+        mesh not modified since, and ROI arrays still on it"""
+        if step["modelID"] != modelToPropagate.GetID() \
+                or step["meshVersion"] != list(self.meshVersion(modelToPropagate.GetPolyData())):
+            return False
+        self.restoreSparseROIs(modelToPropagate)
+        pointData = modelToPropagate.GetPolyData().GetPointData()
+        return bool(step["arrayNames"]) and all(pointData.HasArray(name) for name in step["arrayNames"])
+
+    def getCorrespondentSeedPoints(self, fidList, previousModel, propagatedModel, seedPoints=None,
+                                   searchRadius=None):
+        """Positions, on a model correspondent to the previous time point, of
+        the vertices the ROIs of the previous time point were grown from (see
+        propagateNonCorrespondent)"""
+        inversePermutation = None
+        if self.getTopologyFingerprint(previousModel) != self.getTopologyFingerprint(propagatedModel):
+            permutation = self.getVertexPermutation(previousModel, propagatedModel)
+            if permutation is not None:
+                inversePermutation = numpy.argsort(permutation)
+        previousPolyData = self.getHardenModel(previousModel).GetPolyData()
+        propagatedPolyData = self.getHardenModel(propagatedModel).GetPolyData()
+        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        projectedPoints = dict()
+        for key in landmarkDescription:
+            if seedPoints and key in seedPoints:
+                indexClosestPoint = self.findClosestPointNear(previousPolyData, seedPoints[key], searchRadius)
+            else:
+                indexClosestPoint = self.getClosestPointIndex(
+                    fidList, previousModel.GetPolyData(), fidList.GetNthControlPointIndexByID(key))
+            if inversePermutation is not None:
+                indexClosestPoint = int(inversePermutation[indexClosestPoint])
+            projectedPoints[key] = list(propagatedPolyData.GetPoint(indexClosestPoint))
+        return projectedPoints
+
+    def propagateNonCorrespondent(self, fidList, modelToPropagate, seedPoints=None, searchRadius=None):
+        """Grow the ROIs of the landmarks on a non correspondent model.
+
+        By default the ROIs are grown from the vertices of the model closest to
+        the landmarks. `seedPoints` can give, for each landmark ID, the position
+        to start from instead (the search of the closest vertex is then first
+        limited to `searchRadius` around it). Return the positions of the
+        vertices the ROIs were grown from, by landmark ID.
+        """
         logging.debug(modelToPropagate.GetAttribute("hardenModelID"))
         connectedModel = slicer.app.mrmlScene().GetNodeByID(
-            fidList.GetAttribute("connectedModel"))
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(
-            modelToPropagate.GetAttribute("hardenModelID"))
+            fidList.GetAttribute("connectedModelID"))
+        hardenModel = self.getHardenModel(modelToPropagate)
         landmarkDescription = self.decodeJSON(
             fidList.GetAttribute("landmarkDescription"))
         arrayName = fidList.GetAttribute("arrayName")
 
-        ROIPointListID = vtk.vtkIdList()
+        projectedPoints = dict()
+        landmarkROIs = list()
         for key, activeLandmarkState in landmarkDescription.items():
-            currentROIPointListID = vtk.vtkIdList()
             currentArrayPartName = self.ROI_ARRAY_NAME.format(
                 connectedModel.GetName(), activeLandmarkState['landmarkLabel']
             )
             markupsIndex = fidList.GetNthControlPointIndexByID(key)
-            indexClosestPoint = self.getClosestPointIndex(
-                fidList, modelToPropagate.GetPolyData(), markupsIndex
-            )
-            if activeLandmarkState["ROIradius"] != 0:
-                self.defineNeighbor(
-                    currentROIPointListID,
-                    hardenModel.GetPolyData(),
-                    indexClosestPoint,
-                    activeLandmarkState["ROIradius"]
+            if seedPoints and key in seedPoints:
+                indexClosestPoint = self.findClosestPointNear(
+                    hardenModel.GetPolyData(), seedPoints[key], searchRadius)
+            else:
+                indexClosestPoint = self.getClosestPointIndex(
+                    fidList, modelToPropagate.GetPolyData(), markupsIndex
                 )
-                self.addArrayFromIdList(currentROIPointListID, modelToPropagate, currentArrayPartName)
-            for j in range(currentROIPointListID.GetNumberOfIds()):
-                ROIPointListID.InsertUniqueId(currentROIPointListID.GetId(j))
+            projectedPoints[key] = list(hardenModel.GetPolyData().GetPoint(indexClosestPoint))
+            landmarkROIs.append((currentArrayPartName, indexClosestPoint, activeLandmarkState, None))
+
+        self.paintLandmarkROIs(modelToPropagate, hardenModel.GetPolyData(), landmarkROIs, arrayName)
+        return projectedPoints
+
+    def propagateNonCorrespondentTransfer(self, fidList, referenceInputModel, propagatedInputModel,
+                                          fillHoles=False):
+        """Transfer the painted ROIs of the reference model to a non correspondent
+        model: every vertex of the target takes the values of the closest vertex
+        of the reference (one batched query), so the shape of the ROIs is
+        preserved without holes even if the target is denser."""
+        from vtk.util import numpy_support
+        arrayName = fidList.GetAttribute("arrayName")
+        arrayPartNames = self.decodeJSON(fidList.GetAttribute("arrayPartNames")) or []
+        referenceHardenModel = self.getHardenModel(referenceInputModel)
+        propagatedHardenModel = self.getHardenModel(propagatedInputModel)
+        self.restoreSparseROIs(referenceInputModel)
+        referencePointData = referenceInputModel.GetPolyData().GetPointData()
+        propagatedPolyData = propagatedHardenModel.GetPolyData()
+
+        ROIValues = dict()
+        for name in [arrayName, *arrayPartNames]:
+            arrayToPropagate = referencePointData.GetArray(name)
+            if arrayToPropagate:
+                ROIValues[name] = numpy_support.vtk_to_numpy(arrayToPropagate)
+            else:
+                logging.warning(" NO ROI ARRAY %s FOUND. PLEASE DEFINE ONE BEFORE.", name)
+        if not ROIValues:
+            return
+
+        propagatedPoints = numpy_support.vtk_to_numpy(propagatedPolyData.GetPoints().GetData())
+        sourceIDs = self.findClosestVertices(propagatedPoints, referenceHardenModel.GetPolyData())
+
+        for name, values in ROIValues.items():
+            transferredValues = numpy.asarray(values, dtype=numpy.float64)[sourceIDs]
+            mask = transferredValues > 0
+            if fillHoles:
+                adjacency = self.getVertexAdjacency(propagatedPolyData)
+                filledMask = self.closeMask(adjacency, mask)
+                filledIDs = numpy.flatnonzero(filledMask & ~mask)
+                transferredValues[filledIDs] = self.averageNeighborValues(
+                    adjacency, transferredValues, filledIDs)
+                mask = filledMask
+            transferredIDsOfROI = numpy.flatnonzero(mask)
+            self.addArrayFromIdList(transferredIDsOfROI, propagatedInputModel, name,
+                                    values=transferredValues[transferredIDsOfROI])
+        self.displayROI(propagatedInputModel, arrayName)
+
+    def getGeometryPolyData(self, inputModel):
+        """Mesh of the model in world coordinates (its harden copy if it has one)"""
+        hardenModel = None
+        if inputModel.GetAttribute("hardenModelID"):
+            hardenModel = self.getHardenModel(inputModel)
+        if hardenModel and hardenModel.GetPolyData() \
+                and hardenModel.GetPolyData().GetNumberOfPoints() == inputModel.GetPolyData().GetNumberOfPoints():
+            return hardenModel.GetPolyData()
+        return inputModel.GetPolyData()
+
+    def computeROIStatistics(self, inputModel, arrayNames):
+        """Return, for each ROI array of the model, its number of vertices, area,
+        centroid, mean normal and extent (size of its bounding box).
+
+        The uncached ROIs of the model are processed together as a (ROIs x
+        vertices) mask; the results are cached until the mesh or the ROI changes.
+        """
+        from vtk.util import numpy_support
+        polyData = self.getGeometryPolyData(inputModel)
+        pointData = inputModel.GetPolyData().GetPointData()
+        statistics = dict()
+        namesToCompute = list()
+        versions = dict()
+        for arrayName in arrayNames:
+            array = pointData.GetArray(arrayName)
+            if array is None:
+                continue
+            versions[arrayName] = (id(polyData), self.meshVersion(polyData), array.GetMTime())
+            cached = self.ROIStatisticsCache.get((inputModel.GetID(), arrayName))
+            if cached is not None and cached[0] == versions[arrayName]:
+                statistics[arrayName] = cached[1]
+            else:
+                namesToCompute.append(arrayName)
+        if not namesToCompute:
+            return statistics
+
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        vertexAreas, vertexNormals = self.getVertexAreasAndNormals(polyData)
+        masks = numpy.stack([numpy_support.vtk_to_numpy(pointData.GetArray(arrayName)) > 0
+                             for arrayName in namesToCompute])
+        numberOfVertices = masks.sum(axis=1)
+        areas = masks @ vertexAreas
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            centroids = (masks @ (vertexAreas[:, None] * points)) / areas[:, None]
+            normals = masks @ vertexNormals
+            normals /= numpy.linalg.norm(normals, axis=1)[:, None]
+        for i, arrayName in enumerate(namesToCompute):
+            ROIPoints = points[masks[i]]
+            extent = ROIPoints.max(axis=0) - ROIPoints.min(axis=0) if ROIPoints.size else numpy.zeros(3)
+            statistics[arrayName] = {
+                "numberOfVertices": int(numberOfVertices[i]),
+                "area": float(areas[i]),
+                "centroid": centroids[i].tolist(),
+                "meanNormal": normals[i].tolist(),
+                "extent": extent.tolist(),
+            }
+            self.ROIStatisticsCache[(inputModel.GetID(), arrayName)] = \
+                (versions[arrayName], statistics[arrayName])
+        return statistics
+
+    def getROIModels(self, fidList):
+        """Return the model the fiducial list is connected to and the models its
+        ROIs were propagated to"""
+        models = [slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID"))]
+        modelToPropList = self.decodeJSON(fidList.GetAttribute("modelToPropList"))
+        if modelToPropList:
+            models += [slicer.mrmlScene.GetNodeByID(modelID)
+                       for modelID in modelToPropList["modelToPropList"]]
+        return [model for model in models if model is not None]
+
+    def getROIArrayLabels(self, fidList):
+        """Map the names of the ROI arrays of the fiducial list to the labels of
+        the landmarks they belong to ('All' for the union of the ROIs)"""
+        connectedModel = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID"))
+        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription")) or dict()
+        arrayLabels = {fidList.GetAttribute("arrayName"): "All"}
+        for landmarkState in landmarkDescription.values():
+            arrayName = self.ROI_ARRAY_NAME.format(connectedModel.GetName(),
+                                                   landmarkState["landmarkLabel"])
+            arrayLabels[arrayName] = landmarkState["landmarkLabel"]
+        return arrayLabels
+
+    def getConnectedFiducialLists(self, inputModel):
+        list_ = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
+        return [list_.GetItemAsObject(i) for i in range(list_.GetNumberOfItems())
+                if list_.GetItemAsObject(i).GetAttribute("connectedModelID") == inputModel.GetID()]
+
+    def getROIMask(self, inputModel, arrayName):
+        """Return the ROI `arrayName` of the model as a boolean mask over its
+        vertices, or None if the model has no such ROI"""
+        from vtk.util import numpy_support
+        polyData = inputModel.GetPolyData()
+        array = polyData.GetPointData().GetArray(arrayName)
+        if array is not None:
+            return numpy_support.vtk_to_numpy(array) != 0
+        sparseROIs = self.decodeJSON(inputModel.GetAttribute(self.SPARSE_ROI_ATTRIBUTE)) or dict()
+        encodedROI = sparseROIs.get(arrayName)
+        if encodedROI is None or encodedROI["numberOfPoints"] != polyData.GetNumberOfPoints():
+            return None
+        mask = numpy.zeros(polyData.GetNumberOfPoints(), dtype=bool)
+        mask[self.decodeSparseROI(encodedROI)] = True
+        return mask
+
+    def getROIMasks(self, fidList, inputModel=None):
+        """Return the masks of the ROIs of the fiducial list on a model (by default
+        the model it is connected to), by landmark label ('All' for the union)"""
+        if inputModel is None:
+            inputModel = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID"))
+        masks = dict()
+        for arrayName, label in self.getROIArrayLabels(fidList).items():
+            mask = self.getROIMask(inputModel, arrayName)
+            if mask is not None:
+                masks[label] = mask
+        return masks
+
+    def combineROIMasks(self, operation, masks):
+        """Combine ROI masks with the 'union', 'intersection' or 'difference'
+        (first mask minus the other ones) operation"""
+        masks = list(masks)
+        result = masks[0].copy()
+        if operation == "union":
+            for mask in masks[1:]:
+                numpy.logical_or(result, mask, out=result)
+        elif operation == "intersection":
+            for mask in masks[1:]:
+                numpy.logical_and(result, mask, out=result)
+        elif operation == "difference":
+            for mask in masks[1:]:
+                result &= ~mask
+        else:
+            raise ValueError("Unknown ROI operation: %s" % operation)
+        return result
+
+    def combineROIs(self, fidList, operation, labels):
+        """Add to the model connected to the fiducial list the union,
+        intersection or difference (see combineROIMasks) of the ROIs of the
+        landmarks `labels`, and return the name of the ROI array.
+
+        The combination is stored on the fiducial list: the ROI is computed
+        again when the ROIs of the landmarks are painted or propagated.
+        """
+        if operation not in self.ROI_OPERATIONS:
+            raise ValueError("Unknown ROI operation: %s" % operation)
+        connectedModel = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID"))
+        masks = self.getROIMasks(fidList, connectedModel)
+        missingLabels = [label for label in labels if label not in masks]
+        if missingLabels:
+            raise ValueError("No ROI for the landmarks %s" % ", ".join(missingLabels))
+        arrayName = self.ROI_ARRAY_NAME.format(connectedModel.GetName(), "_".join([operation, *labels]))
+        combinedROIs = self.decodeJSON(fidList.GetAttribute(self.COMBINED_ROI_ATTRIBUTE)) or dict()
+        combinedROIs[arrayName] = {"operation": operation, "labels": list(labels)}
+        fidList.SetAttribute(self.COMBINED_ROI_ATTRIBUTE, self.encodeJSON(combinedROIs))
+        self.addArrayFromMask(self.combineROIMasks(operation, [masks[label] for label in labels]),
+                              connectedModel, arrayName)
+        return arrayName
+
+    def updateCombinedROIs(self, fidList, inputModel):
+        """Compute again on a model the ROIs combined by combineROIs"""
+        combinedROIs = self.decodeJSON(fidList.GetAttribute(self.COMBINED_ROI_ATTRIBUTE))
+        if not combinedROIs:
+            return
+        masks = self.getROIMasks(fidList, inputModel)
+        for arrayName, combination in combinedROIs.items():
+            missingLabels = [label for label in combination["labels"] if label not in masks]
+            if missingLabels:
+                logging.warning("ROI %s of %s not updated: no ROI for the landmarks %s", arrayName,
+                                inputModel.GetName(), ", ".join(missingLabels))
+                continue
+            mask = self.combineROIMasks(combination["operation"],
+                                        [masks[label] for label in combination["labels"]])
+            self.addArrayFromIdList(numpy.flatnonzero(mask), inputModel, arrayName)
+
+    def addArrayFromMask(self, mask, inputModelNode, arrayName):
+        """Add a ROI mask (e.g. computed by combineROIMasks) to the model and display it"""
+        self.addArrayFromIdList(numpy.flatnonzero(mask), inputModelNode, arrayName)
+        self.displayROI(inputModelNode, arrayName)
+
+    def countBits(self, packedBits):
+        """Number of bits set in a bitset packed with numpy.packbits"""
+        if hasattr(numpy, "bitwise_count"):
+            return int(numpy.bitwise_count(packedBits).sum(dtype=numpy.int64))
+        popcountTable = numpy.unpackbits(
+            numpy.arange(256, dtype=numpy.uint8)[:, numpy.newaxis], axis=1).sum(axis=1)
+        return int(popcountTable[packedBits].sum(dtype=numpy.int64))
+
+    def computeROIOverlaps(self, masks):
+        """Return the overlap of every pair of ROIs of `masks` (label -> mask): the
+        number of vertices of each ROI, of their intersection and union, the
+        fraction of each ROI covered by the other one and the Jaccard index"""
+        labels = list(masks)
+        bitsets = [numpy.packbits(masks[label]) for label in labels]
+        sizes = [self.countBits(bitset) for bitset in bitsets]
+        overlaps = list()
+        for i in range(len(labels)):
+            for j in range(i + 1, len(labels)):
+                intersection = self.countBits(numpy.bitwise_and(bitsets[i], bitsets[j]))
+                union = sizes[i] + sizes[j] - intersection
+                overlaps.append({
+                    "ROIs": (labels[i], labels[j]),
+                    "sizes": (sizes[i], sizes[j]),
+                    "intersection": intersection,
+                    "union": union,
+                    "fractions": (intersection / sizes[i] if sizes[i] else 0.0,
+                                  intersection / sizes[j] if sizes[j] else 0.0),
+                    "jaccard": intersection / union if union else 0.0,
+                })
+        return overlaps
+
+    def computeSignedDistances(self, polyData, mask, targetPolyData):
+        """Return the distance of every vertex of `mask` to the closest point of
+        the surface `targetPolyData`, signed along the normal of the closest
+        cell: positive outside of it (0 outside of `mask`). All the vertices are
+        handled by one batched evaluation of a distance function cached for
+        `targetPolyData`."""
+        from vtk.util import numpy_support
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        vertexIDs = numpy.flatnonzero(mask)
+        distances = numpy.zeros(polyData.GetNumberOfPoints())
+        if not vertexIDs.size:
+            return distances
+        queryPoints = numpy_support.numpy_to_vtk(
+            numpy.ascontiguousarray(points[vertexIDs], dtype=numpy.float64), deep=1)
+        signedDistances = vtk.vtkDoubleArray()
+        self.getSurfaceDistance(targetPolyData).FunctionValue(queryPoints, signedDistances)
+        distances[vertexIDs] = numpy_support.vtk_to_numpy(signedDistances)
+        return distances
 
-        listID = ROIPointListID
-        self.addArrayFromIdList(listID, modelToPropagate, arrayName)
-        self.displayROI(modelToPropagate, arrayName)
+    def getSurfaceDistance(self, polyData):
+        """Return the signed distance function of the surface (its cell locator
+        is built once)"""
+        def buildSurfaceDistance():
+            surfaceDistance = vtk.vtkImplicitPolyDataDistance()
+            surfaceDistance.SetInput(polyData)
+            return surfaceDistance
+        return self.getCachedMeshData(polyData, 'surfaceDistance', buildSurfaceDistance)
+
+    def computeDirectedHausdorffDistance(self, points, targetPoints):
+        """Largest distance from the (n, 3) array `points` to the closest of the
+        points `targetPoints` (nan if one of them is empty)"""
+        from vtk.util import numpy_support
+        if not len(points) or not len(targetPoints):
+            return float("nan")
+        targetPoints = numpy.ascontiguousarray(targetPoints, dtype=numpy.float64)
+        targetPolyData = vtk.vtkPolyData()
+        targetPolyData.SetPoints(vtk.vtkPoints())
+        targetPolyData.GetPoints().SetData(numpy_support.numpy_to_vtk(targetPoints, deep=1))
+        try:
+            closestPoints = targetPoints[self.findClosestVertices(points, targetPolyData)]
+        finally:
+            self.releaseMeshCache(targetPolyData)
+        return float(numpy.linalg.norm(points - closestPoints, axis=1).max())
+
+    def addDistanceArray(self, inputModel, arrayName, distances):
+        from vtk.util import numpy_support
+        pointData = inputModel.GetPolyData().GetPointData()
+        if pointData.HasArray(arrayName):
+            pointData.RemoveArray(arrayName)
+        array = numpy_support.numpy_to_vtk(distances, deep=1, array_type=vtk.VTK_DOUBLE)
+        array.SetName(arrayName)
+        pointData.AddArray(array)
+
+    def computeROIDistances(self, fidList, referenceInputModel, propagatedInputModel):
+        """Compare the ROIs of the fiducial list on the reference model and on a
+        model they were propagated to.
+
+        The vertices of the ROIs of each model are matched to the closest point
+        of the surface of the other one, with signed distances (positive outside
+        of it). They are added to both models as point arrays. Return, by ROI
+        array name, the mean signed, mean and max distances from the reference
+        ROI to the propagated surface, their percentiles and the Hausdorff
+        distance between the vertices of the reference ROI and those of the
+        propagated ROI.
+        """
+        from vtk.util import numpy_support
+        names = list()
+        referenceMasks, propagatedMasks = dict(), dict()
+        for arrayName in self.getROIArrayLabels(fidList):
+            referenceMask = self.getROIMask(referenceInputModel, arrayName)
+            propagatedMask = self.getROIMask(propagatedInputModel, arrayName)
+            if referenceMask is not None and propagatedMask is not None:
+                names.append(arrayName)
+                referenceMasks[arrayName] = referenceMask
+                propagatedMasks[arrayName] = propagatedMask
+        if not names:
+            return dict()
+        referencePolyData = self.getGeometryPolyData(referenceInputModel)
+        propagatedPolyData = self.getGeometryPolyData(propagatedInputModel)
+        distances = self.computeSignedDistances(
+            referencePolyData, self.combineROIMasks("union", referenceMasks.values()),
+            propagatedPolyData)
+        reverseDistances = self.computeSignedDistances(
+            propagatedPolyData, self.combineROIMasks("union", propagatedMasks.values()),
+            referencePolyData)
+        self.addDistanceArray(referenceInputModel, self.ROI_DISTANCE_ARRAY_NAME.format(
+            fidList.GetName(), propagatedInputModel.GetName()), distances)
+        self.addDistanceArray(propagatedInputModel, self.ROI_DISTANCE_ARRAY_NAME.format(
+            fidList.GetName(), referenceInputModel.GetName()), reverseDistances)
+
+        referencePoints = numpy_support.vtk_to_numpy(referencePolyData.GetPoints().GetData())
+        propagatedPoints = numpy_support.vtk_to_numpy(propagatedPolyData.GetPoints().GetData())
+        statistics = dict()
+        for arrayName in names:
+            ROIDistances = distances[referenceMasks[arrayName]]
+            absoluteDistances = numpy.abs(ROIDistances)
+            if not ROIDistances.size:
+                continue
+            referenceROIPoints = referencePoints[referenceMasks[arrayName]]
+            propagatedROIPoints = propagatedPoints[propagatedMasks[arrayName]]
+            statistics[arrayName] = {
+                "numberOfVertices": int(ROIDistances.size),
+                "meanSignedDistance": float(ROIDistances.mean()),
+                "meanDistance": float(absoluteDistances.mean()),
+                "maxDistance": float(absoluteDistances.max()),
+                "percentiles": numpy.percentile(
+                    absoluteDistances, self.ROI_DISTANCE_PERCENTILES).tolist(),
+                "hausdorffDistance": max(
+                    self.computeDirectedHausdorffDistance(referenceROIPoints, propagatedROIPoints),
+                    self.computeDirectedHausdorffDistance(propagatedROIPoints, referenceROIPoints)),
+            }
+        return statistics
+
+    def exportROIDistances(self, fidList):
+        """Compare the ROIs of the fiducial list on the reference model with every
+        model they were propagated to and export the distances in the table
+        '<fiducial list>_ROIDistances'"""
+        arrayLabels = self.getROIArrayLabels(fidList)
+        models = self.getROIModels(fidList)
+        rows = list()
+        for model in models[1:]:
+            for arrayName, ROIStatistics in self.computeROIDistances(fidList, models[0], model).items():
+                rows.append((model.GetName(), arrayLabels[arrayName], ROIStatistics))
+        columns = [("Model", [row[0] for row in rows]),
+                   ("Landmark", [row[1] for row in rows]),
+                   ("Number of vertices", [row[2]["numberOfVertices"] for row in rows]),
+                   ("Mean signed distance", [row[2]["meanSignedDistance"] for row in rows]),
+                   ("Mean distance", [row[2]["meanDistance"] for row in rows]),
+                   ("Max distance", [row[2]["maxDistance"] for row in rows])]
+        for i, percentile in enumerate(self.ROI_DISTANCE_PERCENTILES):
+            columns.append(("Distance P%d" % percentile, [row[2]["percentiles"][i] for row in rows]))
+        columns.append(("Hausdorff distance", [row[2]["hausdorffDistance"] for row in rows]))
+        return self.exportTable(fidList.GetName() + "_ROIDistances", columns)
+
+    def exportROIOverlaps(self, fidLists, inputModel):
+        """Compute the overlaps between all the ROIs of the fiducial lists on the
+        model and export them in the table '<model>_ROIOverlaps'"""
+        masks = dict()
+        for fidList in fidLists:
+            for label, mask in self.getROIMasks(fidList, inputModel).items():
+                masks["%s: %s" % (fidList.GetName(), label)] = mask
+        overlaps = self.computeROIOverlaps(masks)
+        columns = [("ROI 1", [overlap["ROIs"][0] for overlap in overlaps]),
+                   ("ROI 2", [overlap["ROIs"][1] for overlap in overlaps]),
+                   ("Vertices 1", [overlap["sizes"][0] for overlap in overlaps]),
+                   ("Vertices 2", [overlap["sizes"][1] for overlap in overlaps]),
+                   ("Intersection", [overlap["intersection"] for overlap in overlaps]),
+                   ("Union", [overlap["union"] for overlap in overlaps]),
+                   ("Fraction of 1", [overlap["fractions"][0] for overlap in overlaps]),
+                   ("Fraction of 2", [overlap["fractions"][1] for overlap in overlaps]),
+                   ("Jaccard", [overlap["jaccard"] for overlap in overlaps])]
+        return self.exportTable(inputModel.GetName() + "_ROIOverlaps", columns)
+
+    def exportTable(self, tableName, columns):
+        """Write `columns` (list of (name, values)) in the table node `tableName`,
+        created if needed"""
+        from vtk.util import numpy_support
+        tableNode = slicer.mrmlScene.GetFirstNodeByName(tableName)
+        if tableNode is None or not tableNode.IsA("vtkMRMLTableNode"):
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", tableName)
+        table = vtk.vtkTable()
+        for columnName, values in columns:
+            if values and isinstance(values[0], str):
+                column = vtk.vtkStringArray()
+                for value in values:
+                    column.InsertNextValue(value)
+            else:
+                column = numpy_support.numpy_to_vtk(
+                    numpy.asarray(values, dtype=numpy.float64), deep=1)
+            column.SetName(columnName)
+            table.AddColumn(column)
+        tableNode.SetAndObserveTable(table)
+        return tableNode
+
+    def exportROIStatistics(self, fidList):
+        """Compute the statistics of every ROI of the fiducial list on every model
+        and export them in the table '<fiducial list>_ROIStatistics'"""
+        arrayLabels = self.getROIArrayLabels(fidList)
+        rows = list()
+        for model in self.getROIModels(fidList):
+            self.restoreSparseROIs(model)
+            statistics = self.computeROIStatistics(model, list(arrayLabels))
+            for arrayName, ROIStatistics in statistics.items():
+                rows.append((model.GetName(), arrayLabels[arrayName], ROIStatistics))
+        columns = [("Model", [row[0] for row in rows]),
+                   ("Landmark", [row[1] for row in rows]),
+                   ("Number of vertices", [row[2]["numberOfVertices"] for row in rows]),
+                   ("Area", [row[2]["area"] for row in rows])]
+        for key, columnName in [("centroid", "Centroid"), ("meanNormal", "Mean normal"),
+                                ("extent", "Extent")]:
+            for axis, axisName in enumerate("XYZ"):
+                columns.append(("%s %s" % (columnName, axisName),
+                                [row[2][key][axis] for row in rows]))
+        return self.exportTable(fidList.GetName() + "_ROIStatistics", columns)
+
+    def startSessionRecording(self, fileName):
+        """Write the events of the session (selections, landmark moves, radius
+        changes, propagations) to `fileName`, one JSON object per line, until
+        stopSessionRecording is called. See replaySession."""
+        self.stopSessionRecording()
+        self.sessionRecordFile = open(fileName, 'w')
+        self.sessionRecordStartTime = time.perf_counter()
+        self.recordSessionEvent("session", sceneURL=slicer.mrmlScene.GetURL())
+
+    def stopSessionRecording(self):
+        if self.sessionRecordFile:
+            self.sessionRecordFile.close()
+            self.sessionRecordFile = None
+
+    def recordSessionEvent(self, eventType, **data):
+        if not self.sessionRecordFile:
+            return
+        data["event"] = eventType
+        data["time"] = round(time.perf_counter() - self.sessionRecordStartTime, 4)
+        self.sessionRecordFile.write(json.dumps(data) + "\n")
+        self.sessionRecordFile.flush()
+
+    def replaySession(self, fileName, sceneFileName=None):
+        """Replay the events of a recorded session and return, by type of event,
+        the number of events and the percentiles of their latency in ms.
+
+        The events refer to the nodes of the scene the session was recorded in,
+        which is loaded from `sceneFileName` if given. Landmarks the scene
+        already holds (e.g. if it was saved at the end of the session) are not
+        added again. No user is needed, e.g.:
+            Slicer --no-main-window --python-code "logic = slicer.modules.PickAndPaintWidget.logic;
+                logic.replaySession('session.jsonl', 'scene.mrb'); exit()"
+        """
+        if sceneFileName:
+            slicer.util.loadScene(sceneFileName)
+        with open(fileName) as sessionFile:
+            events = [json.loads(line) for line in sessionFile if line.strip()]
+        recordFile, self.sessionRecordFile = self.sessionRecordFile, None
+        self.replayedMarkupIDs.clear()
+        latencies = collections.defaultdict(list)
+        try:
+            for event in events:
+                replayer = self.SESSION_EVENT_REPLAYERS.get(event["event"])
+                if replayer is None:
+                    continue
+                startTime = time.perf_counter()
+                getattr(self, replayer)(event)
+                # Include the work deferred to the event loop (added landmarks, rendering)
+                slicer.app.processEvents()
+                latencies[event["event"]].append((time.perf_counter() - startTime) * 1000.0)
+        finally:
+            self.sessionRecordFile = recordFile
+
+        report = dict()
+        for eventType, eventLatencies in latencies.items():
+            p50, p90, p99 = numpy.percentile(eventLatencies, [50, 90, 99])
+            report[eventType] = {"count": len(eventLatencies), "p50": p50, "p90": p90,
+                                 "p99": p99, "max": max(eventLatencies)}
+            logging.info("%s: %d events, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms",
+                         eventType, len(eventLatencies), p50, p90, p99, max(eventLatencies))
+        return report
+
+    def replayModelSelected(self, event):
+        self.interface.inputModelSelector.setCurrentNode(
+            slicer.mrmlScene.GetNodeByID(event["modelID"] or ""))
+
+    def replayListSelected(self, event):
+        self.interface.inputLandmarksSelector.setCurrentNode(
+            slicer.mrmlScene.GetNodeByID(event["fidListID"] or ""))
+
+    def replayLandmarkSelected(self, event):
+        comboBox = self.interface.landmarkComboBox
+        comboBox.setCurrentIndex(comboBox.findText(event["label"]))
+
+    def replayPointsAdded(self, event):
+        fidList = slicer.mrmlScene.GetNodeByID(event["fidListID"])
+        recordedIDs = event.get("markupIDs") or [None] * len(event["positions"])
+        missing = [n for n, markupID in enumerate(recordedIDs)
+                   if markupID is None or fidList.GetNthControlPointIndexByID(markupID) < 0]
+        if not missing:
+            return
+        markupIDs = self.importLandmarks(fidList, [event["positions"][n] for n in missing],
+                                         [event["labels"][n] for n in missing])
+        for n, markupID in zip(missing, markupIDs):
+            if recordedIDs[n] is not None:
+                self.replayedMarkupIDs[recordedIDs[n]] = markupID
+
+    def getReplayedMarkupID(self, markupID):
+        return self.replayedMarkupIDs.get(markupID, markupID)
+
+    def replayPointModified(self, event):
+        fidList = slicer.mrmlScene.GetNodeByID(event["fidListID"])
+        markupsIndex = fidList.GetNthControlPointIndexByID(self.getReplayedMarkupID(event["markupID"]))
+        # Moved without the observers, the move is then handled as in the session
+        self.handlingPointModifiedEvent = True
+        try:
+            fidList.SetNthFiducialPositionFromArray(markupsIndex, event["position"])
+        finally:
+            self.handlingPointModifiedEvent = False
+        self.onPointModifiedEvent(fidList, None, markupsIndex)
+
+    def replayRadiusChanged(self, event):
+        self.setLandmarkROIRadius(slicer.mrmlScene.GetNodeByID(event["fidListID"]),
+                                  self.getReplayedMarkupID(event["markupID"]), event["radius"])
+
+    def replayPropagate(self, event):
+        fidList = slicer.mrmlScene.GetNodeByID(event["fidListID"])
+        fidList.SetAttribute("modelToPropList",
+                             self.encodeJSON({"modelToPropList": event["modelToPropList"]}))
+        self.propagateFromReference(fidList, slicer.mrmlScene.GetNodeByID(event["modelID"]),
+                                    event["typeOfPropagation"], event["transferROIShape"],
+                                    event["fillHoles"], event["chained"])
+
+    def estimateMemorySize(self, value):
+        """Size in bytes of a cached value (numpy arrays, VTK data objects and
+        arrays, locators, distance functions and containers of them)"""
+        if isinstance(value, numpy.ndarray):
+            return value.nbytes
+        if isinstance(value, (tuple, list)):
+            return sum(self.estimateMemorySize(item) for item in value)
+        if isinstance(value, str):
+            return len(value)
+        if hasattr(value, "GetActualMemorySize"):
+            return value.GetActualMemorySize() * 1024
+        if isinstance(value, vtk.vtkStaticPointLocator) and value.GetDataSet():
+            # The buckets hold a (point ID, bucket) pair per point and the
+            # offset of each bucket
+            idSize = vtk.vtkIdTypeArray().GetDataTypeSize()
+            return idSize * (2 * value.GetDataSet().GetNumberOfPoints() + value.GetNumberOfBuckets() + 1)
+        if isinstance(value, vtk.vtkImplicitPolyDataDistance) and hasattr(value, "GetLocator"):
+            return self.estimateMemorySize(value.GetLocator())
+        return 0
+
+    def computeMemoryReport(self):
+        """List the memory used by PickAndPaint: harden copies, ROI and distance
+        arrays of the models, attributes of the fiducial lists and cached
+        search structures. Each row gives the owner, the item, its size in bytes
+        and whether it is orphaned (its owner was removed from the scene, or it
+        is a harden copy that is not in the pool)."""
+        rows = list()
+
+        def addRow(owner, item, size, orphan=False):
+            rows.append({"owner": owner, "item": item, "size": int(size), "orphan": orphan})
+
+        fidLists = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
+        fidLists = [fidLists.GetItemAsObject(i) for i in range(fidLists.GetNumberOfItems())]
+        fidLists = [fidList for fidList in fidLists if fidList.GetAttribute("landmarkDescription")]
+        models = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
+        models = [models.GetItemAsObject(i) for i in range(models.GetNumberOfItems())]
+        hardenModelOwners = {hardenModelID: slicer.mrmlScene.GetNodeByID(modelID)
+                             for hardenModelID, modelID in self.hardenModelPool.items()}
+        ownedArrayNames = set()
+        for fidList in fidLists:
+            ownedArrayNames.add(fidList.GetAttribute("arrayName"))
+            ownedArrayNames.update(self.decodeJSON(fidList.GetAttribute("arrayPartNames")) or [])
+            for attributeName in ["landmarkDescription", "propagationChain"]:
+                attribute = fidList.GetAttribute(attributeName)
+                if attribute:
+                    addRow(fidList.GetName(), attributeName, len(attribute))
+        for model in models:
+            isHardenCopy = model.GetID() in self.hardenModelPool \
+                or (model.GetName().startswith("SurfaceRegistration_") and "_hardenCopy_" in model.GetName())
+            polyData = model.GetPolyData()
+            if isHardenCopy:
+                owner = hardenModelOwners.get(model.GetID())
+                addRow(owner.GetName() if owner else model.GetName(), "harden copy",
+                       polyData.GetActualMemorySize() * 1024 if polyData else 0, owner is None)
+                continue
+            if polyData is None:
+                continue
+            pointData = polyData.GetPointData()
+            for i in range(pointData.GetNumberOfArrays()):
+                arrayName = pointData.GetArrayName(i) or ""
+                if arrayName.endswith("_ROI") or arrayName.endswith("_Distance"):
+                    addRow(model.GetName(), arrayName, pointData.GetArray(i).GetActualMemorySize() * 1024,
+                           arrayName.endswith("_ROI") and arrayName not in ownedArrayNames)
+            sparseROIs = model.GetAttribute(self.SPARSE_ROI_ATTRIBUTE)
+            if sparseROIs:
+                addRow(model.GetName(), self.SPARSE_ROI_ATTRIBUTE, len(sparseROIs))
+
+        polyDataOwners = {id(model.GetPolyData()): model.GetName() for model in models
+                          if model.GetPolyData() is not None}
+        with self.meshCacheLock:
+            meshCacheItems = list(self.meshCache.items())
+        for (kind, key), (polyData, version, value) in meshCacheItems:
+            owner = polyDataOwners.get(key)
+            addRow(owner or "(removed mesh)", "cache: " + kind, self.estimateMemorySize(value),
+                   owner is None)
+        fidListIDs = {fidList.GetID(): fidList.GetName() for fidList in fidLists}
+        for landmarkKey, cached in self.ringLayerCache.items():
+            owner = fidListIDs.get(landmarkKey[0]) if isinstance(landmarkKey, tuple) else None
+            addRow(owner or "(removed list)", "cache: rings of %s" % (landmarkKey,),
+                   self.estimateMemorySize(cached[3]), owner is None)
+        for (referenceKey, targetKey), cached in self.vertexPermutationCache.items():
+            owner = polyDataOwners.get(targetKey)
+            addRow(owner or "(removed mesh)", "cache: vertex permutation",
+                   self.estimateMemorySize(cached[3]),
+                   owner is None or referenceKey not in polyDataOwners)
+        return rows
+
+    def exportMemoryReport(self):
+        """Export the memory report, with its total, in the table 'PickAndPaint_MemoryReport'"""
+        rows = self.computeMemoryReport()
+        totalSize = sum(row["size"] for row in rows)
+        orphanSize = sum(row["size"] for row in rows if row["orphan"])
+        logging.info("PickAndPaint memory: %.1f MB, %.1f MB orphaned",
+                     totalSize / 1048576.0, orphanSize / 1048576.0)
+        rows.append({"owner": "Total", "item": "", "size": totalSize, "orphan": False})
+        rows.append({"owner": "Total orphaned", "item": "", "size": orphanSize, "orphan": True})
+        columns = [("Owner", [row["owner"] for row in rows]),
+                   ("Item", [row["item"] or "-" for row in rows]),
+                   ("Size (kB)", [row["size"] / 1024.0 for row in rows]),
+                   ("Orphaned", ["yes" if row["orphan"] else "no" for row in rows])]
+        return self.exportTable("PickAndPaint_MemoryReport", columns)
 
     def warningMessage(self, message):
         messageBox = ctk.ctkMessageBox()
@@ -1041,6 +3593,81 @@ class PickAndPaintTest(ScriptedLoadableModuleTest):
         self.delayDisplay(' Test addArrayFromIdList Function ')
         self.assertTrue(self.testAddArrayFromIdListFunction())
 
+        self.delayDisplay(' Test defineBallNeighbor Function ')
+        self.assertTrue(self.testDefineBallNeighborFunction())
+
+        self.delayDisplay(' Test findClosestVertices Function ')
+        self.assertTrue(self.testFindClosestVerticesFunction())
+
+        self.delayDisplay(' Test sparse ROI encoding ')
+        self.assertTrue(self.testSparseROIEncoding())
+
+        self.delayDisplay(' Test findClosestPointNear Function ')
+        self.assertTrue(self.testFindClosestPointNearFunction())
+
+        self.delayDisplay(' Test computeROIStatistics Function ')
+        self.assertTrue(self.testComputeROIStatisticsFunction())
+
+        self.delayDisplay(' Test getTopologyFingerprint Function ')
+        self.assertTrue(self.testGetTopologyFingerprintFunction())
+
+        self.delayDisplay(' Test computeNestedROIs Function ')
+        self.assertTrue(self.testComputeNestedROIsFunction())
+
+        self.delayDisplay(' Test cleanerAndTriangleFilter Function ')
+        self.assertTrue(self.testCleanerAndTriangleFilterFunction())
+
+        self.delayDisplay(' Test harden model pool ')
+        self.assertTrue(self.testHardenModelPoolFunction())
+
+        self.delayDisplay(' Test session recording and replay ')
+        self.assertTrue(self.testSessionReplayFunction())
+
+        self.delayDisplay(' Test ROI algebra ')
+        self.assertTrue(self.testROIAlgebraFunction())
+
+        self.delayDisplay(' Test getRingLayers Function ')
+        self.assertTrue(self.testGetRingLayersFunction())
+
+        self.delayDisplay(' Test computeSignedDistances Function ')
+        self.assertTrue(self.testComputeSignedDistancesFunction())
+
+        self.delayDisplay(' Test memory report ')
+        self.assertTrue(self.testMemoryReportFunction())
+
+        self.delayDisplay(' Test computeROIWeights Function ')
+        self.assertTrue(self.testComputeROIWeightsFunction())
+
+        self.delayDisplay(' Test computeVertexPermutation Function ')
+        self.assertTrue(self.testComputeVertexPermutationFunction())
+
+        self.delayDisplay(' Test prewarmModels Function ')
+        self.assertTrue(self.testPrewarmModelsFunction())
+
+        self.delayDisplay(' Test propagateChained Function ')
+        self.assertTrue(self.testPropagateChainedFunction())
+
+        self.delayDisplay(' Test logic observers ')
+        self.assertTrue(self.testLogicObserversFunction())
+
+        self.delayDisplay(' Test propagateNonCorrespondentTransfer Function ')
+        self.assertTrue(self.testPropagateNonCorrespondentTransferFunction())
+
+        self.delayDisplay(' Test closeMask Function ')
+        self.assertTrue(self.testCloseMaskFunction())
+
+        self.delayDisplay(' Test widget setup ')
+        self.assertTrue(self.testWidgetSetupFunction())
+
+        self.delayDisplay(' Test importLandmarks Function ')
+        self.assertTrue(self.testImportLandmarksFunction())
+
+        self.delayDisplay(' Test landmark combo box ')
+        self.assertTrue(self.testLandmarkComboBoxFunction())
+
+        self.delayDisplay(' Test propagateCorrespondent Function ')
+        self.assertTrue(self.testPropagateCorrespondentFunction())
+
         self.delayDisplay(' Tests Passed! ')
 
     def testGetClosestPointIndexFunction(self):
@@ -1142,6 +3769,927 @@ class PickAndPaintTest(ScriptedLoadableModuleTest):
                 logging.info(f'test  {i}  AddArrayFromIdList: succeed')
         return True
 
+    def testDefineBallNeighborFunction(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        closestPointIndexList = [9, 35, 1]
+        for i in range(3):
+            radius = 40.0 * (i + 1)
+            ballIDs = logic.defineBallNeighbor(polyData, closestPointIndexList[i], radius)
+            distances = numpy.linalg.norm(points - points[closestPointIndexList[i]], axis=1)
+            expectedIDs = numpy.flatnonzero(distances <= radius)
+            if not numpy.array_equal(numpy.sort(ballIDs), expectedIDs):
+                logging.warning(f'test  {i}  defineBallNeighbor: failed')
+                return False
+            connectedIDs = logic.defineBallNeighbor(polyData, closestPointIndexList[i], radius, True)
+            if closestPointIndexList[i] not in connectedIDs \
+                    or not numpy.isin(connectedIDs, expectedIDs).all():
+                logging.warning(f'test  {i}  defineBallNeighbor (connected): failed')
+                return False
+            logging.info(f'test  {i}  defineBallNeighbor: succeed')
+        return True
+
+    def testFindClosestVerticesFunction(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        closestVertices = logic.findClosestVertices(points * 1.01, polyData)
+        if not numpy.array_equal(closestVertices, numpy.arange(polyData.GetNumberOfPoints())):
+            logging.warning('test findClosestVertices: failed')
+            return False
+        logging.info('test findClosestVertices: succeed')
+        return True
+
+    def testSparseROIEncoding(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        inter = vtk.vtkIdList()
+        logic.defineNeighbor(inter, polyData, 35, 2)
+        connectedIDs = numpy.sort(logic.idListToArray(inter))
+        encodedROI = logic.encodeSparseROI(connectedIDs, polyData.GetNumberOfPoints())
+        if not numpy.array_equal(logic.decodeSparseROI(encodedROI), connectedIDs):
+            logging.warning('test sparse ROI encoding: failed')
+            return False
+        logic.sparseROIStorage = True
+        logic.addArrayFromIdList(connectedIDs, sphereModel, 'Test_sparse')
+        logic.releaseDenseROIs(sphereModel)
+        if polyData.GetPointData().HasArray('Test_sparse'):
+            logging.warning('test sparse ROI release: failed')
+            return False
+        logic.restoreSparseROIs(sphereModel)
+        restoredArray = polyData.GetPointData().GetArray('Test_sparse')
+        if restoredArray is None or not numpy.array_equal(
+                numpy.flatnonzero(numpy_support.vtk_to_numpy(restoredArray)), connectedIDs):
+            logging.warning('test sparse ROI restore: failed')
+            return False
+        # ROI painted again while the storage is off: its sparse copy is kept up
+        # to date, and an outdated copy does not replace the array at save time
+        logic.setSparseROIStorage(False)
+        logic.addArrayFromIdList(connectedIDs[:5], sphereModel, 'Test_sparse')
+        encodedROI = logic.decodeJSON(sphereModel.GetAttribute(logic.SPARSE_ROI_ATTRIBUTE))['Test_sparse']
+        if not numpy.array_equal(logic.decodeSparseROI(encodedROI), connectedIDs[:5]):
+            logging.warning('test sparse ROI update with storage off: failed')
+            return False
+        polyData.GetPointData().GetArray('Test_sparse').SetValue(int(connectedIDs[-1]), 1.0)
+        logic.releaseDenseROIs(sphereModel)
+        if not polyData.GetPointData().HasArray('Test_sparse'):
+            logging.warning('test outdated sparse ROI release: failed')
+            return False
+        logging.info('test sparse ROI encoding: succeed')
+        return True
+
+    def testFindClosestPointNearFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        coord = [1.01 * x for x in polyData.GetPoint(35)]
+        # found within the search radius, and with the fallback on the whole mesh
+        for searchRadius in [5.0, 1e-6]:
+            if logic.findClosestPointNear(polyData, coord, searchRadius) != 35:
+                logging.warning(f'test findClosestPointNear ({searchRadius}): failed')
+                return False
+        logging.info('test findClosestPointNear: succeed')
+        return True
+
+    def testComputeROIStatisticsFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        logic.addArrayFromIdList(numpy.arange(polyData.GetNumberOfPoints()), sphereModel, 'Test_all')
+        logic.addArrayFromIdList([35], sphereModel, 'Test_one')
+        statistics = logic.computeROIStatistics(sphereModel, ['Test_all', 'Test_one'])
+        massProperties = vtk.vtkMassProperties()
+        massProperties.SetInputData(polyData)
+        massProperties.Update()
+        if statistics['Test_all']['numberOfVertices'] != polyData.GetNumberOfPoints() \
+                or abs(statistics['Test_all']['area'] - massProperties.GetSurfaceArea()) > 1e-6 \
+                or numpy.linalg.norm(statistics['Test_all']['centroid']) > 1e-6:
+            logging.warning('test computeROIStatistics (whole mesh): failed')
+            return False
+        # The normal of a vertex of a sphere points away from the center
+        expectedNormal = numpy.array(polyData.GetPoint(35)) / 100.0
+        if statistics['Test_one']['numberOfVertices'] != 1 \
+                or numpy.dot(statistics['Test_one']['meanNormal'], expectedNormal) < 0.95:
+            logging.warning('test computeROIStatistics (one vertex): failed')
+            return False
+        logging.info('test computeROIStatistics: succeed')
+        return True
+
+    def testGetTopologyFingerprintFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        otherSphereModel = self.defineSphere()
+        fingerprint = logic.getTopologyFingerprint(sphereModel)
+        if fingerprint != logic.getTopologyFingerprint(otherSphereModel) \
+                or sphereModel.GetAttribute("topologyFingerprint") != fingerprint:
+            logging.warning('test getTopologyFingerprint (same topology): failed')
+            return False
+        # Moving the points does not change the topology
+        transform = vtk.vtkTransform()
+        transform.Scale(2.0, 1.0, 1.0)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(otherSphereModel.GetPolyData())
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        otherSphereModel.SetAndObservePolyData(transformFilter.GetOutput())
+        if logic.detectTypeOfPropagation(sphereModel, otherSphereModel) != "correspondentShapes":
+            logging.warning('test getTopologyFingerprint (moved points): failed')
+            return False
+        subdivisionFilter = vtk.vtkLinearSubdivisionFilter()
+        subdivisionFilter.SetInputData(otherSphereModel.GetPolyData())
+        subdivisionFilter.Update()
+        otherSphereModel.SetAndObservePolyData(subdivisionFilter.GetOutput())
+        if logic.detectTypeOfPropagation(sphereModel, otherSphereModel) != "nonCorrespondentShapes":
+            logging.warning('test getTopologyFingerprint (other topology): failed')
+            return False
+        # Same number of points but other vertex degrees: the vertices are not matched
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetRadius(100.0)
+        sphereSource.SetThetaResolution(12)
+        sphereSource.SetPhiResolution(6)
+        sphereSource.Update()
+        otherSphereModel.SetAndObservePolyData(sphereSource.GetOutput())
+        numberOfPermutationSearches = [0]
+        getVertexPermutation = logic.getVertexPermutation
+
+        def countingGetVertexPermutation(referenceInputModel, propagatedInputModel):
+            numberOfPermutationSearches[0] += 1
+            return getVertexPermutation(referenceInputModel, propagatedInputModel)
+        logic.getVertexPermutation = countingGetVertexPermutation
+        if logic.detectTypeOfPropagation(sphereModel, otherSphereModel) != "nonCorrespondentShapes" \
+                or numberOfPermutationSearches[0]:
+            logging.warning('test getTopologyFingerprint (other vertex degrees): failed')
+            return False
+        logging.info('test getTopologyFingerprint: succeed')
+        return True
+
+    def testComputeNestedROIsFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        closestPointIndexList = [9, 35, 1]
+        radii = [0, 1, 2, 3]
+        ROIs = logic.computeNestedROIs(polyData, closestPointIndexList, radii)
+        for i, seed in enumerate(closestPointIndexList):
+            for j, radius in enumerate(radii):
+                expectedIDs = numpy.zeros(0, dtype=numpy.int64)
+                if radius:
+                    inter = vtk.vtkIdList()
+                    logic.defineNeighbor(inter, polyData, seed, radius)
+                    expectedIDs = numpy.sort(logic.idListToArray(inter))
+                if not numpy.array_equal(ROIs.row(i * len(radii) + j), expectedIDs):
+                    logging.warning(f'test  {i} {radius}  computeNestedROIs: failed')
+                    return False
+        ballROIs = logic.computeNestedROIs(polyData, closestPointIndexList, [40.0, 80.0],
+                                           logic.ROI_TYPE_BALL)
+        for i, seed in enumerate(closestPointIndexList):
+            for j, radius in enumerate([40.0, 80.0]):
+                expectedIDs = numpy.sort(logic.defineBallNeighbor(polyData, seed, radius))
+                if not numpy.array_equal(ballROIs.row(i * 2 + j), expectedIDs):
+                    logging.warning(f'test  {i} {radius}  computeNestedROIs (ball): failed')
+                    return False
+        logging.info('test computeNestedROIs: succeed')
+        return True
+
+    def testCleanerAndTriangleFilterFunction(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        # Two copies of the sphere: the points of the second one are merged
+        # with the points of the first one by the cleaner
+        appendFilter = vtk.vtkAppendPolyData()
+        appendFilter.AddInputData(sphereModel.GetPolyData())
+        appendFilter.AddInputData(sphereModel.GetPolyData())
+        appendFilter.Update()
+        sphereModel.SetAndObservePolyData(appendFilter.GetOutput())
+        originalPoints = numpy_support.vtk_to_numpy(
+            appendFilter.GetOutput().GetPoints().GetData()).copy()
+        pointIDMap = logic.cleanerAndTriangleFilter(sphereModel)
+        polyData = sphereModel.GetPolyData()
+        cleanedPoints = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        numberOfPoints = originalPoints.shape[0] // 2
+        if polyData.GetNumberOfPoints() != numberOfPoints \
+                or polyData.GetPointData().HasArray(logic.ORIGINAL_POINT_ID_ARRAY_NAME) \
+                or not numpy.array_equal(pointIDMap[:numberOfPoints], pointIDMap[numberOfPoints:]) \
+                or not numpy.allclose(cleanedPoints[pointIDMap], originalPoints):
+            logging.warning('test cleanerAndTriangleFilter: failed')
+            return False
+        logging.info('test cleanerAndTriangleFilter: succeed')
+        return True
+
+    def testHardenModelPoolFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        slicer.mrmlScene.AddNode(sphereModel)
+        logic.hardenModelMemoryBudget = 0
+        hardenModel = logic.createIntermediateHardenModel(sphereModel)
+        sphereModel.SetAttribute("hardenModelID", hardenModel.GetID())
+        hardenModelID = hardenModel.GetID()
+        # Not referenced and over the budget: the copy is evicted...
+        logic.evictHardenModels()
+        if slicer.mrmlScene.GetNodeByID(hardenModelID) is not None \
+                or logic.getHardenModelMemorySizes() or sphereModel.GetAttribute("hardenModelID"):
+            logging.warning('test harden model pool (eviction): failed')
+            return False
+        # ... and created again when it is needed
+        hardenModel = logic.getHardenModel(sphereModel)
+        if hardenModel is None or sphereModel.GetAttribute("hardenModelID") != hardenModel.GetID() \
+                or hardenModel.GetPolyData().GetNumberOfPoints() != sphereModel.GetPolyData().GetNumberOfPoints():
+            logging.warning('test harden model pool (recreation): failed')
+            return False
+        # The copy of the selected model is kept
+        logic.selectedModel = sphereModel
+        logic.evictHardenModels()
+        if slicer.mrmlScene.GetNodeByID(hardenModel.GetID()) is None:
+            logging.warning('test harden model pool (referenced copy): failed')
+            return False
+        logic.selectedModel = None
+        logic.releaseHardenModels()
+        slicer.mrmlScene.RemoveNode(sphereModel)
+        # A model whose copy was evicted can be propagated to
+        referenceModel, fidList = self.defineConnectedLandmarks(logic)
+        targetModel = self.defineScaledSphere("EvictedTarget", 1.1)
+        evictedModelID = logic.getHardenModel(targetModel).GetID()
+        logic.evictHardenModels()
+        if slicer.mrmlScene.GetNodeByID(evictedModelID) is not None:
+            logging.warning('test harden model pool (evicted target): failed')
+            return False
+        logic.propagate(fidList, referenceModel, targetModel, "nonCorrespondentShapes")
+        # The copy made again for the propagation is evicted after it, too
+        hardenModelID = targetModel.GetAttribute("hardenModelID")
+        if not targetModel.GetPolyData().GetPointData().HasArray(fidList.GetAttribute("arrayName")) \
+                or (hardenModelID and slicer.mrmlScene.GetNodeByID(hardenModelID) is None):
+            logging.warning('test harden model pool (propagation to an evicted target): failed')
+            return False
+        logic.releaseHardenModels()
+        for node in [targetModel, referenceModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test harden model pool: succeed')
+        return True
+
+    def testSessionReplayFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        fileName = os.path.join(slicer.app.temporaryPath, "PickAndPaintSession.jsonl")
+        logic.startSessionRecording(fileName)
+        for label in ["F-1", "F-2", "F-1"]:
+            logic.recordSessionEvent("landmarkSelected", label=label)
+        logic.stopSessionRecording()
+        with open(fileName) as sessionFile:
+            events = [json.loads(line) for line in sessionFile]
+        if [event["event"] for event in events] != ["session"] + 3 * ["landmarkSelected"]:
+            logging.warning('test session recording: failed')
+            return False
+        report = logic.replaySession(fileName)
+        if list(report) != ["landmarkSelected"] or report["landmarkSelected"]["count"] != 3 \
+                or not 0 <= report["landmarkSelected"]["p50"] <= report["landmarkSelected"]["max"]:
+            logging.warning('test session replay: failed')
+            return False
+        os.remove(fileName)
+        # Replayed on the scene saved at the end of the session, the added
+        # landmarks are not added again
+        sphereModel, fidList = self.defineConnectedLandmarks(logic, radius=0)
+        polyData = sphereModel.GetPolyData()
+        logic.startSessionRecording(fileName)
+        logic.importLandmarks(fidList, [polyData.GetPoint(10), polyData.GetPoint(40)], ["A", "B"])
+        logic.stopSessionRecording()
+        fidListID = fidList.GetID()
+        sceneFileName = os.path.join(slicer.app.temporaryPath, "PickAndPaintSession.mrb")
+        slicer.util.saveScene(sceneFileName)
+        slicer.mrmlScene.Clear(0)
+        report = logic.replaySession(fileName, sceneFileName)
+        fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+        if report.get("pointsAdded", {}).get("count") != 1 or fidList is None \
+                or fidList.GetNumberOfMarkups() != 5:
+            logging.warning('test session replay (saved scene): failed')
+            return False
+        logic.releaseHardenModels()
+        slicer.mrmlScene.Clear(0)
+        os.remove(fileName)
+        os.remove(sceneFileName)
+        logging.info('test session recording and replay: succeed')
+        return True
+
+    def testROIAlgebraFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        numberOfPoints = 1001
+        maskA = numpy.zeros(numberOfPoints, dtype=bool)
+        maskB = numpy.zeros(numberOfPoints, dtype=bool)
+        maskA[:600] = True
+        maskB[400:700] = True
+        if logic.combineROIMasks("union", [maskA, maskB]).sum() != 700 \
+                or logic.combineROIMasks("intersection", [maskA, maskB]).sum() != 200 \
+                or logic.combineROIMasks("difference", [maskA, maskB]).sum() != 400 \
+                or maskA.sum() != 600:
+            logging.warning('test ROI algebra (operations): failed')
+            return False
+        overlap = logic.computeROIOverlaps({"A": maskA, "B": maskB})[0]
+        if overlap["sizes"] != (600, 300) or overlap["intersection"] != 200 \
+                or overlap["union"] != 700 or abs(overlap["fractions"][1] - 2.0 / 3.0) > 1e-9:
+            logging.warning('test ROI algebra (overlaps): failed')
+            return False
+        # ROIs of a fiducial list combined in a ROI array, kept up to date
+        sphereModel, fidList = self.defineConnectedLandmarks(logic, pointIDs=(2, 3, 35))
+        arrayName = logic.combineROIs(fidList, "intersection", ["L0", "L1"])
+        masks = logic.getROIMasks(fidList)
+        if not numpy.array_equal(logic.getROIMask(sphereModel, arrayName), masks["L0"] & masks["L1"]) \
+                or not (masks["L0"] & masks["L1"]).any():
+            logging.warning('test ROI algebra (combined ROI): failed')
+            return False
+        landmarkDescription = logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        landmarkDescription[fidList.GetNthMarkupID(0)]["ROIradius"] = 3
+        fidList.SetAttribute("landmarkDescription", logic.encodeJSON(landmarkDescription))
+        logic.findROI(fidList)
+        masks = logic.getROIMasks(fidList)
+        if not numpy.array_equal(logic.getROIMask(sphereModel, arrayName), masks["L0"] & masks["L1"]):
+            logging.warning('test ROI algebra (repainted combined ROI): failed')
+            return False
+        targetModel = self.defineScaledSphere("CombinedROITarget", 1.1)
+        logic.propagate(fidList, sphereModel, targetModel, "nonCorrespondentShapes")
+        masks = logic.getROIMasks(fidList, targetModel)
+        if not numpy.array_equal(logic.getROIMask(targetModel, arrayName), masks["L0"] & masks["L1"]):
+            logging.warning('test ROI algebra (propagated combined ROI): failed')
+            return False
+        logic.releaseHardenModels()
+        for node in [targetModel, sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test ROI algebra: succeed')
+        return True
+
+    def testGetRingLayersFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        polyData = sphereModel.GetPolyData()
+        seed = 35
+        # Radius moved up and down: the stored rings are grown and filtered
+        for radius in [1, 3, 2]:
+            ROIPointIDs = numpy.concatenate(logic.getRingLayers(polyData, seed, radius, "landmark"))
+            inter = vtk.vtkIdList()
+            logic.defineNeighbor(inter, polyData, seed, radius)
+            if ROIPointIDs.size != numpy.unique(ROIPointIDs).size \
+                    or not numpy.array_equal(numpy.sort(ROIPointIDs),
+                                             numpy.sort(logic.idListToArray(inter))):
+                logging.warning(f'test  {radius}  getRingLayers: failed')
+                return False
+        if len(logic.ringLayerCache["landmark"][3]) != len(logic.getRingLayers(polyData, seed, 3)):
+            logging.warning('test getRingLayers (stored rings): failed')
+            return False
+        logging.info('test getRingLayers: succeed')
+        return True
+
+    def testComputeSignedDistancesFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        polyData = self.defineSphere().GetPolyData()
+        transform = vtk.vtkTransform()
+        transform.Scale(1.1, 1.1, 1.1)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(polyData)
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        largerPolyData = transformFilter.GetOutput()
+        mask = numpy.zeros(polyData.GetNumberOfPoints(), dtype=bool)
+        mask[::3] = True
+        # The sphere is inside the larger one, at most 10 mm from its faces
+        distances = logic.computeSignedDistances(polyData, mask, largerPolyData)
+        reverseDistances = logic.computeSignedDistances(largerPolyData, mask, polyData)
+        if not numpy.all((distances[mask] < 0) & (distances[mask] >= -10.0 - 1e-6)) \
+                or numpy.any(distances[~mask]) \
+                or not numpy.all((reverseDistances[mask] > 0) & (reverseDistances[mask] <= 10.0 + 1e-6)):
+            logging.warning('test computeSignedDistances: failed')
+            return False
+        # Distances to the surface, not to its vertices: points 5 mm above and
+        # below a plane whose vertices are offset by half a cell
+        planeSource = vtk.vtkPlaneSource()
+        planeSource.SetOrigin(-50.0, -50.0, 0.0)
+        planeSource.SetPoint1(50.0, -50.0, 0.0)
+        planeSource.SetPoint2(-50.0, 50.0, 0.0)
+        planeSource.SetResolution(10, 10)
+        planeSource.Update()
+        targetPolyData = planeSource.GetOutput()
+        offsetSource = vtk.vtkPlaneSource()
+        offsetSource.SetOrigin(-25.0, -25.0, 5.0)
+        offsetSource.SetPoint1(25.0, -25.0, 5.0)
+        offsetSource.SetPoint2(-25.0, 25.0, 5.0)
+        offsetSource.SetResolution(10, 10)
+        offsetSource.Update()
+        offsetPolyData = offsetSource.GetOutput()
+        mask = numpy.ones(offsetPolyData.GetNumberOfPoints(), dtype=bool)
+        distances = logic.computeSignedDistances(offsetPolyData, mask, targetPolyData)
+        transform = vtk.vtkTransform()
+        transform.Translate(0.0, 0.0, -10.0)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(offsetPolyData)
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        belowDistances = logic.computeSignedDistances(transformFilter.GetOutput(), mask, targetPolyData)
+        if not numpy.allclose(distances, 5.0) or not numpy.allclose(belowDistances, -5.0):
+            logging.warning('test computeSignedDistances (offset surface): failed')
+            return False
+        # Hausdorff distance between two sets of vertices
+        points = numpy.array([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]])
+        if logic.computeDirectedHausdorffDistance(points, points[:1]) != 10.0 \
+                or logic.computeDirectedHausdorffDistance(points[:1], points) != 0.0:
+            logging.warning('test computeSignedDistances (Hausdorff distance): failed')
+            return False
+        logging.info('test computeSignedDistances: succeed')
+        return True
+
+    def testMemoryReportFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        sphereModel.SetName("MemoryReportSphere")
+        slicer.mrmlScene.AddNode(sphereModel)
+        # ROI array that no fiducial list owns
+        logic.addArrayFromIdList(numpy.arange(10), sphereModel, "MemoryReportSphere_F-1_ROI")
+        logic.getPointLocator(sphereModel.GetPolyData())
+        rows = logic.computeMemoryReport()
+        ROIRows = [row for row in rows if row["item"] == "MemoryReportSphere_F-1_ROI"]
+        cacheRows = [row for row in rows if row["owner"] == "MemoryReportSphere"
+                     and row["item"] == "cache: pointLocator"]
+        if len(ROIRows) != 1 or not ROIRows[0]["orphan"] or ROIRows[0]["size"] <= 0 \
+                or len(cacheRows) != 1 or cacheRows[0]["orphan"] or cacheRows[0]["size"] <= 0:
+            logging.warning('test memory report: failed')
+            return False
+        # A pooled harden copy belongs to its model, whatever its attribute says
+        logic.getHardenModel(sphereModel)
+        sphereModel.SetAttribute("hardenModelID", "")
+        hardenRows = [row for row in logic.computeMemoryReport() if row["item"] == "harden copy"
+                      and row["owner"] == "MemoryReportSphere"]
+        if len(hardenRows) != 1 or hardenRows[0]["orphan"]:
+            logging.warning('test memory report (harden copy): failed')
+            return False
+        logic.releaseHardenModels()
+        slicer.mrmlScene.RemoveNode(sphereModel)
+        logging.info('test memory report: succeed')
+        return True
+
+    def testComputeROIWeightsFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        polyData = self.defineSphere().GetPolyData()
+        seeds = [9, 35]
+        landmarkStates = list()
+        for weighting in [logic.ROI_WEIGHTING_GAUSSIAN, logic.ROI_WEIGHTING_HEAT]:
+            landmarkState = logic.newLandmarkState("F", True, None)
+            landmarkState["ROIradius"] = 3
+            landmarkState["ROIWeighting"] = weighting
+            landmarkStates.append(landmarkState)
+        ROIPointIDs = [logic.computeLandmarkROI(polyData, seed, landmarkState)
+                       for seed, landmarkState in zip(seeds, landmarkStates)]
+        ROIWeights = logic.computeROIWeights(polyData, seeds, ROIPointIDs, landmarkStates, [None, None])
+        for seed, IDs, weights in zip(seeds, ROIPointIDs, ROIWeights):
+            distances = logic.computeSeedDistances(polyData, seed, IDs, landmarkStates[0])
+            # Scaled to 1, decreasing with the ring distance, positive in the ROI
+            if weights is None or weights.shape != IDs.shape \
+                    or abs(weights.max() - 1.0) > 1e-9 \
+                    or not numpy.all(weights > 0) or not numpy.all(weights <= 1.0) \
+                    or weights[distances == 1].mean() <= weights[distances == 3].mean():
+                logging.warning('test computeROIWeights: failed')
+                return False
+        encodedROI = logic.encodeSparseROI(ROIPointIDs[0], polyData.GetNumberOfPoints(), ROIWeights[0])
+        order = numpy.argsort(ROIPointIDs[0])
+        if not numpy.allclose(logic.decodeSparseROIValues(encodedROI), ROIWeights[0][order], atol=1e-6):
+            logging.warning('test computeROIWeights (sparse encoding): failed')
+            return False
+        logging.info('test computeROIWeights: succeed')
+        return True
+
+    def testComputeVertexPermutationFunction(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        polyData = self.defineSphere().GetPolyData()
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        triangles = logic.getTriangles(polyData)
+        # Same sphere, moved, with its vertices in another order
+        permutation = numpy.random.RandomState(0).permutation(points.shape[0])
+        inversePermutation = numpy.argsort(permutation)
+        permutedPoints = vtk.vtkPoints()
+        permutedPoints.SetData(numpy_support.numpy_to_vtk(points[permutation] + [10.0, 0.0, 0.0], deep=1))
+        permutedTriangles = inversePermutation[triangles]
+        offsets = numpy.arange(0, 3 * len(permutedTriangles) + 1, 3, dtype=numpy.int64)
+        polys = vtk.vtkCellArray()
+        polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=1),
+                      numpy_support.numpy_to_vtkIdTypeArray(
+                          numpy.ascontiguousarray(permutedTriangles.ravel(), dtype=numpy.int64), deep=1))
+        permutedPolyData = vtk.vtkPolyData()
+        permutedPolyData.SetPoints(permutedPoints)
+        permutedPolyData.SetPolys(polys)
+        if not numpy.array_equal(logic.computeVertexPermutation(polyData, permutedPolyData), permutation):
+            logging.warning('test computeVertexPermutation (permuted mesh): failed')
+            return False
+        # Same mesh, flattened and rotated: the matching found maps the triangles
+        flattenedPoints = points * [1.0, 0.7, 0.4]
+        polyData.GetPoints().SetData(numpy_support.numpy_to_vtk(flattenedPoints, deep=1))
+        rotation = vtk.vtkTransform()
+        rotation.RotateWXYZ(40.0, 1.0, 2.0, 3.0)
+        rotationMatrix = numpy.array([[rotation.GetMatrix().GetElement(i, j) for j in range(3)]
+                                      for i in range(3)])
+        permutedPoints.SetData(numpy_support.numpy_to_vtk(
+            flattenedPoints[permutation].dot(rotationMatrix.T), deep=1))
+        permutedPolyData.Modified()
+        matches = logic.computeVertexPermutation(polyData, permutedPolyData)
+        if matches is None or numpy.unique(matches).size != matches.size \
+                or not logic.haveSameTriangles(triangles, matches[permutedTriangles]):
+            logging.warning('test computeVertexPermutation (rotated mesh): failed')
+            return False
+        # Same points but other triangles: not correspondent
+        subdivisionFilter = vtk.vtkLinearSubdivisionFilter()
+        subdivisionFilter.SetInputData(polyData)
+        subdivisionFilter.Update()
+        if logic.computeVertexPermutation(polyData, subdivisionFilter.GetOutput()) is not None:
+            logging.warning('test computeVertexPermutation (other mesh): failed')
+            return False
+        logging.info('test computeVertexPermutation: succeed')
+        return True
+
+    def testPrewarmModelsFunction(self):
+        import concurrent.futures
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel = self.defineSphere()
+        slicer.mrmlScene.AddNode(sphereModel)
+        transform = vtk.vtkTransform()
+        transform.Translate(10, 0, 0)
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+        slicer.mrmlScene.AddNode(transformNode)
+        sphereModel.SetAndObserveTransformNodeID(transformNode.GetID())
+        logic.prewarmModels([sphereModel.GetID()])
+        polyData = sphereModel.GetPolyData()
+        # The worker thread only reads its snapshot, never the mesh of the model
+        if any(key[1] == id(polyData) for key in logic.meshCache):
+            logging.warning('test prewarmModels (snapshot): failed')
+            return False
+        while logic.getNumberOfPendingPrewarmings():
+            time.sleep(0.01)
+        logic.finishPrewarmedHardenings()
+        hardenModel = slicer.mrmlScene.GetNodeByID(sphereModel.GetAttribute("hardenModelID") or "")
+        if hardenModel is None or hardenModel.GetParentTransformNode() is not None \
+                or abs(hardenModel.GetPolyData().GetPoint(0)[0] - polyData.GetPoint(0)[0] - 10) > 1e-6:
+            logging.warning('test prewarmModels (harden copy): failed')
+            return False
+        hardenPolyData = hardenModel.GetPolyData()
+        if any(isinstance(logic.meshCache[(kind, id(hardenPolyData))][2], concurrent.futures.Future)
+               for kind in ('pointLocator', 'vertexSearch', 'vertexAdjacency')):
+            logging.warning('test prewarmModels (cached structures): failed')
+            return False
+        # The prewarmed copy is reused, and not prewarmed again
+        logic.prewarmModels([sphereModel.GetID()])
+        if logic.getFreshHardenModel(sphereModel) is not hardenModel \
+                or hardenModel.GetPolyData() is not hardenPolyData or logic.prewarmedHardenings:
+            logging.warning('test prewarmModels (reuse): failed')
+            return False
+        # An outdated copy stays registered until the new one replaces it
+        transform.Translate(10, 0, 0)
+        transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+        if logic.hasFreshHardenModel(sphereModel) \
+                or sphereModel.GetAttribute("hardenModelID") != hardenModel.GetID():
+            logging.warning('test prewarmModels (outdated copy): failed')
+            return False
+        hardenModel = logic.getHardenModel(sphereModel)
+        if not logic.hasFreshHardenModel(sphereModel) \
+                or sphereModel.GetAttribute("hardenModelID") != hardenModel.GetID() \
+                or abs(hardenModel.GetPolyData().GetPoint(0)[0] - polyData.GetPoint(0)[0] - 20) > 1e-6:
+            logging.warning('test prewarmModels (new copy): failed')
+            return False
+        # The copies of the propagation targets are kept until they are unchecked
+        logic.hardenModelMemoryBudget = 0
+        logic.propagationTargetIDs = {sphereModel.GetID()}
+        logic.evictHardenModels()
+        if hardenModel.GetID() not in logic.hardenModelPool:
+            logging.warning('test prewarmModels (protected target): failed')
+            return False
+        logic.setPropagationTargets([])
+        if hardenModel.GetID() in logic.hardenModelPool:
+            logging.warning('test prewarmModels (unchecked target): failed')
+            return False
+        logic.shutdownPrewarming()
+        logic.releaseHardenModels()
+        slicer.mrmlScene.RemoveNode(sphereModel)
+        slicer.mrmlScene.RemoveNode(transformNode)
+        logging.info('test prewarmModels: succeed')
+        return True
+
+    def testPropagateChainedFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel, fidList = self.defineConnectedLandmarks(logic)
+        arrayName = fidList.GetAttribute("arrayName")
+        timePoints = [self.defineScaledSphere("TimePoint%d" % (n + 1), 1.0 + 0.05 * (n + 1))
+                      for n in range(3)]
+        report = logic.propagateChained(fidList, sphereModel, timePoints[:2], "nonCorrespondentShapes")
+        if len(report) != 2 or not all(model.GetPolyData().GetPointData().HasArray(arrayName)
+                                       for model in timePoints[:2]):
+            logging.warning('test propagateChained (first time points): failed')
+            return False
+        # Appending a time point only propagates to it
+        report = logic.propagateChained(fidList, sphereModel, timePoints, "nonCorrespondentShapes")
+        if len(report) != 3 or not all("already propagated" in line for line in report[:2]) \
+                or "chained from" not in report[2] \
+                or not timePoints[2].GetPolyData().GetPointData().HasArray(arrayName):
+            logging.warning('test propagateChained (appended time point): failed')
+            return False
+        # A modified time point is propagated again, with the following ones
+        points = timePoints[1].GetPolyData().GetPoints()
+        point = points.GetPoint(0)
+        points.SetPoint(0, point[0] * 1.01, point[1], point[2])
+        points.Modified()
+        report = logic.propagateChained(fidList, sphereModel, timePoints, "nonCorrespondentShapes")
+        if "already propagated" not in report[0] \
+                or any("already propagated" in line for line in report[1:]):
+            logging.warning('test propagateChained (modified time point): failed')
+            return False
+        # So is a time point whose ROIs were removed
+        timePoints[0].GetPolyData().GetPointData().RemoveArray(arrayName)
+        report = logic.propagateChained(fidList, sphereModel, timePoints, "nonCorrespondentShapes")
+        if any("already propagated" in line for line in report) \
+                or not timePoints[0].GetPolyData().GetPointData().HasArray(arrayName):
+            logging.warning('test propagateChained (removed ROIs): failed')
+            return False
+        # Changing an option propagates again the whole series
+        for fillHoles in [False, True]:
+            timePoints[0].GetPolyData().GetPointData().RemoveArray(arrayName)
+            logic.propagateChained(fidList, sphereModel, timePoints, "nonCorrespondentShapes",
+                                   transferROIShape=True, fillHoles=fillHoles)
+            if not timePoints[0].GetPolyData().GetPointData().HasArray(arrayName):
+                logging.warning(f'test propagateChained (fillHoles {fillHoles}): failed')
+                return False
+        # The scaled spheres are detected as correspondent
+        report = logic.propagateChained(fidList, sphereModel, timePoints, "automatic")
+        if not all(": correspondent" in line for line in report):
+            logging.warning('test propagateChained (automatic): failed')
+            return False
+        logic.releaseHardenModels()
+        for node in timePoints + [sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test propagateChained: succeed')
+        return True
+
+    def testLogicObserversFunction(self):
+        widget = slicer.modules.PickAndPaintWidget
+        logic = widget.logic
+        modelSelector = slicer.qMRMLNodeComboBox()
+        modelSelector.nodeTypes = ["vtkMRMLModelNode"]
+        modelSelector.setMRMLScene(slicer.mrmlScene)
+        landmarksSelector = slicer.qMRMLNodeComboBox()
+        landmarksSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+        landmarksSelector.setMRMLScene(slicer.mrmlScene)
+        models = [self.defineSphere() for n in range(2)]
+        for model in models:
+            slicer.mrmlScene.AddNode(model)
+        fidList = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+        modelSelector.setCurrentNode(models[0])
+        logic.ModelChanged(modelSelector, landmarksSelector)
+        landmarksSelector.setCurrentNode(fidList)
+        logic.connectLandmarks(modelSelector, landmarksSelector, True)
+        if logic.numberOfObservers() != 4 or widget.observersLabel.text != "Live observers: 4":
+            logging.warning('test logic observers (connection): failed')
+            return False
+        # Switching the model detaches the observer of the previous one
+        modelSelector.setCurrentNode(models[1])
+        logic.ModelChanged(modelSelector, landmarksSelector)
+        observedNodes = [observation[0] for observation in logic.Observations]
+        if logic.numberOfObservers() != 4 or any(node is models[0] for node in observedNodes):
+            logging.warning('test logic observers (model switch): failed')
+            return False
+        # Closing the scene detaches all of them
+        slicer.mrmlScene.Clear(0)
+        if logic.numberOfObservers() != 0 or widget.observersLabel.text != "Live observers: 0":
+            logging.warning('test logic observers (scene close): failed')
+            return False
+        logging.info('test logic observers: succeed')
+        return True
+
+    def testPropagateNonCorrespondentTransferFunction(self):
+        from vtk.util import numpy_support
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel, fidList = self.defineConnectedLandmarks(logic, pointIDs=(35,), radius=1)
+        arrayName = fidList.GetAttribute("arrayName")
+        # Target denser than the reference
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetRadius(100.0)
+        sphereSource.SetThetaResolution(40)
+        sphereSource.SetPhiResolution(40)
+        sphereSource.Update()
+        denseModel = slicer.modules.models.logic().AddModel(sphereSource.GetOutput())
+        logic.propagateNonCorrespondentTransfer(fidList, sphereModel, denseModel)
+        denseArray = denseModel.GetPolyData().GetPointData().GetArray(arrayName)
+        if denseArray is None:
+            logging.warning('test propagateNonCorrespondentTransfer (array): failed')
+            return False
+        mask = numpy_support.vtk_to_numpy(denseArray) > 0
+        # No vertex outside of the ROI is surrounded by vertices of the ROI
+        adjacency = logic.getVertexAdjacency(logic.getHardenModel(denseModel).GetPolyData())
+        if not mask.any() or numpy.any(logic.countNeighborsInMask(adjacency, ~mask)[~mask] == 0):
+            logging.warning('test propagateNonCorrespondentTransfer (holes): failed')
+            return False
+        logic.releaseHardenModels()
+        for node in [denseModel, sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test propagateNonCorrespondentTransfer: succeed')
+        return True
+
+    def testCloseMaskFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        polyData = self.defineSphere().GetPolyData()
+        adjacency = logic.getVertexAdjacency(polyData)
+        inter = vtk.vtkIdList()
+        logic.defineNeighbor(inter, polyData, 35, 2)
+        mask = numpy.zeros(polyData.GetNumberOfPoints(), dtype=bool)
+        mask[logic.idListToArray(inter)] = True
+        # A hole of one vertex is filled, the rest of the ROI is not changed
+        holedMask = mask.copy()
+        holedMask[35] = False
+        if not numpy.array_equal(logic.closeMask(adjacency, holedMask), logic.closeMask(adjacency, mask)) \
+                or not logic.closeMask(adjacency, holedMask)[35] \
+                or logic.closeMask(adjacency, numpy.zeros_like(mask)).any():
+            logging.warning('test closeMask: failed')
+            return False
+        logging.info('test closeMask: succeed')
+        return True
+
+    def testWidgetSetupFunction(self):
+        widget = slicer.modules.PickAndPaintWidget
+        if not widget.setupTime > 0:
+            logging.warning('test widget setup (setup time): failed')
+            return False
+        # The widgets are found in the index built once after loading the .ui file
+        logic = PickAndPaintLogic(widget)
+        for objectName in ["inputModelSelector", "propagateButton", "memoryReportButton"]:
+            if widget.widgetIndex.get(objectName) is None \
+                    or logic.get(objectName) is not widget.widgetIndex[objectName]:
+                logging.warning(f'test widget setup ({objectName}): failed')
+                return False
+        try:
+            logic.get("noSuchWidget")
+            logging.warning('test widget setup (unknown widget): failed')
+            return False
+        except KeyError:
+            pass
+        logging.info('test widget setup: succeed')
+        return True
+
+    def testImportLandmarksFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel, fidList = self.defineConnectedLandmarks(logic, pointIDs=(), radius=0)
+        logic.addObserver(fidList, fidList.PointAddedEvent, logic.onPointAddedEvent)
+        logic.addObserver(fidList, fidList.PointModifiedEvent, logic.onPointModifiedEvent)
+        polyData = logic.getHardenModel(fidList).GetPolyData()
+        pointIDs = [2, 10, 20, 35, 40]
+        positions = [[1.05 * x for x in polyData.GetPoint(pointID)] for pointID in pointIDs]
+        numberOfFindROICalls = [0]
+        findROI = logic.findROI
+
+        def countingFindROI(fidList):
+            numberOfFindROICalls[0] += 1
+            return findROI(fidList)
+        logic.findROI = countingFindROI
+        logic.importLandmarks(fidList, positions, ["I%d" % n for n in range(len(positions))])
+        landmarkDescription = logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        if len(landmarkDescription) != len(pointIDs) or logic.addedPointsProcessingScheduled:
+            logging.warning('test importLandmarks (descriptions): failed')
+            return False
+        for n, pointID in enumerate(pointIDs):
+            landmarkState = landmarkDescription[fidList.GetNthMarkupID(n)]
+            coord = [-1, -1, -1]
+            fidList.GetNthFiducialPosition(n, coord)
+            if not landmarkState["projection"]["isProjected"] \
+                    or landmarkState["projection"]["closestPointIndex"] != pointID \
+                    or numpy.linalg.norm(numpy.subtract(coord, polyData.GetPoint(pointID))) > 1e-6:
+                logging.warning(f'test importLandmarks (projection of landmark {n}): failed')
+                return False
+        if numberOfFindROICalls[0] != 1:
+            logging.warning('test importLandmarks (findROI calls): failed')
+            return False
+        # Points pasted in the list are also painted once, when the events are processed
+        numberOfFindROICalls[0] = 0
+        for position in positions:
+            index = fidList.AddFiducialFromArray(position, "")
+            fidList.SetNthFiducialPositionFromArray(index, position)
+        slicer.app.processEvents()
+        landmarkDescription = logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        if len(landmarkDescription) != 2 * len(pointIDs) or numberOfFindROICalls[0] != 1:
+            logging.warning('test importLandmarks (pasted landmarks): failed')
+            return False
+        logic.removeObservers()
+        logic.releaseHardenModels()
+        for node in [sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test importLandmarks: succeed')
+        return True
+
+    def testLandmarkComboBoxFunction(self):
+        widget = slicer.modules.PickAndPaintWidget
+        logic = PickAndPaintLogic(widget)
+        sphereModel, fidList = self.defineConnectedLandmarks(logic, radius=0)
+        comboBox = widget.landmarkComboBox
+
+        def comboBoxItems():
+            return [(comboBox.itemText(i), comboBox.itemData(i, qt.Qt.UserRole)) for i in range(comboBox.count)]
+        markupIDs = [fidList.GetNthMarkupID(n) for n in range(fidList.GetNumberOfMarkups())]
+        logic.updateLandmarkComboBox(fidList)
+        if comboBoxItems() != [("L0", markupIDs[0]), ("L1", markupIDs[1]), ("L2", markupIDs[2])]:
+            logging.warning('test landmark combo box (update): failed')
+            return False
+        # Added landmark: appended to the items
+        fidList.AddFiducialFromArray(sphereModel.GetPolyData().GetPoint(40), "L3")
+        markupIDs.append(fidList.GetNthMarkupID(3))
+        logic.addLandmarksToDescription(fidList)
+        logic.addLandmarkComboBoxItems(fidList, [3])
+        if comboBoxItems()[-1] != ("L3", markupIDs[3]) or comboBox.count != 4:
+            logging.warning('test landmark combo box (add): failed')
+            return False
+        # Removed landmark: only its item is removed
+        logic.removeLandmarkComboBoxItems([markupIDs[1]])
+        if comboBoxItems() != [("L0", markupIDs[0]), ("L2", markupIDs[2]), ("L3", markupIDs[3])] \
+                or markupIDs[1] in logic.landmarkComboBoxItems:
+            logging.warning('test landmark combo box (remove): failed')
+            return False
+        # Relabeled landmark: its item is renamed in place
+        logic.renameLandmarkComboBoxItem(markupIDs[2], "Renamed")
+        if comboBoxItems() != [("L0", markupIDs[0]), ("Renamed", markupIDs[2]), ("L3", markupIDs[3])] \
+                or logic.landmarkComboBoxItems[markupIDs[2]].row() != 1:
+            logging.warning('test landmark combo box (rename): failed')
+            return False
+        # The selection is the landmark of the current item, not the typed text
+        comboBox.setCurrentIndex(1)
+        comboBox.setEditText("L")
+        if logic.getSelectedLandmarkID() != markupIDs[2]:
+            logging.warning('test landmark combo box (selection): failed')
+            return False
+        logic.clearLandmarkComboBox()
+        logic.releaseHardenModels()
+        for node in [sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test landmark combo box: succeed')
+        return True
+
+    def testPropagateCorrespondentFunction(self):
+        logic = PickAndPaintLogic(slicer.modules.PickAndPaintWidget)
+        sphereModel, fidList = self.defineConnectedLandmarks(logic)
+        arrayName = fidList.GetAttribute("arrayName")
+        # Same number of points (8 * 6 + 2 = 12 * 4 + 2) but other triangles
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetRadius(100.0)
+        sphereSource.SetThetaResolution(12)
+        sphereSource.SetPhiResolution(6)
+        sphereSource.Update()
+        otherModel = slicer.modules.models.logic().AddModel(sphereSource.GetOutput())
+        otherModel.SetName("OtherTopology")
+        if otherModel.GetPolyData().GetNumberOfPoints() != sphereModel.GetPolyData().GetNumberOfPoints():
+            logging.warning('test propagateCorrespondent (test meshes): failed')
+            return False
+        if logic.propagateCorrespondent(fidList, sphereModel, otherModel) \
+                or otherModel.GetPolyData().GetPointData().HasArray(arrayName):
+            logging.warning('test propagateCorrespondent (other topology): failed')
+            return False
+        # Asked as correspondent, the model gets the non correspondent propagation
+        fidList.SetAttribute("modelToPropList", logic.encodeJSON({"modelToPropList": [otherModel.GetID()]}))
+        report = logic.propagateFromReference(fidList, sphereModel, "correspondentShapes")
+        if report != ["OtherTopology: non correspondent (not correspondent)"] \
+                or otherModel.GetAttribute("typeOfPropagation") != "nonCorrespondentShapes" \
+                or not otherModel.GetPolyData().GetPointData().HasArray(arrayName):
+            logging.warning('test propagateCorrespondent (fallback): failed')
+            return False
+        logic.releaseHardenModels()
+        for node in [otherModel, sphereModel, fidList]:
+            slicer.mrmlScene.RemoveNode(node)
+        logging.info('test propagateCorrespondent: succeed')
+        return True
+
+    def defineConnectedLandmarks(self, logic, pointIDs=(2, 20, 35), radius=2):
+        """Sphere model with a fiducial list connected to it, whose landmarks
+        are on the given vertices and have ROIs of `radius` rings"""
+        sphereModel = self.defineSphere()
+        sphereModel.SetName("TestSphere")
+        slicer.mrmlScene.AddNode(sphereModel)
+        fidList = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "TestLandmarks")
+        for n, pointID in enumerate(pointIDs):
+            fidList.AddFiducialFromArray(sphereModel.GetPolyData().GetPoint(pointID), "L%d" % n)
+        logic.getHardenModel(sphereModel)
+        logic.createNewDataStructure(fidList, sphereModel, True)
+        if radius:
+            landmarkDescription = logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+            for landmarkState in landmarkDescription.values():
+                landmarkState["ROIradius"] = radius
+            fidList.SetAttribute("landmarkDescription", logic.encodeJSON(landmarkDescription))
+            logic.findROI(fidList)
+        return sphereModel, fidList
+
+    def defineScaledSphere(self, name, scale):
+        transform = vtk.vtkTransform()
+        transform.Scale(scale, scale, scale)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(self.defineSphere().GetPolyData())
+        transformFilter.SetTransform(transform)
+        transformFilter.Update()
+        model = slicer.modules.models.logic().AddModel(transformFilter.GetOutput())
+        model.SetName(name)
+        return model
+
     def defineSphere(self):
         sphereSource = vtk.vtkSphereSource()
         sphereSource.SetRadius(100.0)